@@ -323,3 +323,181 @@ const long SDdest_size = nroots*4*ntdest;
     }
 }
 }
+
+void LASSIRDMdscatterSD1 (double * SDdest, double * SDsrc, double * wgt,
+                          long * bra, long * ket, long * isrc, int nelem, int nket,
+                          int ndest, int nsrc,
+                          int * SDdest_idx, int * SDsrc_idx, int * SDlen,
+                          int nidx)
+{
+/* Add weighted source 1-TDMs to segmented elements of many state-pair blocks of the STDM1s
+   array, i.e., for all ielem,
+       SDdest[bra[ielem],ket[ielem]][SDdest_idx] += wgt[ielem] * SDsrc[isrc[ielem]][SDsrc_idx]
+   Threads are distributed over contiguous blocks of the destination TDMs, so repeated
+   bra, ket pairs are safe.
+
+   Input:
+        SDsrc : array of shape (*,2,nsrc*nsrc)
+        wgt : array of shape (nelem); contains overlap & permutation factors
+        bra : array of shape (nelem); first state index of SDdest
+        ket : array of shape (nelem); second state index of SDdest
+        isrc : array of shape (nelem); index of SDsrc
+        SDdest_idx : array of shape (nidx)
+            beginnings of contiguous blocks in the minor dimension of SDdest
+        SDsrc_idx : array of shape (nidx)
+            beginnings of contiguous blocks in the minor dimension of SDsrc
+        SDlen : array of shape (nidx); lengths of contiguous blocks
+
+   Input/Output:
+        SDdest : array of shape (nbra,nket,2,ndest*ndest)
+            Elements of SDsrc corresponding to SDdest_idx are added
+*/
+const unsigned int i_one = 1;
+const long npdest = ndest*ndest;
+const long npsrc = nsrc*nsrc;
+const long nssrc = 2*npsrc;
+const int nblk = 2*nidx;
+#pragma omp parallel
+{
+    int ispin, iidx;
+    long sidx, didx;
+    #pragma omp for schedule(static)
+    for (int i = 0; i < nblk; i++){
+        ispin = i/nidx;
+        iidx = i%nidx;
+        sidx = ispin*npsrc + SDsrc_idx[iidx];
+        for (int ielem = 0; ielem < nelem; ielem++){
+            didx = ((bra[ielem]*nket + ket[ielem])*2 + ispin)*npdest + SDdest_idx[iidx];
+            daxpy_(SDlen+iidx, wgt+ielem, SDsrc+isrc[ielem]*nssrc+sidx, &i_one,
+                   SDdest+didx, &i_one);
+        }
+    }
+}
+}
+
+void LASSIRDMdscatterSD2 (double * SDdest, double * SDsrc, double * wgt,
+                          long * bra, long * ket, long * isrc, int nelem, int nket,
+                          int ndest, int nsrc, int * pdest,
+                          int * SDdest_idx, int * SDsrc_idx, int * SDlen,
+                          int nidx)
+{
+/* Add weighted source 2-TDMs to segmented elements of many state-pair blocks of the STDM2s
+   array, i.e., for all ielem,
+       SDdest[bra[ielem],ket[ielem]][pdest,SDdest_idx] += wgt[ielem] * SDsrc[isrc[ielem]][:,SDsrc_idx]
+   Threads are distributed over contiguous blocks of the destination TDMs, so repeated
+   bra, ket pairs are safe.
+
+   Input:
+        SDsrc : array of shape (*,4,nsrc*nsrc,nsrc*nsrc)
+        wgt : array of shape (nelem); contains overlap & permutation factors
+        bra : array of shape (nelem); first state index of SDdest
+        ket : array of shape (nelem); second state index of SDdest
+        isrc : array of shape (nelem); index of SDsrc
+        pdest : array of shape (nsrc,nsrc)
+            Indices of all addressed elements in the second-minor dimension of SDdest
+        SDdest_idx : array of shape (nidx)
+            beginnings of contiguous blocks in the minor dimension of SDdest
+        SDsrc_idx : array of shape (nidx)
+            beginnings of contiguous blocks in the minor dimension of SDsrc
+        SDlen : array of shape (nidx); lengths of contiguous blocks
+
+   Input/Output:
+        SDdest : array of shape (nbra,nket,4,ndest*ndest,ndest*ndest)
+            Elements of SDsrc corresponding to SDdest_idx are added
+*/
+const unsigned int i_one = 1;
+const long npdest = ndest*ndest;
+const long npsrc = nsrc*nsrc;
+const long ntdest = npdest*npdest;
+const long ntsrc = npsrc*npsrc;
+const long nssrc = 4*ntsrc;
+const int nblk = 4*npsrc*nidx;
+const int lspin = npsrc*nidx;
+#pragma omp parallel
+{
+    int ipdest, ispin, iidx, j;
+    long sidx, didx;
+    #pragma omp for schedule(static)
+    for (int i = 0; i < nblk; i++){
+        ispin = i/lspin;
+        j = i%lspin;
+        ipdest = j/nidx;
+        iidx = j%nidx;
+        sidx = ispin*ntsrc + ((long) ipdest*npsrc + SDsrc_idx[iidx]);
+        for (int ielem = 0; ielem < nelem; ielem++){
+            didx = ((bra[ielem]*nket + ket[ielem])*4 + ispin)*ntdest;
+            didx += (long) pdest[ipdest]*npdest + SDdest_idx[iidx];
+            daxpy_(SDlen+iidx, wgt+ielem, SDsrc+isrc[ielem]*nssrc+sidx, &i_one,
+                   SDdest+didx, &i_one);
+        }
+    }
+}
+}
+
+void LASSIRDMzscatterSD1 (double complex * SDdest, double complex * SDsrc,
+                          double complex * wgt, long * bra, long * ket, long * isrc,
+                          int nelem, int nket,
+                          int ndest, int nsrc,
+                          int * SDdest_idx, int * SDsrc_idx, int * SDlen,
+                          int nidx)
+{
+/* Complex version of LASSIRDMdscatterSD1 */
+const unsigned int i_one = 1;
+const long npdest = ndest*ndest;
+const long npsrc = nsrc*nsrc;
+const long nssrc = 2*npsrc;
+const int nblk = 2*nidx;
+#pragma omp parallel
+{
+    int ispin, iidx;
+    long sidx, didx;
+    #pragma omp for schedule(static)
+    for (int i = 0; i < nblk; i++){
+        ispin = i/nidx;
+        iidx = i%nidx;
+        sidx = ispin*npsrc + SDsrc_idx[iidx];
+        for (int ielem = 0; ielem < nelem; ielem++){
+            didx = ((bra[ielem]*nket + ket[ielem])*2 + ispin)*npdest + SDdest_idx[iidx];
+            zaxpy_(SDlen+iidx, wgt+ielem, SDsrc+isrc[ielem]*nssrc+sidx, &i_one,
+                   SDdest+didx, &i_one);
+        }
+    }
+}
+}
+
+void LASSIRDMzscatterSD2 (double complex * SDdest, double complex * SDsrc,
+                          double complex * wgt, long * bra, long * ket, long * isrc,
+                          int nelem, int nket,
+                          int ndest, int nsrc, int * pdest,
+                          int * SDdest_idx, int * SDsrc_idx, int * SDlen,
+                          int nidx)
+{
+/* Complex version of LASSIRDMdscatterSD2 */
+const unsigned int i_one = 1;
+const long npdest = ndest*ndest;
+const long npsrc = nsrc*nsrc;
+const long ntdest = npdest*npdest;
+const long ntsrc = npsrc*npsrc;
+const long nssrc = 4*ntsrc;
+const int nblk = 4*npsrc*nidx;
+const int lspin = npsrc*nidx;
+#pragma omp parallel
+{
+    int ipdest, ispin, iidx, j;
+    long sidx, didx;
+    #pragma omp for schedule(static)
+    for (int i = 0; i < nblk; i++){
+        ispin = i/lspin;
+        j = i%lspin;
+        ipdest = j/nidx;
+        iidx = j%nidx;
+        sidx = ispin*ntsrc + ((long) ipdest*npsrc + SDsrc_idx[iidx]);
+        for (int ielem = 0; ielem < nelem; ielem++){
+            didx = ((bra[ielem]*nket + ket[ielem])*4 + ispin)*ntdest;
+            didx += (long) pdest[ipdest]*npdest + SDdest_idx[iidx];
+            zaxpy_(SDlen+iidx, wgt+ielem, SDsrc+isrc[ielem]*nssrc+sidx, &i_one,
+                   SDdest+didx, &i_one);
+        }
+    }
+}
+}
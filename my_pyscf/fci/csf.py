@@ -9,8 +9,8 @@ from pyscf.lib.numpy_helper import tag_array
 from mrh.my_pyscf.lib.logger import select_log_printer
 from mrh.my_pyscf.fci.csdstring import get_csdaddrs_shape 
 from mrh.my_pyscf.fci.csfstring import count_all_csfs, get_spin_evecs
-from mrh.my_pyscf.fci.csfstring import get_csfvec_shape
-from mrh.my_pyscf.fci.csfstring import CSFTransformer
+from mrh.my_pyscf.fci.csfstring import get_csfvec_shape, get_spin_exchange_diag, get_econf_addrs
+from mrh.my_pyscf.fci.csfstring import CSFTransformer, get_link_index_cached
 from mrh.lib.helper import load_library as mrh_load_library
 '''
     MRH 03/24/2019
@@ -62,25 +62,76 @@ def get_init_guess(norb, nelec, nroots, hdiag_csf, transformer):
     ci = _get_init_guess (ncsf_sym, 1, nroots, hdiag_csf, nelec)
     return transformer.vec_csf2det (ci)
 
+def get_link_index (norb, nelec):
+    ''' Same as pyscf.fci.direct_spin1._unpack (norb, nelec, None), but with link indices shared
+    across solvers through csfstring.get_link_index_cached '''
+    neleca, nelecb = _unpack_nelec (nelec)
+    link_indexa = link_indexb = get_link_index_cached (norb, neleca)
+    if neleca != nelecb:
+        link_indexb = get_link_index_cached (norb, nelecb)
+    return link_indexa, link_indexb
+
+def contract_2e_csf (fci, h2e, civec, norb, nelec, link_index=None, transformer=None, ci_det=None):
+    ''' Sigma vectors of one or several CSF-basis CI vectors. The determinant-basis vectors are
+    built and projected back one spin-coupling block at a time, only through the configurations
+    of the target irrep, instead of going through the full transform_civec_det2csf machinery.
+    Several vectors are transformed together with one matrix-matrix product per block.
+
+    Args:
+        fci: instance of CSFFCISolver
+        h2e: ndarray
+            Output of fci.absorb_h1e
+        civec: ndarray of shape (transformer.ncsf,) or (nvec, transformer.ncsf)
+        norb: integer
+        nelec: integer or pair of integers
+
+    Kwargs:
+        link_index: tuple of ndarrays
+        transformer: instance of CSFTransformer
+            Defaults to fci.transformer
+        ci_det: ndarray of shape (ndeta, ndetb) or (nvec, ndeta, ndetb)
+            Buffer for the determinant-basis vectors, reused between calls
+
+    Returns:
+        hc: ndarray of the same shape as civec
+    '''
+    if transformer is None: transformer = fci.transformer
+    civec = np.asarray (civec)
+    ci_det = transformer.vec_csf2det_blocked (civec, out=ci_det)
+    if civec.ndim == 1:
+        hc = fci.contract_2e (h2e, ci_det, norb, nelec, link_index)
+    else:
+        # Each sigma vector overwrites the determinant-basis vector it came from
+        hc = ci_det
+        for i in range (civec.shape[0]):
+            hc[i] = fci.contract_2e (h2e, ci_det[i], norb, nelec, link_index)
+    return transformer.vec_det2csf_blocked (hc)
+
 def make_hdiag_det (fci, h1e, eri, norb, nelec):
     ''' Wrap to the uhf version in order to use two-component h1e '''
     return direct_uhf.make_hdiag (unpack_h1e_ab (h1e), [eri, eri, eri], norb, nelec)
 
 def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None, max_memory=None):
+    ''' Within an electron configuration, the only nonzero off-diagonal Hamiltonian matrix elements
+    between determinants are spin exchanges of pairs of singly-occupied orbitals, so that
+
+    hdiag_csf[conf,:] = np.dot (hdiag_det[conf,:], umat**2) + np.dot (K[conf,:], D)
+
+    with D from csfstring.get_spin_exchange_diag. Configurations are streamed in blocks that fit
+    within max_memory. '''
     smult = transformer.smult
     if hdiag_det is None:
         hdiag_det = make_hdiag_det (None, h1e, eri, norb, nelec)
+    if max_memory is None: max_memory = lib.param.MAX_MEMORY
     eri = ao2mo.restore(1, eri, norb)
-    tlib = wlib = 0
+    kmat = np.ascontiguousarray (np.einsum ('pqqp->pq', eri))
     neleca, nelecb = _unpack_nelec (nelec)
     min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = get_csdaddrs_shape (norb, neleca, nelecb)
     _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
     npair_econf_size = npair_dconf_size * npair_sconf_size
     max_npair = min (neleca, nelecb)
     ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
-    ndeta_all = cistring.num_strings(norb, neleca)
     ndetb_all = cistring.num_strings(norb, nelecb)
-    ndet_all = ndeta_all * ndetb_all
     hdiag_csf = np.ascontiguousarray (np.zeros (ncsf_all, dtype=np.float64))
     hdiag_csf_check = np.ones (ncsf_all, dtype=np.bool_)
     for npair in range (min_npair, max_npair+1):
@@ -90,8 +141,21 @@ def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None, max_memo
         ncsf = int (npair_csf_size[ipair])
         if ncsf == 0:
             continue
+        nspin = neleca + nelecb - 2*npair
+        npr = nspin * (nspin-1) // 2
         csd_offset = npair_csd_offset[ipair]
-        det_addr = transformer.csd_mask[csd_offset:][:nconf*ndet]
+        csf_offset = npair_csf_offset[ipair]
+        det_addr = transformer.csd_mask[csd_offset:][:nconf*ndet].reshape (nconf, ndet)
+        hdiag_csf_check[csf_offset:][:nconf*ncsf] = False
+        if ndet == 1:
+            # Closed-shell singlets
+            assert (ncsf == 1)
+            hdiag_csf[csf_offset:][:nconf] = hdiag_det[det_addr.flat]
+            continue
+        umat = transformer.umats[nspin]
+        umat2 = umat * umat
+        dmat = get_spin_exchange_diag (nspin, neleca, nelecb, smult, umat=umat)
+        idx, jdx = np.triu_indices (nspin, k=1)
         # mem safety
         # Issue #54: PySCF wants "max_memory" on entrance to FCI to be "remaining memory". However,
         # the first few lines of this function consume some memory, so that's difficult to
@@ -99,49 +163,28 @@ def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None, max_memo
         # calculation.
         mem_remaining = max_memory - lib.current_memory ()[0]
         safety_factor = 1.2
-        nfloats = float(nconf)*ndet*ndet + float(det_addr.size)
-        mem_floats = nfloats * np.dtype (float).itemsize / 1e6
-        mem_ints = det_addr.dtype.itemsize * det_addr.size * 3 / 1e6
-        mem = safety_factor * (mem_floats + mem_ints)
-        memstr = ("hdiag_csf of {} orbitals, ({},{}) electrons and smult={} with {} "
-                  "doubly-occupied orbitals ({} configurations and {} determinants) requires {} "
-                  "MB > {} MB remaining of {} MB max").format (
-            norb, neleca, nelecb, smult, npair, nconf, ndet, mem, mem_remaining, max_memory)
-        if mem > mem_remaining:
+        nfloats_conf = ndet + norb + nspin + npr + ncsf
+        mem_conf = safety_factor * nfloats_conf * np.dtype (float).itemsize / 1e6
+        blksize = int (mem_remaining / mem_conf) if mem_remaining > 0 else 0
+        if blksize < 1:
+            memstr = ("hdiag_csf of {} orbitals, ({},{}) electrons and smult={} with {} "
+                      "doubly-occupied orbitals requires {} MB per configuration > {} MB remaining "
+                      "of {} MB max").format (norb, neleca, nelecb, smult, npair, mem_conf,
+                                              mem_remaining, max_memory)
             raise MemoryError (memstr)
         # end mem safety
-        nspin = neleca + nelecb - 2*npair
-        csf_offset = npair_csf_offset[ipair]
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
-        if ndet == 1:
-            # Closed-shell singlets
-            assert (ncsf == 1)
-            hdiag_csf[csf_offset:][:nconf] = hdiag_det[det_addr.flat]
-            hdiag_csf_check[csf_offset:][:nconf] = False
-            continue
-        det_addra, det_addrb = divmod (det_addr, ndetb_all)
-        det_stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, det_addra).reshape (nconf, ndet, order='C'))
-        det_strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, det_addrb).reshape (nconf, ndet, order='C'))
-        det_addr = det_addr.reshape (nconf, ndet, order='C')
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
-        hdiag_conf_det = np.ascontiguousarray (hdiag_det[det_addr], dtype=np.float64)
-        t1 = lib.logger.process_clock ()
-        w1 = lib.logger.perf_counter ()
-        libcsf.FCICSFhdiag (hdiag_conf.ctypes.data_as (ctypes.c_void_p),
-                            hdiag_conf_det.ctypes.data_as (ctypes.c_void_p),
-                            eri.ctypes.data_as (ctypes.c_void_p),
-                            det_stra.ctypes.data_as (ctypes.c_void_p),
-                            det_strb.ctypes.data_as (ctypes.c_void_p),
-                            ctypes.c_uint (norb), ctypes.c_uint (nconf), ctypes.c_uint (ndet))
-        tlib += lib.logger.process_clock () - t1
-        wlib += lib.logger.perf_counter () - w1
-        umat = get_spin_evecs (nspin, neleca, nelecb, smult)
-        hdiag_conf = np.tensordot (hdiag_conf, umat, axes=1)
-        hdiag_conf *= umat[np.newaxis,:,:]
-        hdiag_csf[csf_offset:][:nconf*ncsf] = hdiag_conf.sum (1).ravel (order='C')
-        hdiag_csf_check[csf_offset:][:nconf*ncsf] = False
+        for i0, i1 in lib.prange (0, nconf, blksize):
+            addr = det_addr[i0:i1]
+            hdiag_blk = np.dot (hdiag_det[addr], umat2)
+            # Singly-occupied orbitals of each configuration, in ascending order
+            addra, addrb = divmod (addr[:,0], ndetb_all)
+            somo_str = (cistring.addrs2str (norb, neleca, addra)
+                        ^ cistring.addrs2str (norb, nelecb, addrb))
+            somo = (somo_str[:,None] >> np.arange (norb)[None,:]) & 1
+            somo = np.nonzero (somo)[1].reshape (i1-i0, nspin)
+            hdiag_blk += np.dot (kmat[somo[:,idx],somo[:,jdx]], dmat)
+            hdiag_csf[csf_offset:][i0*ncsf:i1*ncsf] = hdiag_blk.ravel ()
     assert (np.count_nonzero (hdiag_csf_check) == 0), np.count_nonzero (hdiag_csf_check)
-    #print ("Time in hdiag_csf library: {}, {}".format (tlib, wlib))
     return hdiag_csf
 
 
@@ -183,7 +226,7 @@ def make_hdiag_csf_slower (h1e, eri, norb, nelec, transformer, hdiag_det=None, m
             hdiag_csf[csf_offset:][:nconf] = hdiag_det[det_addr.flat]
             hdiag_csf_check[csf_offset:][:nconf] = False
             continue
-        umat = get_spin_evecs (nspin, neleca, nelecb, smult)
+        umat = transformer.umats[nspin]
         det_addra, det_addrb = divmod (det_addr, ndetb_all)
         t1, w1 = lib.logger.process_clock (), lib.logger.perf_counter ()
         det_stra = cistring.addrs2str (norb, neleca, det_addra).reshape (nconf, ndet, order='C')
@@ -277,8 +320,8 @@ def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=N
 
     # To build 
     econf_addr = np.unique (transformer.econf_csf_mask[csf_addr])
-    det_addr = np.concatenate ([np.nonzero (transformer.econf_det_mask == conf)[0]
-        for conf in econf_addr])
+    det_addr = get_econf_addrs (norb, neleca, nelecb, transformer.smult, econf_addr,
+                                transformer.csd_mask)[0]
     lib.logger.debug (fci, ("csf.pspace: Lowest-energy %s CSFs correspond to %s configurations"
         " which are spanned by %s determinants"), npsp, econf_addr.size, det_addr.size)
 
@@ -390,7 +433,7 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     nroots = min(ncsf_sym, nroots)
     if nroots is not None:
         assert (ncsf_sym >= nroots), "Can't find {} roots among only {} CSFs".format (nroots, ncsf_sym)
-    link_indexa, link_indexb = _unpack(norb, nelec, None)
+    link_indexa, link_indexb = get_link_index (norb, nelec)
     na = link_indexa.shape[0]
     nb = link_indexb.shape[0]
 
@@ -436,10 +479,24 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     '''
     h2e = fci.absorb_h1e(h1e, eri, norb, nelec, .5)
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: h2e", *t0)
-    def hop(x):
-        x_det = transformer.vec_csf2det (x)
-        hx = fci.contract_2e(h2e, x_det, norb, nelec, (link_indexa,link_indexb))
-        return transformer.vec_det2csf (hx, normalize=False).ravel ()
+    ci_det = np.empty ((0,na,nb), dtype=np.float64)
+    def hop(xs):
+        nonlocal ci_det
+        nvec = len (xs)
+        # Determinant-basis buffer and one contract_2e output per vector
+        mem_remaining = max_memory - lib.current_memory ()[0] + ci_det.nbytes/1e6
+        blksize = int (mem_remaining*1e6 / (2*na*nb*np.dtype (np.float64).itemsize))
+        blksize = max (1, min (nvec, blksize))
+        if ci_det.shape[0] < blksize:
+            ci_det = None
+            ci_det = np.empty ((blksize,na,nb), dtype=np.float64)
+        hxs = []
+        for p0, p1 in lib.prange (0, nvec, blksize):
+            hx = contract_2e_csf (fci, h2e, np.stack (xs[p0:p1]), norb, nelec,
+                                  (link_indexa,link_indexb), transformer=transformer,
+                                  ci_det=ci_det[:p1-p0])
+            hxs.extend (list (hx))
+        return hxs
 
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: make hop", *t0)
     if ci0 is None:
@@ -476,11 +533,15 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
 
     #with lib.with_omp_threads(fci.threads):
         #e, c = lib.davidson(hop, ci0, precond, tol=fci.conv_tol, lindep=fci.lindep)
-    e, c = fci.eig(hop, ci0, precond, tol=tol, lindep=lindep,
-                       max_cycle=max_cycle, max_space=max_space, nroots=nroots,
-                       max_memory=max_memory, verbose=verbose, follow_state=True,
-                       tol_residual=tol_residual, **kwargs)
-    t0 = lib.logger.timer_debug1 (fci, "csf.kernel: running fci.eig", *t0)
+    # hop acts on the whole list of trial vectors at once, so it goes to lib.davidson1 directly
+    # rather than through fci.eig, which maps a single-vector op over the list
+    fci.converged, e, c = lib.davidson1 (hop, ci0, precond, tol=tol, lindep=lindep,
+                                         max_cycle=max_cycle, max_space=max_space, nroots=nroots,
+                                         max_memory=max_memory, verbose=verbose, follow_state=True,
+                                         tol_residual=tol_residual, lessio=fci.lessio, **kwargs)
+    if nroots == 1:
+        fci.converged, e, c = fci.converged[0], e[0], c[0]
+    t0 = lib.logger.timer_debug1 (fci, "csf.kernel: running lib.davidson1", *t0)
     c = transformer.vec_csf2det (c, order='C')
     t0 = lib.logger.timer_debug1 (fci, "csf.kernel: transforming final ci vector", *t0)
     if nroots > 1:
@@ -489,6 +550,13 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
         return e+ecore, c.reshape(na,nb)
 
 class CSFFCISolver: # parent class
+    ''' The spin-coupling matrices, string tables and link indices of the CSF solvers are shared
+    between instances through process-wide caches in csfstring.py, capped at
+    UMAT_CACHE_MAX_MEMORY and TABLE_CACHE_MAX_MEMORY MB (config keys
+    fci_csfstring_umat_cache_max_memory and fci_csfstring_table_cache_max_memory). This memory
+    is not counted against max_memory. Release it with csfstring.clear_umat_cache () and
+    csfstring.clear_table_cache (); arrays still referred to by a solver's transformer are only
+    freed along with the solver. '''
     _keys = {'smult', 'transformer'}
     pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 200)
     make_hdiag = make_hdiag_det
@@ -515,6 +583,8 @@ class CSFFCISolver: # parent class
         return h2eff
 
     def contract_2e(self, eri, fcivec, norb, nelec, link_index=None, **kwargs):
+        if link_index is None:
+            link_index = get_link_index (norb, _unpack_nelec (nelec, self.spin))
         hc = super().contract_2e(eri, fcivec, norb, nelec, link_index, **kwargs)
         if hasattr (eri, 'h1e_s'):
            hc += direct_uhf.contract_1e ([eri.h1e_s, -eri.h1e_s], fcivec, norb, nelec, link_index)  
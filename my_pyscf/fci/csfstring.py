@@ -1,6 +1,8 @@
 import numpy as np
 import sys, os, time
 import ctypes
+import threading
+from collections import OrderedDict
 from mrh.my_pyscf.fci import csdstring
 from pyscf.fci import cistring
 from pyscf.fci.spin_op import spin_square0
@@ -11,8 +13,87 @@ from mrh.util.io import prettyprint_ndarray
 from functools import reduce
 from mrh.lib.helper import load_library
 from pyscf.fci.direct_spin1_symm import _gen_strs_irrep
+from pyscf import __config__
 libcsf = load_library ('libcsf')
 
+# Capacity in MB of the process-wide least-recently-used cache of get_spin_evecs_cached. Zero
+# disables the cache.
+UMAT_CACHE_MAX_MEMORY = getattr (__config__, 'fci_csfstring_umat_cache_max_memory', 256)
+# Capacity in MB of the process-wide least-recently-used cache of the string tables of
+# CSFTransformer (csd_mask, econf_det_mask, econf_csf_mask, confsym) and of FCI link indices.
+# Zero disables the cache. Both caches are outside of any object's max_memory accounting, and
+# entries evicted from them stay alive as long as a CSFTransformer refers to them.
+TABLE_CACHE_MAX_MEMORY = getattr (__config__, 'fci_csfstring_table_cache_max_memory', 100)
+_umat_cache = OrderedDict ()
+_table_cache = OrderedDict ()
+_cache_lock = threading.Lock ()
+
+def _lru_get (cache, key, build, max_memory):
+    ''' Look up key in the OrderedDict cache, or build, mark read-only and add the ndarray (or
+    tuple of ndarrays) build (), evicting the least-recently-used entries beyond max_memory MB '''
+    with _cache_lock:
+        val = cache.get (key, None)
+        if val is not None:
+            cache.move_to_end (key)
+            return val
+    val = build ()
+    arrs = val if isinstance (val, tuple) else (val,)
+    for arr in arrs: arr.flags.writeable = False
+    nbytes = sum ([arr.nbytes for arr in arrs])
+    max_bytes = max_memory * 1e6
+    if nbytes > max_bytes: return val
+    with _cache_lock:
+        cache[key] = val
+        nbytes = sum ([sum ([a.nbytes for a in (v if isinstance (v, tuple) else (v,))])
+                       for v in cache.values ()])
+        while nbytes > max_bytes:
+            v = cache.popitem (last=False)[1]
+            nbytes -= sum ([a.nbytes for a in (v if isinstance (v, tuple) else (v,))])
+    return val
+
+def get_csd_mask_cached (norb, neleca, nelecb):
+    ''' csdstring.make_csd_mask, looked up in the process-wide string-table cache. Read-only. '''
+    return _lru_get (_table_cache, ('csd_mask', norb, neleca, nelecb),
+                     lambda: csdstring.make_csd_mask (norb, neleca, nelecb),
+                     TABLE_CACHE_MAX_MEMORY)
+
+def get_econf_det_mask_cached (norb, neleca, nelecb, csd_mask=None):
+    ''' csdstring.make_econf_det_mask, looked up in the process-wide string-table cache.
+    Read-only. '''
+    def build ():
+        mask = csd_mask
+        if mask is None: mask = get_csd_mask_cached (norb, neleca, nelecb)
+        return csdstring.make_econf_det_mask (norb, neleca, nelecb, mask)
+    return _lru_get (_table_cache, ('econf_det_mask', norb, neleca, nelecb), build,
+                     TABLE_CACHE_MAX_MEMORY)
+
+def get_econf_csf_mask_cached (norb, neleca, nelecb, smult):
+    ''' make_econf_csf_mask, looked up in the process-wide string-table cache. Read-only. '''
+    return _lru_get (_table_cache, ('econf_csf_mask', norb, neleca, nelecb, smult),
+                     lambda: make_econf_csf_mask (norb, neleca, nelecb, smult),
+                     TABLE_CACHE_MAX_MEMORY)
+
+def get_confsym_cached (norb, neleca, nelecb, econf_det_mask, orbsym):
+    ''' make_confsym, looked up in the process-wide string-table cache by the content of orbsym.
+    Read-only. econf_det_mask must be that of (norb, neleca, nelecb). '''
+    orbsym = np.asarray (orbsym)
+    key = ('confsym', norb, neleca, nelecb, orbsym.dtype.str, orbsym.tobytes ())
+    return _lru_get (_table_cache, key,
+                     lambda: make_confsym (norb, neleca, nelecb, econf_det_mask, orbsym),
+                     TABLE_CACHE_MAX_MEMORY)
+
+def get_link_index_cached (norb, nelec):
+    ''' cistring.gen_linkstr_index_trilidx (range (norb), nelec), looked up in the process-wide
+    string-table cache. Read-only. '''
+    return _lru_get (_table_cache, ('linkstr_index_trilidx', norb, nelec),
+                     lambda: cistring.gen_linkstr_index_trilidx (range (norb), nelec),
+                     TABLE_CACHE_MAX_MEMORY)
+
+def clear_table_cache ():
+    ''' Empty the cache of the get_*_cached string tables and link indices '''
+    with _cache_lock:
+        _table_cache.clear ()
+
 class ImpossibleCIvecError (RuntimeError):
     def __init__(self, message, ndet=None, ncsf=None, norb=None, neleca=None, nelecb=None):
         self.message = message
@@ -34,6 +115,8 @@ class ImpossibleSpinError (ImpossibleCIvecError):
 class CSFTransformer (lib.StreamObject):
     def __init__(self, norb, neleca, nelecb, smult, orbsym=None, wfnsym=None):
         self._norb = self._neleca = self._nelecb = self._smult = self._orbsym = None
+        self._umats = None
+        self._csf_blocks = self._csf_blocks_wfnsym = None
         self.wfnsym = wfnsym
         self._update_spin_cache (norb, neleca, nelecb, smult)
         self.orbsym = orbsym
@@ -45,7 +128,7 @@ class CSFTransformer (lib.StreamObject):
         vec_on_cols = (order.upper () == 'F')
         civec, norm = transform_civec_det2csf (civec, self._norb, self._neleca, 
             self._nelecb, self._smult, csd_mask=self.csd_mask, do_normalize=normalize,
-            vec_on_cols=vec_on_cols)
+            vec_on_cols=vec_on_cols, umats=self.umats)
         civec = self.pack_csf (civec, order=order)
         if return_norm: return civec, norm
         return civec
@@ -54,7 +137,7 @@ class CSFTransformer (lib.StreamObject):
         vec_on_cols = (order.upper () == 'F')
         civec, norm = transform_civec_csf2det (self.unpack_csf (civec), self._norb, self._neleca, 
             self._nelecb, self._smult, csd_mask=self.csd_mask, do_normalize=normalize,
-            vec_on_cols=vec_on_cols)
+            vec_on_cols=vec_on_cols, umats=self.umats)
         if return_norm: return civec, norm
         return civec
 
@@ -66,7 +149,8 @@ class CSFTransformer (lib.StreamObject):
 
     def mat_det2csf_confspace (self, mat, confs):
         mat, csf_addr = transform_opmat_det2csf_pspace (mat, confs, self._norb, self._neleca,
-            self._nelecb, self._smult, self.csd_mask, self.econf_det_mask, self.econf_csf_mask) 
+            self._nelecb, self._smult, self.csd_mask, self.econf_det_mask, self.econf_csf_mask,
+            umats=self.umats)
         return mat, csf_addr
 
     def pack_csf (self, csfvec, order='C'):
@@ -102,17 +186,121 @@ class CSFTransformer (lib.StreamObject):
 
     def _update_spin_cache (self, norb, neleca, nelecb, smult):
         if any ([self._norb != norb, self._neleca != neleca, self._nelecb != nelecb, self._smult != smult]):
-            self.csd_mask = csdstring.make_csd_mask (norb, neleca, nelecb)
-            self.econf_det_mask = csdstring.make_econf_det_mask (norb, neleca, nelecb, self.csd_mask)
-            self.econf_csf_mask = make_econf_csf_mask (norb, neleca, nelecb, smult)
+            self.csd_mask = get_csd_mask_cached (norb, neleca, nelecb)
+            self.econf_det_mask = get_econf_det_mask_cached (norb, neleca, nelecb, self.csd_mask)
+            self.econf_csf_mask = get_econf_csf_mask_cached (norb, neleca, nelecb, smult)
+            self._umats = None
+            self._csf_blocks = None
             self._norb = norb
             self._neleca = neleca
             self._nelecb = nelecb
             self._smult = smult
 
+    @property
+    def umats (self):
+        '''Spin-coupling matrices of all sectors with at least one CSF, as a dict {nspin: umat};
+        see get_umats. Built at first use after each change of spin state'''
+        if self._umats is None:
+            self._umats = get_umats (self._norb, self._neleca, self._nelecb, self._smult)
+        return self._umats
+
+    def get_csf_blocks (self):
+        '''Blocks of the CSF vector (packed by point-group symmetry, if applicable) that share a
+        spin-coupling matrix, restricted to configurations of the target irrep
+
+        Returns
+        blocks: list of tuples (umat, det_addrs, p0, p1)
+            The CSFs p0:p1, reshaped to (nconf, ncsf), are obtained from the determinants
+            det_addrs, of shape (nconf, ndet), by contracting with umat of shape (ndet, ncsf)
+        '''
+        wfnsym = None if self._orbsym is None else self.wfnsym
+        if self._csf_blocks is not None and self._csf_blocks_wfnsym == wfnsym:
+            return self._csf_blocks
+        norb, neleca, nelecb, smult = self._norb, self._neleca, self._nelecb, self._smult
+        min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = \
+            csdstring.get_csdaddrs_shape (norb, neleca, nelecb)
+        npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)[-1]
+        blocks = []
+        p0 = iconf = 0
+        for ipair, ncsf in enumerate (npair_csf_size):
+            nconf = npair_dconf_size[ipair] * npair_sconf_size[ipair]
+            ndet = npair_sdet_size[ipair]
+            csd_offset = npair_csd_offset[ipair]
+            det_addrs = self.csd_mask[csd_offset:][:nconf*ndet].reshape (nconf, ndet)
+            if wfnsym is not None:
+                det_addrs = det_addrs[self.confsym[iconf:iconf+nconf] == wfnsym]
+            iconf += nconf
+            if ncsf == 0 or det_addrs.shape[0] == 0: continue
+            nspin = neleca + nelecb - 2*(min_npair + ipair)
+            p1 = p0 + det_addrs.shape[0] * ncsf
+            blocks.append ((self.umats[nspin], np.ascontiguousarray (det_addrs), p0, p1))
+            p0 = p1
+        self._csf_blocks, self._csf_blocks_wfnsym = blocks, wfnsym
+        return blocks
+
+    def vec_csf2det_blocked (self, civec, out=None):
+        '''Unnormalized vec_csf2det of one or several vectors, with one matrix-matrix product per
+        spin-coupling block for all vectors at once
+
+        Args:
+            civec: ndarray of shape (ncsf,) or (nvec, ncsf)
+
+        Kwargs:
+            out: ndarray of shape (ndeta, ndetb) or (nvec, ndeta, ndetb)
+                Buffer for the result, overwritten
+
+        Returns:
+            out: ndarray of shape (ndeta, ndetb) or (nvec, ndeta, ndetb)
+        '''
+        civec = np.asarray (civec)
+        is_flat = (civec.ndim == 1)
+        civec = civec.reshape (-1, civec.shape[-1])
+        nvec = civec.shape[0]
+        if out is None:
+            out = np.empty ((nvec, self.ndeta, self.ndetb), dtype=np.float64)
+            if is_flat: out = out[0]
+        out_flat = out.reshape (nvec, -1)
+        out_flat[:] = 0
+        for umat, det_addrs, p0, p1 in self.get_csf_blocks ():
+            nconf, ndet = det_addrs.shape
+            x = civec[:,p0:p1].reshape (nvec*nconf, umat.shape[1])
+            x = np.dot (x, umat.T).reshape (nvec, nconf*ndet)
+            # Row-by-row scattering is much faster than fancy-indexing a 2d lvalue
+            for i in range (nvec): out_flat[i,det_addrs.ravel ()] = x[i]
+        return out
+
+    def vec_det2csf_blocked (self, civec, out=None):
+        '''Unnormalized vec_det2csf of one or several vectors, with one matrix-matrix product per
+        spin-coupling block for all vectors at once
+
+        Args:
+            civec: ndarray of shape (ndeta, ndetb) or (nvec, ndeta, ndetb)
+
+        Kwargs:
+            out: ndarray of shape (ncsf,) or (nvec, ncsf)
+                Buffer for the result, overwritten
+
+        Returns:
+            out: ndarray of shape (ncsf,) or (nvec, ncsf)
+        '''
+        civec = np.asarray (civec)
+        is_flat = (civec.size == self.ndet) and (civec.ndim < 3)
+        civec = civec.reshape (-1, self.ndet)
+        nvec = civec.shape[0]
+        if out is None:
+            out = np.empty ((nvec, self.ncsf), dtype=np.float64)
+            if is_flat: out = out[0]
+        out_2d = out.reshape (nvec, -1)
+        for umat, det_addrs, p0, p1 in self.get_csf_blocks ():
+            nconf, ndet = det_addrs.shape
+            x = np.take (civec, det_addrs.ravel (), axis=1).reshape (nvec*nconf, ndet)
+            out_2d[:,p0:p1] = np.dot (x, umat).reshape (nvec, -1)
+        return out
+
     def _update_symm_cache (self, orbsym):
         if (orbsym is not None) and (self._orbsym is None or np.any (orbsym != self._orbsym)):
-            self.confsym = make_confsym (self.norb, self.neleca, self.nelecb, self.econf_det_mask, orbsym)
+            self.confsym = get_confsym_cached (self.norb, self.neleca, self.nelecb, self.econf_det_mask, orbsym)
+            self._csf_blocks = None
         self._orbsym = orbsym
 
     def printable_largest_csf (self, csfvec, npr, order='C', isdet=False, normalize=True):
@@ -334,7 +522,8 @@ def project_civec_csf (detarr, norb, neleca, nelecb, smult, csd_mask=None):
     '''
     return detarr / detnorm, detnorm
 
-def transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None, vec_on_cols=False, do_normalize=True):
+def transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None, vec_on_cols=False, do_normalize=True,
+                             umats=None):
     ''' Express CI vector in terms of CSFs for spin s
 
     Args
@@ -350,6 +539,8 @@ def transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None,
         (i.e., an eigenvector matrix) (requires 2d ndarray for detarr)
     do_normalize: bool
         If false, do NOT normalize the vector (i.e., if it is a matrix-vector product
+    umats: dict
+        Output of get_umats; otherwise, get_spin_evecs_cached is used
 
     Returns
     csfarr: same data type as detarr
@@ -381,7 +572,8 @@ def transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None,
      
 
     # Driver needs an ndarray of explicit shape (*, ndet)        
-    csfarr = _transform_detcsf_vec_or_mat (detarr, norb, neleca, nelecb, smult, reverse=False, op_matrix=False, csd_mask=csd_mask, project=False)
+    csfarr = _transform_detcsf_vec_or_mat (detarr, norb, neleca, nelecb, smult, reverse=False, op_matrix=False, csd_mask=csd_mask, project=False,
+                                           umats=umats)
     if csfarr.size == 0:
         assert (False)
         return np.zeros (0, dtype=detarr.dtype), 0.0
@@ -407,7 +599,8 @@ def transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None,
         csfnorm = 0.0
     return csfarr, csfnorm
 
-def transform_civec_csf2det (csfarr, norb, neleca, nelecb, smult, csd_mask=None, vec_on_cols=False, do_normalize=True):
+def transform_civec_csf2det (csfarr, norb, neleca, nelecb, smult, csd_mask=None, vec_on_cols=False, do_normalize=True,
+                             umats=None):
     ''' Transform CI vector in terms of CSFs back into determinants
 
     Args
@@ -422,7 +615,8 @@ def transform_civec_csf2det (csfarr, norb, neleca, nelecb, smult, csd_mask=None,
         (i.e., an eigenvector matrix) (requires 2d ndarray for detarr)
     do_normalize: bool
         If false, do NOT normalize the vector (i.e., if it is a matrix-vector product
-        
+    umats: dict
+        Output of get_umats; otherwise, get_spin_evecs_cached is used
 
     Returns
     detarr: same data type as csfarr. Last dimension is of length ndeta*ndetb
@@ -455,7 +649,8 @@ def transform_civec_csf2det (csfarr, norb, neleca, nelecb, smult, csd_mask=None,
     else:
         csfarr = np.ascontiguousarray (csfarr.reshape (nvec, ncsf))
 
-    detarr = _transform_detcsf_vec_or_mat (csfarr, norb, neleca, nelecb, smult, reverse=True, op_matrix=False, csd_mask=csd_mask, project=False)
+    detarr = _transform_detcsf_vec_or_mat (csfarr, norb, neleca, nelecb, smult, reverse=True, op_matrix=False, csd_mask=csd_mask, project=False,
+                                           umats=umats)
 
     # Manipulate detarr back into the original shape
     detnorm = linalg.norm (detarr, axis=1)
@@ -498,7 +693,8 @@ def transform_opmat_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=None)
     csfarr = _transform_detcsf_vec_or_mat (detarr, norb, neleca, nelecb, smult, reverse=False, op_matrix=True, csd_mask=csd_mask, project=False)
     return csfarr
 
-def _transform_detcsf_vec_or_mat (arr, norb, neleca, nelecb, smult, reverse=False, op_matrix=False, csd_mask=None, project=False):
+def _transform_detcsf_vec_or_mat (arr, norb, neleca, nelecb, smult, reverse=False, op_matrix=False, csd_mask=None, project=False,
+                                  umats=None):
     ''' Wrapper to manipulate array into correct shape and transform both dimensions if an operator matrix 
 
     Args
@@ -517,6 +713,8 @@ def _transform_detcsf_vec_or_mat (arr, norb, neleca, nelecb, smult, reverse=Fals
         index array for reordering determinant pairs in csd format
     project: bool
         if true, arr is projected, rather than transformed
+    umats: dict
+        Output of get_umats; otherwise, get_spin_evecs_cached is used
 
     Returns
     arr: ndarray of shape (nrow, ncol)
@@ -533,10 +731,12 @@ def _transform_detcsf_vec_or_mat (arr, norb, neleca, nelecb, smult, reverse=Fals
         assert (nrow == ncol), "operator matrix must be square"
     assert (arr.shape == tuple((nrow, ncol))), "array shape should be {0}; is {1}".format ((nrow, ncol), arr.shape)
 
-    arr = _transform_det2csf (arr, norb, neleca, nelecb, smult, reverse=reverse, csd_mask=csd_mask, project=project)
+    arr = _transform_det2csf (arr, norb, neleca, nelecb, smult, reverse=reverse, csd_mask=csd_mask, project=project,
+                              umats=umats)
     if op_matrix:
         arr = arr.T
-        arr = _transform_det2csf (arr, norb, neleca, nelecb, smult, reverse=reverse, csd_mask=csd_mask, project=project)
+        arr = _transform_det2csf (arr, norb, neleca, nelecb, smult, reverse=reverse, csd_mask=csd_mask, project=project,
+                                  umats=umats)
         arr = numpy_helper.transpose (arr, inplace=True)
 
     if arr.size == 0:
@@ -552,7 +752,8 @@ def _transform_detcsf_vec_or_mat (arr, norb, neleca, nelecb, smult, reverse=Fals
     return arr
 
     
-def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_mask=None, project=False):
+def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_mask=None, project=False,
+                        umats=None):
     ''' Must take an array of shape (*, ndet) or (*, ncsf) '''
     t_start = lib.logger.perf_counter ()
     time_umat = 0
@@ -607,7 +808,7 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
             continue
 
         t_ref = lib.logger.perf_counter ()
-        umat = np.asarray_chkfinite (get_spin_evecs (nspin, neleca, nelecb, smult))
+        umat = _get_umat (umats, nspin, neleca, nelecb, smult)
         size_umat = max (size_umat, umat.nbytes)
         ncsf_blk = ncsf # later on I can use this variable to implement a generator form of get_spin_evecs to save memory when there are too many csfs
         assert (umat.shape[0] == ndet)
@@ -646,7 +847,8 @@ def _transform_det2csf (inparr, norb, neleca, nelecb, smult, reverse=False, csd_
     '''
     return outarr
 
-def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd_mask, econf_det_mask, econf_csf_mask):
+def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd_mask, econf_det_mask, econf_csf_mask,
+                                    umats=None):
     ''' Transform an operator matrix from the determinant basis to the csf basis, in a subspace of determinants spanning
         the electron configurations addressed by econfs
 
@@ -677,58 +879,55 @@ def transform_opmat_det2csf_pspace (op, econfs, norb, neleca, nelecb, smult, csd
             CI vector element addresses in CSF basis
     '''
 
-    nconf_all = econfs.size 
-    # I basically need to invert econf_det_mask and econf_csf_mask. I can't use argsort for this because their elements aren't unique
-    # csf_addrs needs to be sorted because I don't want to make a second reduced_csd_mask index for the csf-basis version (see below);
-    # just return the damn thing in the canonical order!
-    det_addrs = np.concatenate ([np.nonzero (econf_det_mask == conf)[0] for conf in econfs])
-    csf_addrs = np.sort (np.concatenate ([np.nonzero (econf_csf_mask == conf)[0] for conf in econfs]))
+    # econfs could have been provided in any order and defines the indexing of "op". Sort it and permute the rows and
+    # columns of op to match, so that the canonical (npair, doubly-occupied string, singly-occupied string, spin
+    # configuration) order defined in csdstring.py, restricted to econfs, is the order of op
+    econfs = np.asarray (econfs, dtype=np.int64)
+    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = csdstring.get_csdaddrs_shape (norb, neleca, nelecb)
+    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    npair_econf_size = np.asarray (npair_dconf_size, dtype=np.int64) * npair_sconf_size
+    npair_econf_offset = np.cumsum (npair_econf_size) - npair_econf_size
+    if np.any (econfs[1:] < econfs[:-1]):
+        econf_ndet = np.asarray (npair_sdet_size, dtype=np.int64)[np.searchsorted (npair_econf_offset, econfs,
+                                                                                   side='right') - 1]
+        econf_offset = np.cumsum (econf_ndet) - econf_ndet
+        idx = np.argsort (econfs, kind='stable')
+        econfs, econf_ndet, econf_offset = econfs[idx], econf_ndet[idx], econf_offset[idx]
+        perm = np.repeat (econf_offset - (np.cumsum (econf_ndet) - econf_ndet), econf_ndet)
+        perm += np.arange (econf_ndet.sum (), dtype=np.int64)
+        op = op[np.ix_(perm, perm)]
+    assert (np.all (econfs[1:] > econfs[:-1])), "econfs must be unique"
+    det_addrs, csf_addrs = get_econf_addrs (norb, neleca, nelecb, smult, econfs, csd_mask)
     ndet_all = det_addrs.size
     ncsf_all = csf_addrs.size
-    # econfs could have been provided in any order and defines the indexing of "op" (via det_addrs as generated above).
-    #   I need to generate a mask array to address the elements of "op"
-    #   in the "canonical" ordering (ipair, doubly-occupied string, singly-occupied string, and spin configuration)
-    #   that I developed in csd string but spanning only those configurations that are included in econfs.
-    #   The next line should accomplish this. np.argsort (mask) inverts a given mask index array (assuming its elements are unique).
-    #   So for instance, np.argsort (csd_mask)[det_addrs] gives you csd addresses.
-    #   Then np.argsort (np.argsort (csd_mask)[det_addrs])[csd_addrs] inverts it twice, and gives you determinant addresses,
-    #   but if det_addrs doesn't span the whole space, then csd_addrs can't either. In other words, the csd indices are compressed
-    #   and correspond to the elements of op.
-    reduced_csd_mask = np.argsort (np.argsort (csd_mask)[det_addrs])
     assert (op.shape == (ndet_all, ndet_all)), "operator matrix shape problem ({} for det_addrs of size {})".format (op.shape, det_addrs.size)
-    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = csdstring.get_csdaddrs_shape (norb, neleca, nelecb)
-    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
-    npair_econf_size = npair_dconf_size * npair_sconf_size
+    npair_nconf = np.bincount (np.searchsorted (npair_econf_offset, econfs, side='right') - 1,
+                               minlength=npair_econf_size.size)
     max_npair = min (neleca, nelecb)
-    assert (np.count_nonzero (reduced_csd_mask[1:] - reduced_csd_mask[:-1] - 1)==0)
     def ax_b (mat):
         nrow = mat.shape[0]
         assert (mat.shape[1] == ndet_all)
         outmat = np.zeros ((nrow, ncsf_all), dtype=mat.dtype)
         det_offset = 0
         csf_offset = 0
-        full_conf_offset = 0
-        full_det_offset = 0
         for npair in range (min_npair, max_npair+1):
             ipair = npair - min_npair
-            nconf_full = npair_econf_size[ipair]
-            nconf = np.count_nonzero (np.isin (range (full_conf_offset, full_conf_offset+nconf_full), econfs))
-            full_conf_offset += nconf_full
+            nconf = npair_nconf[ipair]
             ncsf = npair_csf_size[ipair]
             ndet = npair_sdet_size[ipair]
-            full_det_offset += nconf_full * ndet
             if nconf == 0 or ncsf == 0 or ndet == 0:
+                det_offset += nconf*ndet
                 continue
 
             ci = csf_offset
             cj = ci + nconf*ncsf
 
-            di = reduced_csd_mask[det_offset]
+            di = det_offset
             dj = di + nconf*ndet
             mat_ij = mat[:,di:dj].reshape (nrow, nconf, ndet)
 
             nspin = neleca + nelecb - 2*npair
-            umat = np.asarray_chkfinite (get_spin_evecs (nspin, neleca, nelecb, smult))
+            umat = _get_umat (umats, nspin, neleca, nelecb, smult)
 
             outmat[:,ci:cj] = np.tensordot (mat_ij, umat, axes=1).reshape (nrow, ncsf*nconf, order='C')
 
@@ -900,6 +1099,108 @@ def get_spin_evecs (nspin, neleca, nelecb, smult):
 
     return umat
 
+def get_spin_exchange_diag (nspin, neleca, nelecb, smult, umat=None):
+    ''' Diagonal elements, in the CSF basis, of the spin-exchange operators of all pairs of
+    singly-occupied orbitals. Within one electron configuration, the Hamiltonian matrix between two
+    determinants which differ by exchanging the spins of the ith and jth singly-occupied orbitals
+    (i < j) is (-1)**(i+j+1) * (pq|qp), where p and q are the corresponding orbitals, so that
+
+    hdiag_csf[conf,:] = np.dot (hdiag_det[conf,:], umat**2) + np.dot (K[conf,:], D)
+
+    where K[conf,ij] = (pq|qp).
+
+    Args:
+        nspin, neleca, nelecb, smult: integers
+
+    Kwargs:
+        umat: ndarray of shape (ndet, ncsf)
+            Output of get_spin_evecs
+
+    Returns:
+        D: ndarray of shape (nspin*(nspin-1)//2, ncsf)
+            Row ij is for the pair (i,j) in the order of np.triu_indices (nspin, k=1)
+    '''
+    if umat is None: umat = get_spin_evecs_cached (nspin, neleca, nelecb, smult)
+    na = (nspin + neleca - nelecb) // 2
+    ndet, ncsf = umat.shape
+    spinstrs = cistring.addrs2str (nspin, na, list (range (ndet)))
+    idx, jdx = np.triu_indices (nspin, k=1)
+    D = np.zeros ((idx.size, ncsf), dtype=umat.dtype)
+    for ij, (i, j) in enumerate (zip (idx, jdx)):
+        flip = (1 << int (i)) | (1 << int (j))
+        x = np.where (((spinstrs >> i) & 1) != ((spinstrs >> j) & 1))[0]
+        if x.size == 0: continue
+        y = cistring.strs2addr (nspin, na, spinstrs[x] ^ flip)
+        D[ij] = (umat[x] * umat[y]).sum (0) * (-1)**(i+j+1)
+    return D
+
+def get_econf_addrs (norb, neleca, nelecb, smult, econfs, csd_mask):
+    ''' Determinant and CSF addresses spanning the electron configurations econfs, computed from
+    the offsets of the configurations rather than by searching econf_det_mask and
+    econf_csf_mask
+
+    Args:
+        norb, neleca, nelecb, smult: integers
+        econfs: ndarray of ints
+            addresses for electron configurations in the canonical order defined by csdstring.py
+        csd_mask: ndarray of ints
+            csd_mask[idx_csd] = idx_dd
+
+    Returns:
+        det_addrs: ndarray of ints
+            Determinant addresses, grouped by configuration in the order of econfs
+        csf_addrs: ndarray of ints
+            CSF addresses, grouped by configuration in the order of econfs
+    '''
+    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = \
+        csdstring.get_csdaddrs_shape (norb, neleca, nelecb)
+    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    npair_conf_size = np.asarray (npair_dconf_size, dtype=np.int64) * npair_sconf_size
+    npair_conf_offset = np.cumsum (npair_conf_size) - npair_conf_size
+    econfs = np.asarray (econfs, dtype=np.int64)
+    ipair = np.searchsorted (npair_conf_offset, econfs, side='right') - 1
+    iconf = econfs - npair_conf_offset[ipair]
+    ndet = np.asarray (npair_sdet_size, dtype=np.int64)[ipair]
+    ncsf = np.asarray (npair_csf_size, dtype=np.int64)[ipair]
+    def _ranges (starts, sizes):
+        offs = np.cumsum (sizes) - sizes
+        return np.repeat (starts - offs, sizes) + np.arange (sizes.sum (), dtype=np.int64)
+    det_addrs = csd_mask[_ranges (npair_csd_offset[ipair] + iconf*ndet, ndet)]
+    csf_addrs = _ranges (npair_csf_offset[ipair] + iconf*ncsf, ncsf)
+    return det_addrs, csf_addrs
+
+def get_spin_evecs_cached (nspin, neleca, nelecb, smult):
+    ''' Same as get_spin_evecs, but looked up in and added to a process-wide least-recently-used
+    cache holding at most UMAT_CACHE_MAX_MEMORY MB. The returned array is read-only. '''
+    return _lru_get (_umat_cache, (nspin, neleca, nelecb, smult),
+                     lambda: np.asarray_chkfinite (get_spin_evecs (nspin, neleca, nelecb, smult)),
+                     UMAT_CACHE_MAX_MEMORY)
+
+def clear_umat_cache ():
+    ''' Empty the cache of get_spin_evecs_cached '''
+    with _cache_lock:
+        _umat_cache.clear ()
+
+def get_umats (norb, neleca, nelecb, smult):
+    ''' Spin-coupling matrices of all sectors of a CI vector with at least one CSF
+
+    Returns
+    umats: dict
+        umats[nspin] is get_spin_evecs (nspin, neleca, nelecb, smult) for every number nspin of
+        singly-occupied orbitals with at least one CSF
+    '''
+    min_npair, _, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    umats = {}
+    for ipair, ncsf in enumerate (npair_csf_size):
+        if ncsf == 0: continue
+        nspin = neleca + nelecb - 2*(min_npair + ipair)
+        umats[nspin] = get_spin_evecs_cached (nspin, neleca, nelecb, smult)
+    return umats
+
+def _get_umat (umats, nspin, neleca, nelecb, smult):
+    if umats is not None and nspin in umats: return umats[nspin]
+    return get_spin_evecs_cached (nspin, neleca, nelecb, smult)
+
 def test_spin_evecs (nspin, neleca, nelecb, smult, S2mat=None):
     s = (smult - 1) / 2
     ms = (neleca - nelecb) / 2
@@ -1,5 +1,6 @@
 import numpy as np
 import time
+import h5py
 from scipy import linalg
 from mrh.my_pyscf.lassi import op_o0
 from mrh.my_pyscf.lassi import op_o1
@@ -24,6 +25,11 @@ from pyscf import __config__
 # temporary environment.
 
 LINDEP_THRESH = getattr (__config__, 'lassi_lindep_thresh', 1.0e-5)
+DAVIDSON_DENSE_NSTATES = getattr (__config__, 'lassi_davidson_dense_nstates', 16)
+DAVIDSON_CONV_TOL = getattr (__config__, 'lassi_davidson_conv_tol', 1e-10)
+DAVIDSON_MAX_CYCLE = getattr (__config__, 'lassi_davidson_max_cycle', 100)
+DAVIDSON_LEVEL_SHIFT = getattr (__config__, 'lassi_davidson_level_shift', 1e-3)
+RDM_H5_COMPRESSION = getattr (__config__, 'lassi_rdm_h5_compression', 'gzip')
 
 op = (op_o0, op_o1)
 
@@ -235,8 +241,18 @@ class LASSIOop01DisagreementError (RuntimeError):
         return self.message
 
 def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, soc=False,
-           break_symmetry=False, opt=1):
-    ''' Diagonalize the state-interaction matrix of LASSCF '''
+           break_symmetry=False, opt=1, davidson=False, nroots_si=1, nproc=1):
+    ''' Diagonalize the state-interaction matrix of LASSCF
+
+    If nproc > 1, the symmetry blocks are built and diagonalized concurrently in a pool of nproc
+    forked worker processes, largest blocks first. Each worker process uses only one OpenMP thread,
+    so nproc should be comparable to the number of available cores.
+
+    If davidson is True, only the lowest nroots_si eigenstates of each symmetry block are
+    obtained, by a generalized Davidson algorithm using only matrix-vector products, without
+    ever building the Hamiltonian or overlap matrices. In that case, s2_mat is not available
+    and is tagged as None on the returned si array.
+    '''
     if mo_coeff is None: mo_coeff = las.mo_coeff
     if ci is None: ci = las.ci
     if orbsym is None: 
@@ -248,6 +264,8 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
     o0_memcheck = op_o0.memcheck (las, ci, soc=soc)
     if opt == 0 and o0_memcheck == False:
         raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
+    if davidson and opt == 0:
+        raise RuntimeError ('Davidson LASSI algorithm requires opt >= 1')
 
     # Construct second-quantization Hamiltonian
     if callable (getattr (las, 'ham_2q', None)):
@@ -265,11 +283,11 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
     si = []
     s2_mat = []
     idx_allprods = []
-    dtype = complex if soc else np.float64
 
-    # Loop over symmetry blocks
+    # Collect symmetry blocks
     qn_lbls = ['nelec',] if soc else ['neleca','nelecb',]
     if not break_symmetry: qn_lbls.append ('irrep')
+    blocks = []
     for it, (las1,sym,indices,indexed) in enumerate (iterate_subspace_blocks(las,ci,statesym)):
         idx_space, idx_prod = indices
         ci_blk, nelec_blk = indexed
@@ -279,20 +297,19 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
                          + '(%d rootspaces; %d states)', it,
                          np.count_nonzero (idx_space), 
                          np.count_nonzero (idx_prod))
-        if np.count_nonzero (idx_prod) == 1:
-            lib.logger.debug (las, 'Only one state in this symmetry block')
-            e_roots.extend (las1.e_states - e0)
-            si.append (np.ones ((1,1), dtype=dtype))
-            s2_mat.append (s2_states[idx_space]*np.ones((1,1)))
-            s2_roots.extend (s2_states[idx_space])
-            rootsym.extend ([sym,])
-            continue
-        wfnsym = None if break_symmetry else sym[-1]
-        e, c, s2_blk = _eig_block (las1, e0, h1, h2, ci_blk, nelec_blk, sym, soc,
-                                   orbsym, wfnsym, o0_memcheck, opt)
-        s2_mat.append (s2_blk)
+        blocks.append ((sym, idx_space, idx_prod, ci_blk, nelec_blk))
+
+    # Diagonalize symmetry blocks
+    blk_args = (s2_states, soc, orbsym, break_symmetry, o0_memcheck, opt, davidson, nroots_si)
+    nblk_multi = sum ([np.count_nonzero (blk[2]) > 1 for blk in blocks])
+    if nproc > 1 and nblk_multi > 1:
+        results = _eig_blocks_parallel (las, e0, h1, h2, blocks, blk_args, nproc)
+    else:
+        results = [_eig_block_env (las, e0, h1, h2, *blk, *blk_args) for blk in blocks]
+    for (sym, idx_space, idx_prod, ci_blk, nelec_blk), res in zip (blocks, results):
+        e, c, s2_mat_blk, s2_blk = res
         si.append (c)
-        s2_blk = c.conj ().T @ s2_blk @ c
+        if s2_mat_blk is not None: s2_mat.append (s2_mat_blk)
         lib.logger.debug2 (las, 'Block S**2 in adiabat basis:')
         lib.logger.debug2 (las, '{}'.format (s2_blk))
         e_roots.extend (list(e))
@@ -303,7 +320,10 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
     # Therefore, I need to ~invert~ idx_allprods to get the proper order
     idx_allprods = np.argsort (idx_allprods)
     si = linalg.block_diag (*si)[idx_allprods,:]
-    s2_mat = linalg.block_diag (*s2_mat)[np.ix_(idx_allprods,idx_allprods)]
+    if davidson:
+        s2_mat = None
+    else:
+        s2_mat = linalg.block_diag (*s2_mat)[np.ix_(idx_allprods,idx_allprods)]
 
     # Sort results by energy
     idx = np.argsort (e_roots)
@@ -350,6 +370,100 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
             break
     return e_roots, si
 
+def _eig_block_env (las, e0, h1, h2, sym, idx_space, idx_prod, ci_blk, nelec_blk, s2_states, soc,
+                    orbsym, break_symmetry, o0_memcheck, opt, davidson, nroots_si):
+    ''' Diagonalize one symmetry block within the corresponding subspace environment of las
+
+    Returns:
+        e : ndarray of shape (nroots_blk,)
+            Eigenvalues minus e0
+        c : ndarray of shape (nstates_blk,nroots_blk)
+            Eigenvectors
+        s2_mat_blk : ndarray of shape (nstates_blk,nstates_blk) or None
+            Spin-squared operator matrix in the LAS product-state basis; None if the Davidson
+            algorithm was used
+        s2_blk : ndarray of shape (nroots_blk,nroots_blk)
+            Spin-squared operator matrix in the eigenvector basis
+    '''
+    nstates = np.count_nonzero (idx_prod)
+    if nstates == 1:
+        lib.logger.debug (las, 'Only one state in this symmetry block')
+        dtype = complex if soc else np.float64
+        s2_blk = s2_states[idx_space]*np.ones((1,1))
+        return las.e_states[idx_space] - e0, np.ones ((1,1), dtype=dtype), s2_blk, s2_blk
+    wfnsym = None if break_symmetry else sym[-1]
+    with _LASSI_subspace_env (las, idx_space):
+        if davidson and nstates > max (DAVIDSON_DENSE_NSTATES, 2*nroots_si):
+            e, c, s2_blk = _eig_block_Davidson (las, e0, h1, h2, ci_blk, nelec_blk, sym, soc,
+                                                nroots_si)
+            s2_mat_blk = None
+        else:
+            e, c, s2_mat_blk = _eig_block (las, e0, h1, h2, ci_blk, nelec_blk, sym, soc,
+                                           orbsym, wfnsym, o0_memcheck, opt)
+            if davidson: e, c = e[:nroots_si], c[:,:nroots_si]
+            s2_blk = c.conj ().T @ s2_mat_blk @ c
+    return e, c, s2_mat_blk, s2_blk
+
+# Work list of _eig_blocks_parallel. Worker processes are forked after this is set, so that they
+# share h1, h2, and the CI vectors with the parent process (copy-on-write) instead of receiving
+# pickled copies of them.
+_eig_blocks_shared = None
+
+def _eig_block_worker (iblk):
+    las, e0, h1, h2, blocks, blk_args = _eig_blocks_shared
+    # GNU OpenMP cannot rebuild its thread pool in a child forked from a parent which has already
+    # used it, and any parallel region with more than one thread deadlocks there
+    with lib.with_omp_threads (1):
+        return _eig_block_env (las, e0, h1, h2, *blocks[iblk], *blk_args)
+
+def _eig_blocks_parallel (las, e0, h1, h2, blocks, blk_args, nproc):
+    ''' Diagonalize symmetry blocks in a pool of nproc forked single-threaded worker processes,
+    largest blocks first, and return the results in the original order of the blocks '''
+    global _eig_blocks_shared
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor
+    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    nstates = [np.count_nonzero (blk[2]) for blk in blocks]
+    jobs = [iblk for iblk in np.argsort (nstates, kind='stable')[::-1] if nstates[iblk] > 1]
+    nproc = min (nproc, len (jobs))
+    lib.logger.info (las, 'Diagonalizing %d LASSI symmetry blocks in %d processes',
+                     len (jobs), nproc)
+    results = [None for blk in blocks]
+    _eig_blocks_shared = (las, e0, h1, h2, blocks, blk_args)
+    try:
+        with ProcessPoolExecutor (max_workers=nproc,
+                                  mp_context=multiprocessing.get_context ('fork')) as executor:
+            futures = {iblk: executor.submit (_eig_block_worker, iblk) for iblk in jobs}
+            for iblk, future in futures.items ():
+                results[iblk] = future.result ()
+    finally:
+        _eig_blocks_shared = None
+    for iblk, blk in enumerate (blocks):
+        if results[iblk] is None:
+            results[iblk] = _eig_block_env (las, e0, h1, h2, *blk, *blk_args)
+    lib.logger.timer (las, 'LASSI parallel symmetry-block diagonalization', *t0)
+    return results
+
+def _check_hdiag (las, e0, hdiag, ci_blk, soc):
+    '''Error catch: diagonal Hamiltonian elements of the model space should reproduce the LAS
+    state energies'''
+    # This diagnostic is simply not valid for local excitations;
+    # the energies aren't supposed to be additive
+    lroots = get_lroots (ci_blk)
+    e_states_meaningful = not getattr (las, 'e_states_meaningless', False)
+    e_states_meaningful &= np.all (lroots==1)
+    e_states_meaningful &= not (soc) # TODO: fix?
+    if not e_states_meaningful: return
+    diag_ref = las.e_states - e0
+    maxerr = np.max (np.abs (hdiag-diag_ref))
+    if maxerr>1e-5:
+        lib.logger.debug (las, '{:>13s} {:>13s} {:>13s}'.format ('Diagonal', 'Reference',
+                                                                 'Error'))
+        for ix, (test, ref) in enumerate (zip (hdiag, diag_ref)):
+            lib.logger.debug (las, '{:13.6e} {:13.6e} {:13.6e}'.format (test, ref, test-ref))
+        lib.logger.warn (las, 'LAS states in basis may not be converged (%s = %e)',
+                         'max(|Hdiag-e_states|)', maxerr)
+
 def _eig_block (las, e0, h1, h2, ci_blk, nelec_blk, rootsym, soc, orbsym, wfnsym, o0_memcheck, opt):
     # TODO: simplify
     t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
@@ -403,24 +517,7 @@ def _eig_block (las, e0, h1, h2, ci_blk, nelec_blk, rootsym, soc, orbsym, wfnsym
     log_debug (las, '{}'.format (s2_blk.round (8)))
     log_debug (las, 'Block overlap matrix:')
     log_debug (las, '{}'.format (ovlp_blk.round (8)))
-    # Error catch: diagonal Hamiltonian elements
-    # This diagnostic is simply not valid for local excitations;
-    # the energies aren't supposed to be additive
-    lroots = get_lroots (ci_blk)
-    e_states_meaningful = not getattr (las, 'e_states_meaningless', False)
-    e_states_meaningful &= np.all (lroots==1)
-    e_states_meaningful &= not (soc) # TODO: fix?
-    if e_states_meaningful:
-        diag_test = np.diag (ham_blk)
-        diag_ref = las.e_states - e0
-        maxerr = np.max (np.abs (diag_test-diag_ref))
-        if maxerr>1e-5:
-            lib.logger.debug (las, '{:>13s} {:>13s} {:>13s}'.format ('Diagonal', 'Reference',
-                                                                     'Error'))
-            for ix, (test, ref) in enumerate (zip (diag_test, diag_ref)):
-                lib.logger.debug (las, '{:13.6e} {:13.6e} {:13.6e}'.format (test, ref, test-ref))
-            lib.logger.warn (las, 'LAS states in basis may not be converged (%s = %e)',
-                             'max(|Hdiag-e_states|)', maxerr)
+    _check_hdiag (las, e0, np.diag (ham_blk), ci_blk, soc)
     # Error catch: linear dependencies in basis
     try:
         e, c = linalg.eigh (ham_blk, b=ovlp_blk)
@@ -438,6 +535,41 @@ def _eig_block (las, e0, h1, h2, ci_blk, nelec_blk, rootsym, soc, orbsym, wfnsym
         else: raise (err) from None
     return e, c, s2_blk
 
+def _eig_block_Davidson (las, e0, h1, h2, ci_blk, nelec_blk, rootsym, soc, nroots_si,
+                         conv_tol=DAVIDSON_CONV_TOL, max_cycle=DAVIDSON_MAX_CYCLE,
+                         level_shift=DAVIDSON_LEVEL_SHIFT):
+    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    log = lib.logger.new_logger (las, las.verbose)
+    ham_op, s2_op, ovlp_op, hdiag, odiag = op_o1.gen_contract_op_si_hdiag (
+        las, h1, h2, ci_blk, nelec_blk, soc=soc)
+    t0 = log.timer ('LASSI H operator build rootsym {}'.format (rootsym), *t0)
+    _check_hdiag (las, e0, hdiag, ci_blk, soc)
+    nstates = len (hdiag)
+    x0 = []
+    for i in np.argsort (hdiag / odiag)[:nroots_si]:
+        x = np.zeros (nstates, dtype=hdiag.dtype)
+        x[i] = 1.0
+        x0.append (x)
+    def abop (xs):
+        xs = np.stack (xs, axis=-1)
+        return list (ham_op (xs).T), list (ovlp_op (xs).T)
+    precond = lib.make_diag_precond (hdiag / odiag, level_shift=level_shift)
+    conv, e, c = lib.linalg_helper.dgeev1 (abop, x0, precond, tol=conv_tol, max_cycle=max_cycle,
+                                           max_space=max (12, 4*nroots_si), nroots=nroots_si,
+                                           max_memory=las.max_memory, verbose=log)
+    if nroots_si == 1: e, c = [e,], [c,]
+    e = np.asarray (e)
+    c = np.stack (c, axis=-1)
+    conv = np.atleast_1d (conv)
+    if not np.all (conv):
+        log.warn ('LASSI Davidson diagonalizer rootsym %s not converged: %s', str (rootsym),
+                  str (conv))
+    # Normalize in the metric of the LAS product states
+    c /= np.sqrt ((c.conj () * ovlp_op (c)).sum (0))[None,:]
+    s2_blk = c.conj ().T @ s2_op (c)
+    t0 = log.timer ('LASSI Davidson diagonalizer rootsym {}'.format (rootsym), *t0)
+    return e, c, s2_blk
+
 def make_stdm12s (las, ci=None, orbsym=None, soc=False, break_symmetry=False, opt=1):
     ''' Evaluate <I|p'q|J> and <I|p'r'sq|J> where |I>, |J> are LAS states.
 
@@ -708,12 +840,194 @@ def root_make_rdm12s (las, ci, si, state=0, orbsym=None, soc=None, break_symmetr
         rdm1s, rdm2s = rdm1s[0], rdm2s[0]
     return rdm1s, rdm2s
 
+def iter_roots_make_rdm12s (las, ci, si, state=None, batch_size=None, orbsym=None, soc=None,
+                            break_symmetry=None, rootsym=None, opt=1):
+    '''Generate 1- and 2-electron reduced density matrices of LASSI states one at a time. The
+    density matrices are computed in batches of states, so that at most one batch is held in
+    memory at once.
+
+        Args:
+            las: LASCI object
+            ci: list of list of ci vectors
+            si: tagged ndarray of shape (nroots,nroots)
+               Linear combination vectors defining LASSI states.
+
+        Kwargs:
+            state: integer or sequence of integers
+                Identify the specific LASSI eigenstate(s) for which the density matrices are
+                to be computed. Defaults to all columns of si.
+            batch_size: integer
+                Maximum number of states whose density matrices are computed at once. Defaults
+                to as many as fit in las.max_memory.
+            orbsym, soc, break_symmetry, rootsym, opt:
+                See roots_make_rdm12s
+
+        Yields:
+            state: integer
+                Index of the LASSI state. States are grouped by symmetry, so they are not
+                necessarily generated in the order requested.
+            rdm1s: ndarray of shape (2,ncas,ncas) if soc==False;
+                or of shape (2*ncas,2*ncas) if soc==True.
+            rdm2s: ndarray of shape (2,ncas,ncas,2,ncas,ncas)
+    '''
+    if orbsym is None: 
+        orbsym = getattr (las.mo_coeff, 'orbsym', None)
+        if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
+            orbsym = las.label_symmetry_(las.mo_coeff).orbsym
+        if orbsym is not None:
+            orbsym = orbsym[las.ncore:las.ncore+las.ncas]
+    if soc is None:
+        soc = getattr (si, 'soc', getattr (las, 'soc', False))
+    if break_symmetry is None:
+        break_symmetry = getattr (si, 'break_symmetry', getattr (las, 'break_symmetry', False))
+    if rootsym is None:
+        rootsym = getattr (si, 'rootsym', getattr (las, 'rootsym', None))
+    if opt == 0 and op_o0.memcheck (las, ci, soc=soc) == False:
+        raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
+    if state is None: states = np.arange (si.shape[1])
+    else: states = np.atleast_1d (state)
+    rootsym = np.array ([tuple (rootsym[s]) for s in states])
+
+    # Resolve the symmetry blocks up front, so that the subspace environment of las is not
+    # left engaged while the caller holds the generator
+    statesym = las_symm_tuple (las, break_spin=soc, break_symmetry=break_symmetry, verbose=0)[0]
+    blocks = [(sym, indcs, indxd) for las1, sym, indcs, indxd
+              in iterate_subspace_blocks (las, ci, statesym, subset=set (map (tuple, rootsym)))]
+    for sym, (idx_space, idx_prod), (ci_blk, nelec_blk) in blocks:
+        states_blk = states[np.all (rootsym == sym, axis=1)]
+        wfnsym = None if break_symmetry else sym[-1]
+        si_blk = si[np.ix_(idx_prod,states_blk)]
+        if opt == 0:
+            nbatch = batch_size or len (states_blk)
+            gen = ((np.arange (p0, min (p0+nbatch, len (states_blk))),)
+                   + op_o0.roots_make_rdm12s (las, ci_blk, nelec_blk, si_blk[:,p0:p0+nbatch],
+                                              orbsym=orbsym, wfnsym=wfnsym)
+                   for p0 in range (0, len (states_blk), nbatch))
+        else:
+            gen = op[opt].iter_roots_make_rdm12s (las, ci_blk, nelec_blk, si_blk,
+                                                  batch_size=batch_size, orbsym=orbsym,
+                                                  wfnsym=wfnsym)
+        while True:
+            t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+            with _LASSI_subspace_env (las, idx_space):
+                batch = next (gen, None)
+            if batch is None: break
+            cols, d1s, d2s = batch
+            lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} batch of {}'.format (
+                sym, len (cols)), *t0)
+            for i, d1, d2 in zip (cols, d1s, d2s):
+                yield states_blk[i], d1, d2
+            batch = cols = d1s = d2s = None
+
+def dump_roots_rdm12s (las, ci, si, h5file, state=None, batch_size=None,
+                       compression=RDM_H5_COMPRESSION, **kwargs):
+    '''Evaluate 1- and 2-electron reduced density matrices of LASSI states and write them
+    directly to an HDF5 file, one batch of states at a time. The file contains the datasets
+    "states", "rdm1s", and "rdm2s", the latter two chunked by state.
+
+        Args:
+            las: LASCI object
+            ci: list of list of ci vectors
+            si: tagged ndarray of shape (nroots,nroots)
+               Linear combination vectors defining LASSI states.
+            h5file: str or file-like object
+                Destination; overwritten if it exists
+
+        Kwargs:
+            state: integer or sequence of integers
+                Defaults to all columns of si
+            batch_size: integer
+                Maximum number of states whose density matrices are computed at once
+            compression: str or None
+                HDF5 compression filter for the density-matrix datasets
+            Additional kwargs are passed to iter_roots_make_rdm12s
+
+        Returns:
+            rdms: instance of :class:`RootsRDM12sH5`
+                Lazy reader of the file
+    '''
+    if state is None: states = np.arange (si.shape[1])
+    else: states = np.atleast_1d (state)
+    row = {s: i for i, s in enumerate (states)}
+    if hasattr (h5file, 'truncate'):
+        # h5py does not truncate file-like objects opened in 'w' mode
+        h5file.seek (0)
+        h5file.truncate ()
+    with h5py.File (h5file, 'w') as f:
+        f['states'] = states
+        dset1 = dset2 = None
+        for s, rdm1s, rdm2s in iter_roots_make_rdm12s (las, ci, si, state=states,
+                                                       batch_size=batch_size, **kwargs):
+            if dset1 is None:
+                dset1 = f.create_dataset ('rdm1s', (len (states),) + rdm1s.shape,
+                                          dtype=rdm1s.dtype, chunks=(1,) + rdm1s.shape,
+                                          compression=compression)
+                dset2 = f.create_dataset ('rdm2s', (len (states),) + rdm2s.shape,
+                                          dtype=rdm2s.dtype, chunks=(1,) + rdm2s.shape,
+                                          compression=compression)
+            dset1[row[s]] = rdm1s
+            dset2[row[s]] = rdm2s
+    return RootsRDM12sH5 (h5file)
+
+class RootsRDM12sH5 (object):
+    '''Lazy reader of LASSI-state density matrices written by dump_roots_rdm12s. The density
+    matrices are read one state at a time through a single read-only handle, which is opened on
+    the first read and released by close () (or on leaving a with block).
+
+    Attributes:
+        states: ndarray of ints
+            Indices of the LASSI states stored in the file
+    '''
+    def __init__(self, h5file):
+        self.h5file = h5file
+        self._f = None
+        with h5py.File (h5file, 'r') as f:
+            self.states = f['states'][()]
+        self._rows = {s: i for i, s in enumerate (self.states)}
+
+    def __len__(self):
+        return len (self.states)
+
+    def __contains__(self, state):
+        return state in self._rows
+
+    def __iter__(self):
+        for s in self.states:
+            yield (s,) + self.get_rdm12s (s)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close ()
+
+    def __del__(self):
+        self.close ()
+
+    def close (self):
+        if getattr (self, '_f', None) is not None: self._f.close ()
+        self._f = None
+
+    def _read (self, state, *keys):
+        i = self._rows[state]
+        if self._f is None: self._f = h5py.File (self.h5file, 'r')
+        return tuple (np.asarray (self._f[key][i]) for key in keys)
+
+    def get_rdm1s (self, state):
+        return self._read (state, 'rdm1s')[0]
+
+    def get_rdm2s (self, state):
+        return self._read (state, 'rdm2s')[0]
+
+    def get_rdm12s (self, state):
+        return self._read (state, 'rdm1s', 'rdm2s')
+
 class LASSI(lib.StreamObject):
     '''
     LASSI Method class
     '''
     def __init__(self, las, mo_coeff=None, ci=None, soc=False, break_symmetry=False, opt=1,
-                 **kwargs):
+                 davidson=False, nroots_si=1, nproc=1, **kwargs):
         from mrh.my_pyscf.mcscf.lasci import LASCINoSymm
         if isinstance(las, LASCINoSymm): self._las = las
         else: raise RuntimeError("LASSI requires las instance")
@@ -733,7 +1047,8 @@ class LASSI(lib.StreamObject):
         self.stdout, self.verbose, self.chkfile = las.stdout, las.verbose, las.chkfile
         # General config data from las parent
         self.max_memory = las.max_memory
-        keys = set(('e_roots', 'si', 's2', 's2_mat', 'nelec', 'wfnsym', 'rootsym', 'break_symmetry', 'soc', 'opt'))
+        keys = set(('e_roots', 'si', 's2', 's2_mat', 'nelec', 'wfnsym', 'rootsym', 'break_symmetry', 'soc', 'opt',
+                    'davidson', 'nroots_si', 'nproc'))
         self.e_roots = None
         self.si = None
         self.s2 = None
@@ -744,19 +1059,30 @@ class LASSI(lib.StreamObject):
         self.break_symmetry = break_symmetry
         self.soc = soc
         self.opt = opt
+        self.davidson = davidson
+        self.nroots_si = nroots_si
+        self.nproc = nproc
+        # Fragment intermediates shared by successive op_o1 calls (ham, RDMs, etc.) on this
+        # object, including those made after kernel; emptied by reset or ints_cache.clear ()
+        self.ints_cache = op_o1.frag.FragIntsCache ()
         self._keys = set((self.__dict__.keys())).union(keys)
 
     def kernel(self, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, soc=None,\
-               break_symmetry=None, opt=None,  **kwargs):
+               break_symmetry=None, opt=None, davidson=None, nroots_si=None, nproc=None,
+               **kwargs):
         if soc is None: soc = self.soc
         if break_symmetry is None: break_symmetry = self.break_symmetry
         if opt is None: opt = self.opt
+        if davidson is None: davidson = self.davidson
+        if nroots_si is None: nroots_si = self.nroots_si
+        if nproc is None: nproc = self.nproc
         log = lib.logger.new_logger (self, self.verbose)
         t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
         if not self.converged:
             log.warn ('LASSI state preparation step not converged!')
         e_roots, si = lassi(self, mo_coeff=mo_coeff, ci=ci, veff_c=veff_c, h2eff_sub=h2eff_sub, orbsym=orbsym, \
-                            soc=soc, break_symmetry=break_symmetry, opt=opt)
+                            soc=soc, break_symmetry=break_symmetry, opt=opt, davidson=davidson,
+                            nroots_si=nroots_si, nproc=nproc)
         self.e_roots = e_roots
         self.si, self.s2, self.s2_mat, self.nelec, self.wfnsym, self.rootsym, self.break_symmetry, self.soc  = \
             si, si.s2, si.s2_mat, si.nelec, si.wfnsym, si.rootsym, si.break_symmetry, si.soc
@@ -824,6 +1150,7 @@ class LASSI(lib.StreamObject):
     def reset (self, mol=None):
         if mol is not None:
             self.mol = mol
+        self.ints_cache.clear ()
         self._las.reset (mol)
 
     dump_chk = chkfile.dump_lsi
@@ -1,7 +1,10 @@
+import copy
 import numpy as np
 from scipy import linalg
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from pyscf import lib
-from pyscf.fci.direct_spin1 import trans_rdm12s, contract_1e, contract_2e, absorb_h1e
+from pyscf.fci.direct_spin1 import trans_rdm12s, trans_rdm1s, contract_1e, contract_2e, absorb_h1e
 from pyscf.fci.direct_uhf import contract_1e as contract_1e_uhf
 from pyscf.fci.addons import cre_a, cre_b, des_a, des_b
 from pyscf.fci import cistring
@@ -12,6 +15,228 @@ from pyscf import __config__
 
 SCREEN_THRESH = getattr (__config__, 'lassi_frag_screen_thresh', 1e-10)
 DO_SCREEN_LINEQUIV = getattr (__config__, 'lassi_frag_do_screen_linequiv', True)
+# Relative tolerance for fingerprints of candidate duplicate rootspaces (the fingerprints
+# themselves scale as lroots/ndet)
+FINGERPRINT_RTOL = getattr (__config__, 'lassi_frag_fingerprint_rtol', 1e-6)
+# Maximum number of threads among which fragments are distributed by make_ints. None means
+# lib.num_threads (). Opt-in, because the OpenMP threads are divided equally among the
+# fragments regardless of their size.
+MAKE_INTS_NTHREADS = getattr (__config__, 'lassi_frag_make_ints_nthreads', 1)
+# Caps on the number and total size (in MB) of make_ints results held by a FragIntsCache. The
+# size is further capped at this fraction of the max_memory of the LASSI instance.
+INTS_CACHE_MAX_SIZE = getattr (__config__, 'lassi_frag_ints_cache_max_size', 8)
+INTS_CACHE_MAX_MEMORY = getattr (__config__, 'lassi_frag_ints_cache_max_memory', 2000)
+INTS_CACHE_MAX_MEMORY_FRACTION = getattr (__config__,
+                                          'lassi_frag_ints_cache_max_memory_fraction', 0.25)
+
+def get_rootspace_fingerprint (ci):
+    '''Cheap fingerprint of the span of the CI vectors of one rootspace, invariant to unitary
+    transformations among them: the squared norm of the projection of a fixed random unit
+    vector onto the span. The CI vectors of the rootspace are assumed to be orthonormal;
+    otherwise, this is not a function of the span alone.
+
+    Args:
+        ci : ndarray of shape (lroots, ndeta, ndetb)
+            CI vectors of a single rootspace
+
+    Returns:
+        fp : float
+    '''
+    ci = ci.reshape (ci.shape[0], -1)
+    rng = np.random.default_rng (ci.shape[1])
+    r = rng.random (ci.shape[1]) - 0.5
+    r /= linalg.norm (r)
+    return linalg.norm (ci.conj () @ r) ** 2
+
+def get_unique_root_candidates (ci, nelec_r, rtol=FINGERPRINT_RTOL):
+    '''Find all pairs of rootspaces which may be duplicates or linearly equivalent, by
+    bucketing them according to nelec, lroots, and CI array shape and then comparing
+    fingerprints (see get_rootspace_fingerprint) within each bucket. The CI vectors of each
+    rootspace are assumed to be orthonormal.
+
+    Args:
+        ci : list of ndarray of length nroots
+            Contains CI vectors for a fragment
+        nelec_r : list of tuple of length nroots
+            Number of spin-up and spin-down electrons in each rootspace
+
+    Kwargs:
+        rtol : float
+            Two rootspaces are considered candidates if their fingerprints fp_i and fp_j satisfy
+            |fp_i-fp_j| <= rtol*min(fp_i,fp_j)
+
+    Returns:
+        pairs : list of tuple
+            Candidate pairs (i,j) with i<j, in lexical order
+    '''
+    buckets = {}
+    for i, (c, nelec) in enumerate (zip (ci, nelec_r)):
+        key = (tuple (nelec), c.shape)
+        buckets.setdefault (key, []).append (i)
+    pairs = []
+    for roots in buckets.values ():
+        if len (roots) < 2: continue
+        roots = np.asarray (roots)
+        fps = np.array ([get_rootspace_fingerprint (ci[i]) for i in roots])
+        idx = np.argsort (fps)
+        roots, fps = roots[idx], fps[idx]
+        ends = np.searchsorted (fps, fps + rtol*np.abs (fps), side='right')
+        for p, q in enumerate (ends):
+            for r in range (p+1, q):
+                i, j = roots[p], roots[r]
+                pairs.append ((min (i,j), max (i,j)))
+    return sorted (pairs)
+
+def _trans_epq_lroots (c, norb, nelec, spin, link_index=None):
+    '''Apply all single-spin excitation operators E_pq to a stack of CI vectors.
+
+    Args:
+        c : ndarray of shape (lroots, ndeta, ndetb)
+        norb : integer
+        nelec : tuple of length 2
+        spin : 0 or 1
+
+    Kwargs:
+        link_index : ndarray
+            From cistring.gen_linkstr_index for the relevant spin
+
+    Returns:
+        epq_c : ndarray of shape (norb, norb, lroots, ndeta*ndetb)
+            epq_c[p,q] = E_pq|c>
+    '''
+    if link_index is None: link_index = cistring.gen_linkstr_index (range (norb), nelec[spin])
+    p, q, J, sgn = link_index.transpose (2,0,1)
+    I = np.broadcast_to (np.arange (link_index.shape[0])[:,None], p.shape)
+    epq_c = np.zeros ((norb,norb) + c.shape, dtype=c.dtype)
+    # (p,q,J) is unique for each link, so no accumulation is required
+    if spin==0:
+        epq_c[p,q,:,J,:] = sgn[:,:,None,None] * c.transpose (1,0,2)[I]
+    else:
+        epq_c[p,q,:,:,J] = sgn[:,:,None,None] * c.transpose (2,0,1)[I]
+    return epq_c.reshape (norb, norb, c.shape[0], -1)
+
+def _get_epq_blksize (norb, c, nbuf, max_memory):
+    '''Number of CI vectors like c[0] to which all E_pq of both spins can be applied at once
+    within max_memory, with nbuf copies of each'''
+    if max_memory is None: max_memory = lib.param.MAX_MEMORY
+    mem_per_root = nbuf * 2 * norb * norb * c[0].size * np.dtype (c.dtype).itemsize / 1e6
+    mem_avail = max_memory - lib.current_memory ()[0]
+    return int (mem_avail / max (mem_per_root, 1e-6))
+
+def trans_rdm1s_lroots (bra, ket, norb, nelec, link_index=None, max_memory=None):
+    '''Spin-separated 1-body transition density matrices between all pairs of states in two
+    stacks of CI vectors with the same numbers of electrons. The kets are processed in chunks
+    that fit in max_memory; if not even one ket fits, direct_spin1.trans_rdm1s is called for
+    each pair instead.
+
+    Args:
+        bra : ndarray of shape (lroots_bra, ndeta, ndetb)
+        ket : ndarray of shape (lroots_ket, ndeta, ndetb)
+        norb : integer
+        nelec : tuple of length 2
+
+    Kwargs:
+        link_index : tuple of length 2
+            From cistring.gen_linkstr_index for each spin
+        max_memory : float
+            In MB; defaults to lib.param.MAX_MEMORY
+
+    Returns:
+        tdm1s : ndarray of shape (lroots_bra, lroots_ket, 2, norb, norb)
+            tdm1s[i,j,s,p,q] = <bra[i]|p(s)'q(s)|ket[j]>
+    '''
+    nbra, nket = bra.shape[0], ket.shape[0]
+    blksize = _get_epq_blksize (norb, ket, 1, max_memory)
+    if blksize >= nket: return _trans_rdm1s_lroots (bra, ket, norb, nelec, link_index)
+    tdm1s = np.empty ((nbra, nket, 2, norb, norb), dtype=np.result_type (bra, ket))
+    if blksize < 1:
+        for i, j in product (range (nbra), range (nket)):
+            d1s = trans_rdm1s (bra[i], ket[j], norb, nelec)
+            tdm1s[i,j] = np.stack (d1s, axis=0).transpose (0,2,1)
+        return tdm1s
+    for j0, j1 in lib.prange (0, nket, blksize):
+        tdm1s[:,j0:j1] = _trans_rdm1s_lroots (bra, ket[j0:j1], norb, nelec, link_index)
+    return tdm1s
+
+def _trans_rdm1s_lroots (bra, ket, norb, nelec, link_index=None):
+    if link_index is None: link_index = (None, None)
+    bra = bra.reshape (bra.shape[0], -1).conj ()
+    tdm1s = [np.dot (bra, _trans_epq_lroots (ket, norb, nelec, s, link_index[s]).reshape (
+                norb*norb*ket.shape[0], -1).T).reshape (bra.shape[0], norb, norb, ket.shape[0])
+             for s in (0,1)]
+    return np.stack (tdm1s, axis=1).transpose (0,4,1,2,3)
+
+def trans_rdm12s_lroots (bra, ket, norb, nelec, link_index=None, max_memory=None):
+    '''Spin-separated 1- and 2-body transition density matrices between all pairs of states in
+    two stacks of CI vectors with the same numbers of electrons, in the conventions of
+    direct_spin1.trans_rdm12s, evaluated as
+
+    <bra|p'q r's|ket> = <E_qp bra|E_rs ket>
+
+    with a single matrix multiplication over the determinant space for each spin pair. The bras
+    and kets are processed in chunks that fit in max_memory; if not even one bra and one ket
+    fit, direct_spin1.trans_rdm12s is called for each pair instead.
+
+    Args:
+        bra : ndarray of shape (lroots_bra, ndeta, ndetb)
+        ket : ndarray of shape (lroots_ket, ndeta, ndetb)
+        norb : integer
+        nelec : tuple of length 2
+
+    Kwargs:
+        link_index : tuple of length 2
+            From cistring.gen_linkstr_index for each spin
+        max_memory : float
+            In MB; defaults to lib.param.MAX_MEMORY
+
+    Returns:
+        tdm1s : ndarray of shape (lroots_bra, lroots_ket, 2, norb, norb)
+            tdm1s[i,j,s,p,q] = <bra[i]|p(s)'q(s)|ket[j]>
+        tdm2s : ndarray of shape (lroots_bra, lroots_ket, 4, norb, norb, norb, norb)
+            tdm2s[i,j,s1*2+s2,p,q,r,s] = <bra[i]|p(s1)'r(s2)'s(s2)q(s1)|ket[j]>
+    '''
+    nbra, nket = bra.shape[0], ket.shape[0]
+    # E_pq|bra> and E_pq|ket> for both spins, plus a conjugated copy of the former
+    blksize = _get_epq_blksize (norb, ket, 1.5, max_memory)
+    if blksize >= nbra + nket: return _trans_rdm12s_lroots (bra, ket, norb, nelec, link_index)
+    dtype = np.result_type (bra, ket)
+    tdm1s = np.empty ((nbra, nket, 2, norb, norb), dtype=dtype)
+    tdm2s = np.empty ((nbra, nket, 4, norb, norb, norb, norb), dtype=dtype)
+    if blksize < 2:
+        for i, j in product (range (nbra), range (nket)):
+            d1s, d2s = trans_rdm12s (bra[i], ket[j], norb, nelec)
+            # Transpose based on docstring of direct_spin1.trans_rdm12s
+            tdm1s[i,j] = np.stack (d1s, axis=0).transpose (0,2,1)
+            tdm2s[i,j] = np.stack (d2s, axis=0)
+        return tdm1s, tdm2s
+    bblk = min (nbra, blksize // 2)
+    kblk = min (nket, blksize - bblk)
+    for i0, i1 in lib.prange (0, nbra, bblk):
+        for j0, j1 in lib.prange (0, nket, kblk):
+            tdm1s[i0:i1,j0:j1], tdm2s[i0:i1,j0:j1] = _trans_rdm12s_lroots (
+                bra[i0:i1], ket[j0:j1], norb, nelec, link_index)
+    return tdm1s, tdm2s
+
+def _trans_rdm12s_lroots (bra, ket, norb, nelec, link_index=None):
+    if link_index is None: link_index = (None, None)
+    nbra, nket = bra.shape[0], ket.shape[0]
+    ndet = bra.shape[1] * bra.shape[2]
+    epq_bra = [_trans_epq_lroots (bra, norb, nelec, s, link_index[s]) for s in (0,1)]
+    epq_ket = [_trans_epq_lroots (ket, norb, nelec, s, link_index[s]) for s in (0,1)]
+    bravec = bra.reshape (nbra, ndet).conj ()
+    tdm1s = [np.dot (bravec, e.reshape (norb*norb*nket, ndet).T) for e in epq_ket]
+    tdm1s = np.stack (tdm1s, axis=0).reshape (2, nbra, norb, norb, nket).transpose (1,4,0,2,3)
+    tdm2s = np.empty ((nbra, nket, 4, norb, norb, norb, norb), dtype=tdm1s.dtype)
+    for s1, s2 in product (range (2), repeat=2):
+        e1 = epq_bra[s1].reshape (norb*norb*nbra, ndet).conj ()
+        e2 = epq_ket[s2].reshape (norb*norb*nket, ndet)
+        # (q,p,i,r,s,j) -> (i,j,p,q,r,s)
+        d2 = np.dot (e1, e2.T).reshape (norb, norb, nbra, norb, norb, nket)
+        tdm2s[:,:,2*s1+s2] = d2.transpose (2,5,1,0,3,4)
+    for s in (0,1):
+        for q in range (norb):
+            tdm2s[:,:,3*s,:,q,q,:] -= tdm1s[:,:,s]
+    return tdm1s, tdm2s
 
 class FragTDMInt (object):
     ''' Fragment-local LAS state transition density matrix intermediate
@@ -84,12 +309,16 @@ class FragTDMInt (object):
             screen_linequiv : logical
                 Whether to compress data by aggressively identifying linearly equivalent
                 rootspaces and storing the relevant unitary matrices.
+            max_memory : float
+                In MB; bounds the scratch memory of the batched TDM evaluations. Defaults to
+                lib.param.MAX_MEMORY.
     '''
 
     def __init__(self, ci, hopping_index, zerop_index, onep_index, norb, nroots, nelec_rs,
                  rootaddr, fragaddr, idx_frag, dtype=np.float64,
-                 screen_linequiv=DO_SCREEN_LINEQUIV):
-        # TODO: if it actually helps, cache the "linkstr" arrays
+                 screen_linequiv=DO_SCREEN_LINEQUIV, max_memory=None):
+        if max_memory is None: max_memory = lib.param.MAX_MEMORY
+        self.max_memory = max_memory
         self.ci = ci
         self.hopping_index = hopping_index
         self.zerop_index = zerop_index
@@ -153,6 +382,28 @@ class FragTDMInt (object):
 
     def setmanip (self, x): return np.ascontiguousarray (x)
 
+    def recast (self, cls):
+        '''Shallow copy of self as an instance of a subclass which stores the same intermediates
+        in a different memory layout (i.e., which only overrides setmanip)'''
+        other = copy.copy (self)
+        other.__class__ = cls
+        def remanip (tab):
+            if isinstance (tab, list): return [remanip (t) for t in tab]
+            if tab is None: return None
+            return other.setmanip (tab)
+        for key in ('_h', '_hh', '_phh', '_sm', 'dm1', 'dm2'):
+            setattr (other, key, remanip (getattr (self, key)))
+        return other
+
+    def get_nbytes (self):
+        '''Total size of the stored intermediates in bytes'''
+        def nbytes (tab):
+            if isinstance (tab, list): return sum ([nbytes (t) for t in tab])
+            if tab is None: return 0
+            return tab.nbytes
+        return sum ([nbytes (getattr (self, key))
+                     for key in ('ovlp', '_h', '_hh', '_phh', '_sm', 'dm1', 'dm2')])
+
     # 0-particle intermediate (overlap)
 
     def get_ovlp (self, i, j):
@@ -305,7 +556,7 @@ class FragTDMInt (object):
         self.root_unique = np.ones (self.nroots, dtype=bool)
         self.unique_root = np.arange (self.nroots, dtype=int)
         self.umat_root = {}
-        for i, j in combinations (range (self.nroots), 2):
+        for i, j in get_unique_root_candidates (ci, self.nelec_r):
             if not self.root_unique[i]: continue
             if not self.root_unique[j]: continue
             if self.nelec_r[i] != self.nelec_r[j]: continue
@@ -368,19 +619,32 @@ class FragTDMInt (object):
             return np.asarray (des_c)
         def des_a_loop (c, nelec, p): return des_loop (des_a, c, nelec, p)
         def des_b_loop (c, nelec, p): return des_loop (des_b, c, nelec, p)
+        link_index_cache = {}
+        def get_link_index (nelec):
+            if nelec not in link_index_cache:
+                link_index_cache[nelec] = tuple (cistring.gen_linkstr_index (range (norb), n)
+                                                 for n in nelec)
+            return link_index_cache[nelec]
         def trans_rdm12s_loop (iroot, bra, ket):
             nelec = self.nelec_r[iroot]
             na, nb = ndeta[iroot], ndetb[iroot]
             bra = bra.reshape (-1, na, nb)
             ket = ket.reshape (-1, na, nb)
-            tdm1s = np.zeros ((bra.shape[0],ket.shape[0],2,norb,norb), dtype=self.dtype)
-            tdm2s = np.zeros ((bra.shape[0],ket.shape[0],4,norb,norb,norb,norb), dtype=self.dtype)
-            for i, j in product (range (bra.shape[0]), range (ket.shape[0])):
-                d1s, d2s = trans_rdm12s (bra[i], ket[j], norb, nelec)
-                # Transpose based on docstring of direct_spin1.trans_rdm12s
-                tdm1s[i,j] = np.stack (d1s, axis=0).transpose (0, 2, 1)
-                tdm2s[i,j] = np.stack (d2s, axis=0)
-            return tdm1s, tdm2s
+            tdm1s, tdm2s = trans_rdm12s_lroots (bra, ket, norb, nelec,
+                                                link_index=get_link_index (nelec),
+                                                max_memory=self.max_memory)
+            return tdm1s.astype (self.dtype, copy=False), tdm2s.astype (self.dtype, copy=False)
+        def trans_phh_loop (iroot, bra, hket):
+            # <bra|t't h_p|ket> for all p; hket[p] = h_p|ket>
+            nelec = self.nelec_r[iroot]
+            na, nb = ndeta[iroot], ndetb[iroot]
+            bra = bra.reshape (-1, na, nb)
+            nket = hket.shape[1]
+            hket = hket.reshape (norb*nket, na, nb)
+            phh = trans_rdm1s_lroots (bra, hket, norb, nelec, link_index=get_link_index (nelec),
+                                      max_memory=self.max_memory)
+            phh = phh.reshape (bra.shape[0], norb, nket, 2, norb, norb).transpose (0,2,3,4,5,1)
+            return phh.astype (self.dtype, copy=False)
 
         # Spectator fragment contribution
         spectator_index = np.all (hopping_index == 0, axis=0)
@@ -417,8 +681,7 @@ class FragTDMInt (object):
                     ))
                     # <j|a'_q a_r a_p|i>, <j|b'_q b_r a_p|i> - how to tell if consistent sign rule?
                     if onep_index[bra,ket]:
-                        phh = np.stack ([trans_rdm12s_loop (bra, ci[bra], ketmat)[0]
-                                         for ketmat in apket], axis=-1)
+                        phh = trans_phh_loop (bra, ci[bra], apket)
                         err = np.abs (phh[:,:,0] + phh[:,:,0].transpose (0,1,2,4,3))
                         assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err)) 
                         # ^ Passing this assert proves that I have the correct index
@@ -463,8 +726,7 @@ class FragTDMInt (object):
                     ))
                     # <j|a'_q a_r b_p|i>, <j|b'_q b_r b_p|i> - how to tell if consistent sign rule?
                     if onep_index[bra,ket]:
-                        phh = np.stack ([trans_rdm12s_loop (bra, ci[bra], ketmat)[0]
-                                         for ketmat in bpket], axis=-1)
+                        phh = trans_phh_loop (bra, ci[bra], bpket)
                         err = np.abs (phh[:,:,1] + phh[:,:,1].transpose (0,1,2,4,3))
                         assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err))
                         # ^ Passing this assert proves that I have the correct index
@@ -588,7 +850,7 @@ class FragTDMInt (object):
         return hci
 
 def make_ints (las, ci, nelec_frs, screen_linequiv=DO_SCREEN_LINEQUIV, nlas=None,
-               _FragTDMInt_class=FragTDMInt):
+               nthreads=None, use_cache=True, _FragTDMInt_class=FragTDMInt):
     ''' Build fragment-local intermediates (`FragTDMInt`) for LASSI o1
 
     Args:
@@ -603,6 +865,15 @@ def make_ints (las, ci, nelec_frs, screen_linequiv=DO_SCREEN_LINEQUIV, nlas=None
         screen_linequiv : logical
             Whether to compress data by aggressively identifying linearly equivalent
             rootspaces and storing the relevant unitary matrices.
+        nthreads : integer
+            Maximum number of fragments to process concurrently, each in its own Python thread
+            with an equal share of the OpenMP threads. Defaults to MAKE_INTS_NTHREADS = 1 (None
+            means lib.num_threads ()), and is further limited by max_memory.
+        use_cache : logical
+            Whether to look up and store the results in las.ints_cache, an instance of
+            :class:`FragIntsCache`, if las has one (i.e., if las is a LASSI instance). If so,
+            hopping_index is tagged with a dict, "exc_tables", in which the excitation tables
+            built from it are stored.
 
     Returns:
         hopping_index : ndarray of ints of shape (nfrags, 2, nroots, nroots)
@@ -614,19 +885,156 @@ def make_ints (las, ci, nelec_frs, screen_linequiv=DO_SCREEN_LINEQUIV, nlas=None
     '''
     nfrags, nroots = nelec_frs.shape[:2]
     if nlas is None: nlas = las.ncas_sub
+    cache = getattr (las, 'ints_cache', None) if use_cache else None
+    if cache is not None:
+        cache_args = (ci, nelec_frs, nlas, screen_linequiv, _FragTDMInt_class)
+        result = cache.get (*cache_args)
+        if result is not None:
+            lib.logger.debug (las, 'LAS-state TDM12s fragment intermediates retrieved from cache')
+            return result
     lroots = get_lroots (ci)
     hopping_index, zerop_index, onep_index = lst_hopping_index (nelec_frs)
     rootaddr, fragaddr = get_rootaddr_fragaddr (lroots)
-    ints = []
-    for ifrag in range (nfrags):
-        tdmint = _FragTDMInt_class (ci[ifrag], hopping_index[ifrag], zerop_index, onep_index,
-                                   nlas[ifrag], nroots, nelec_frs[ifrag], rootaddr,
-                                   fragaddr[ifrag], ifrag, screen_linequiv=screen_linequiv)
+    nthreads = _get_make_ints_nthreads (las, ci, nlas, nthreads)
+    nthreads_omp = max (1, lib.num_threads () // nthreads)
+    # Each concurrent fragment gets an equal share of the memory currently available
+    max_memory = getattr (las, 'max_memory', las.mol.max_memory)
+    current_memory = lib.current_memory ()[0]
+    max_memory_frag = current_memory + (max_memory - current_memory) / nthreads
+    def make_int (ifrag):
+        # Each fragment ORs the rows and columns of its linearly-equivalent rootspaces into its
+        # own copies of zerop_index and onep_index
+        with lib.with_omp_threads (nthreads_omp):
+            tdmint = _FragTDMInt_class (ci[ifrag], hopping_index[ifrag], zerop_index.copy (),
+                                       onep_index.copy (), nlas[ifrag], nroots, nelec_frs[ifrag],
+                                       rootaddr, fragaddr[ifrag], ifrag,
+                                       screen_linequiv=screen_linequiv,
+                                       max_memory=max_memory_frag)
         lib.logger.timer (las, 'LAS-state TDM12s fragment {} intermediate crunching'.format (
             ifrag), *tdmint.time_crunch)
         lib.logger.debug (las, 'UNIQUE ROOTSPACES OF FRAG %d: %d/%d', ifrag,
                           np.count_nonzero (tdmint.root_unique), nroots)
-        ints.append (tdmint)
+        return tdmint
+    if nthreads > 1:
+        with ThreadPoolExecutor (max_workers=nthreads) as executor:
+            ints = list (executor.map (make_int, range (nfrags)))
+    else:
+        ints = [make_int (ifrag) for ifrag in range (nfrags)]
+    if cache is not None:
+        hopping_index = lib.tag_array (hopping_index, exc_tables={})
+        cache.put (*cache_args, (hopping_index, ints, lroots), max_memory=max_memory)
     return hopping_index, ints, lroots
 
+def _get_make_ints_nthreads (las, ci, nlas, nthreads):
+    '''Number of fragments processed concurrently by make_ints, limited by the number of
+    fragments and by max_memory. Each fragment is assumed to need scratch memory for the
+    annihilation operators applied to all of the CI vectors of its largest rootspace (norb
+    times the size of that CI array), plus the smallest chunk of the batched TDM evaluations (all
+    E_pq of both spins applied to one bra and one ket, with a conjugated copy; see
+    trans_rdm12s_lroots).'''
+    if nthreads is None: nthreads = MAKE_INTS_NTHREADS
+    if nthreads is None: nthreads = lib.num_threads ()
+    nthreads = min (nthreads, len (ci))
+    if nthreads < 2: return 1
+    max_memory = getattr (las, 'max_memory', las.mol.max_memory)
+    def mem_rootspace (norb, c):
+        nbytes_root = c.nbytes // (c.shape[0] if c.ndim == 3 else 1)
+        return norb*c.nbytes + 6*norb*norb*nbytes_root
+    mem_frag = max ([max ([mem_rootspace (norb, c) for c in ci_f])
+                     for norb, ci_f in zip (nlas, ci)])
+    mem_frag = mem_frag / 1e6
+    mem_avail = max_memory - lib.current_memory ()[0]
+    if mem_frag > 0: nthreads = min (nthreads, int (mem_avail // mem_frag))
+    return max (1, nthreads)
+
+class FragIntsCache (object):
+    '''Least-recently-used cache of the results of make_ints, so that successive LASSI o1
+    calculations on the same CI vectors (Hamiltonian, RDMs, TDMs, etc.) build the fragment
+    intermediates and the excitation tables only once.
+
+    Entries are keyed on the identity of the CI vectors, the electron numbers, the orbital
+    partition, and the FragTDMInt class, and are checked against a checksum of the CI vectors on
+    retrieval in case these have been modified in-place. A subclass of FragTDMInt with the
+    attribute `_layout_of` is obtained by recasting a cached instance of that parent class.
+
+    Each LASSI instance owns one as its attribute ints_cache, which persists after LASSI.kernel
+    so that subsequent RDM and TDM evaluations reuse the intermediates; it is emptied by
+    LASSI.reset, at the end of a LAS-PDFT kernel, or explicitly by calling ints_cache.clear ().
+    Its size is bounded by max_memory regardless. The cache is only used if the LASSI instance,
+    not its parent LAS instance, is passed to the op_o1 functions, since LAS instances have none.
+
+    Kwargs:
+        max_size : integer
+            Maximum number of make_ints results held
+        max_memory : float
+            Maximum total size in MB of the intermediates held; see also put
+    '''
+    def __init__(self, max_size=INTS_CACHE_MAX_SIZE, max_memory=INTS_CACHE_MAX_MEMORY):
+        self.max_size = max_size
+        self.max_memory = max_memory
+        self.entries = OrderedDict ()
+        self.nhits = self.nmisses = 0
+
+    def __len__(self):
+        return len (self.entries)
+
+    def clear (self):
+        self.entries.clear ()
+
+    def get_key (self, ci, nelec_frs, nlas, screen_linequiv, cls):
+        ci_id = tuple ([tuple ([id (c) for c in ci_r]) for ci_r in ci])
+        nelec_frs = np.asarray (nelec_frs)
+        return (cls, ci_id, nelec_frs.shape, nelec_frs.tobytes (), tuple (nlas),
+                bool (screen_linequiv))
+
+    def get (self, ci, nelec_frs, nlas, screen_linequiv, cls):
+        '''Return the cached (hopping_index, ints, lroots) tuple or None'''
+        key = self.get_key (ci, nelec_frs, nlas, screen_linequiv, cls)
+        result = self._get (key, ci)
+        parent = getattr (cls, '_layout_of', None)
+        if result is None and parent is not None:
+            result = self._get (self.get_key (ci, nelec_frs, nlas, screen_linequiv, parent), ci)
+            if result is not None:
+                hopping_index, ints, lroots = result
+                result = (hopping_index, [i.recast (cls) for i in ints], lroots)
+                self.put (ci, nelec_frs, nlas, screen_linequiv, cls, result)
+        if result is None: self.nmisses += 1
+        else: self.nhits += 1
+        return result
+
+    def _get (self, key, ci):
+        entry = self.entries.get (key, None)
+        if entry is None: return None
+        if entry['checksum'] != _ci_checksum (ci):
+            del self.entries[key]
+            return None
+        self.entries.move_to_end (key)
+        return entry['result']
+
+    def put (self, ci, nelec_frs, nlas, screen_linequiv, cls, result, max_memory=None):
+        '''Store a (hopping_index, ints, lroots) tuple. If max_memory (in MB) is provided, the
+        total size of the cache is also capped at INTS_CACHE_MAX_MEMORY_FRACTION of it, and if
+        the current memory usage exceeds it, the cache is emptied and nothing is stored.'''
+        key = self.get_key (ci, nelec_frs, nlas, screen_linequiv, cls)
+        nbytes = sum ([i.get_nbytes () for i in result[1]])
+        cap = self.max_memory
+        if max_memory is not None:
+            cap = min (cap, INTS_CACHE_MAX_MEMORY_FRACTION * max_memory)
+            if lib.current_memory ()[0] > max_memory:
+                self.clear ()
+                return
+        if nbytes / 1e6 > cap: return
+        # Holding references to the CI vectors keeps their ids from being recycled
+        self.entries[key] = {'ci': ci, 'checksum': _ci_checksum (ci), 'result': result,
+                             'nbytes': nbytes}
+        self.entries.move_to_end (key)
+        while ((len (self.entries) > self.max_size)
+               or (self.get_nbytes () / 1e6 > cap)):
+            self.entries.popitem (last=False)
+
+    def get_nbytes (self):
+        return sum ([entry['nbytes'] for entry in self.entries.values ()])
+
+def _ci_checksum (ci):
+    return tuple ([tuple ([lib.fp (c) for c in ci_r]) for ci_r in ci])
 
@@ -137,25 +137,19 @@ class HamS2Ovlp (stdm.LSTDM):
 
     def _put_op_(self, op, bra, ket, opval, wgt):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        op[bra,ket] += wgt * opval
+        with self._put_lock:
+            op[bra,ket] += wgt * opval
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_s, self.dw_s = self.dt_s + dt, self.dw_s + dw
 
     def _put_ham_s2_(self, bra, ket, ham, s2, *inv):
-        # TODO: vectorize this part
         bra_rng = self._get_addr_range (bra, *inv) # profiled as idx
         ket_rng = self._get_addr_range (ket, *inv) # profiled as idx
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        ham = ham.flat
-        if s2 is None:
-            def _put_s2_(b,k,i,w): pass
-        else:
-            s2 = s2.flat
-            def _put_s2_(b,k,i,w): self._put_op_(self.s2, b, k, s2[i], w)
-        for ix, (bra1, ket1) in enumerate (product (bra_rng, ket_rng)):
-            bra2, ket2, wgt = self._get_spec_addr_ovlp (bra1, ket1, *inv)
-            self._put_op_(self.ham, bra2, ket2, ham[ix], wgt)
-            _put_s2_(bra2, ket2, ix, wgt)
+        bra2, ket2, wgt, ix = self._get_spec_addr_ovlp_rng (bra_rng, ket_rng, *inv)
+        self._put_op_(self.ham, bra2, ket2, ham.ravel ()[ix], wgt)
+        if s2 is not None:
+            self._put_op_(self.s2, bra2, ket2, s2.ravel ()[ix], wgt)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
@@ -399,6 +393,58 @@ class HamS2Ovlp (stdm.LSTDM):
         self.dt_2c, self.dw_2c = self.dt_2c + dt, self.dw_2c + dw
         return ham, s2, (l, j, i, k)
 
+def soc_context (h1, h2, ci, nelec_frs, soc, nlas):
+    ''' Prepare the Hamiltonian amplitudes, CI vectors, and electron numbers for a model space
+    in which spin-orbit coupling may mix states of different neleca-nelecb, by engaging the
+    ``spinless mapping'' if necessary. nelec_frs is modified in-place in that case.
+
+    Args:
+        h1 : ndarray of size ncas**2 or (2*ncas)**2
+            Contains effective 1-electron Hamiltonian amplitudes in second quantization
+        h2 : ndarray of size ncas**4
+            Contains 2-electron Hamiltonian amplitudes in second quantization
+        ci : list of list of ndarrays
+            Contains all CI vectors
+        nelec_frs : ndarray of shape (nfrags,nroots,2)
+            Number of electrons of each spin in each rootspace in each
+            fragment
+        soc : integer
+            Order of spin-orbit coupling included in the Hamiltonian
+        nlas : sequence of length (nfrags)
+            Number of orbitals in each fragment
+
+    Returns:
+        spin_pure : logical
+            Whether all rootspaces have the same neleca and nelecb
+        h1, h2, ci, nelec_frs, nlas : same as input
+            Transformed to the spinless mapping if necessary
+        spin_shuffle_fac : list of length nroots or None
+            Fermion permutation factors of the spinless mapping, if it was engaged
+    '''
+    n = sum (nlas)
+    nroots = nelec_frs.shape[1]
+    nelec_rs = [tuple (x) for x in nelec_frs.sum (0)]
+    spin_pure = len (set (nelec_rs)) == 1
+    spin_shuffle_fac = None
+    if soc and spin_pure: # In this scenario, the off-diagonal sector of h1 is pointless
+        h1 = np.stack ([h1[:n,:n], h1[n:,n:]], axis=0)
+    elif soc: # Engage the ``spinless mapping''
+        ix = np.argsort (spin_shuffle_idx (nlas))
+        h1 = h1[np.ix_(ix,ix)]
+        h2_ = np.zeros ([2*n,]*4, dtype=h2.dtype)
+        h2_[:n,:n,:n,:n] = h2[:]
+        h2_[:n,:n,n:,n:] = h2[:]
+        h2_[n:,n:,:n,:n] = h2[:]
+        h2_[n:,n:,n:,n:] = h2[:]
+        h2 = h2_[np.ix_(ix,ix,ix,ix)]
+        ci = ci_map2spinless (ci, nlas, nelec_frs)
+        nlas = [2*x for x in nlas]
+        spin_shuffle_fac = [fermion_spin_shuffle (nelec_frs[:,i,0], nelec_frs[:,i,1])
+                            for i in range (nroots)]
+        nelec_frs[:,:,0] += nelec_frs[:,:,1]
+        nelec_frs[:,:,1] = 0
+    return spin_pure, h1, h2, ci, nelec_frs, nlas, spin_shuffle_fac
+
 def ham (las, h1, h2, ci, nelec_frs, soc=0, nlas=None, _HamS2Ovlp_class=HamS2Ovlp, _do_kernel=True,
          **kwargs):
     ''' Build Hamiltonian, spin-squared, and overlap matrices in LAS product state basis
@@ -442,29 +488,12 @@ def ham (las, h1, h2, ci, nelec_frs, soc=0, nlas=None, _HamS2Ovlp_class=HamS2Ovl
     if soc>1: raise NotImplementedError ("Spin-orbit coupling of second order")
 
     # Handle possible SOC
-    n = sum (nlas)
-    nelec_rs = [tuple (x) for x in nelec_frs.sum (0)]
-    spin_pure = len (set (nelec_rs)) == 1
-    if soc and spin_pure: # In this scenario, the off-diagonal sector of h1 is pointless
-        h1 = np.stack ([h1[:n,:n], h1[n:,n:]], axis=0)
-    elif soc: # Engage the ``spinless mapping''
-        ix = np.argsort (spin_shuffle_idx (nlas))
-        h1 = h1[np.ix_(ix,ix)]
-        h2_ = np.zeros ([2*n,]*4, dtype=h2.dtype)
-        h2_[:n,:n,:n,:n] = h2[:]
-        h2_[:n,:n,n:,n:] = h2[:]
-        h2_[n:,n:,:n,:n] = h2[:]
-        h2_[n:,n:,n:,n:] = h2[:]
-        h2 = h2_[np.ix_(ix,ix,ix,ix)]
-        ci = ci_map2spinless (ci, nlas, nelec_frs)
-        nlas = [2*x for x in nlas]
-        spin_shuffle_fac = [fermion_spin_shuffle (nelec_frs[:,i,0], nelec_frs[:,i,1])
-                            for i in range (nroots)]
-        nelec_frs[:,:,0] += nelec_frs[:,:,1]
-        nelec_frs[:,:,1] = 0
+    spin_pure, h1, h2, ci, nelec_frs, nlas, spin_shuffle_fac = soc_context (
+        h1, h2, ci, nelec_frs, soc, nlas)
         
     # First pass: single-fragment intermediates
-    hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas)
+    hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas,
+                                                  use_cache=spin_pure)
     nstates = np.sum (np.prod (lroots, axis=0))
         
     # Memory check
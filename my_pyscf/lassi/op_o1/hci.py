@@ -36,6 +36,7 @@ class ContractHamCI (stdm.LSTDM):
     # Handling for 1s1c: need to do both a'.sm.b and b'.sp.a explicitly
     all_interactions_full_square = True
     interaction_has_spin = ('_1c_', '_1c1d_', '_1s1c_', '_2c_')
+    crunch_lroots_batched = False
 
     def _init_vecs (self):
         hci_fr_pabq = []
@@ -370,8 +371,9 @@ class ContractHamCI (stdm.LSTDM):
     def _put_vecs_(self, bra, ket, vecs, *inv):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
         bras, kets, facs = self._get_spec_addr_ovlp (bra, ket, *inv)
-        for bra, ket, fac in zip (bras, kets, facs):
-            self._put_Svecs_(bra, ket, [fac*vec for vec in vecs], *inv)
+        with self._put_lock:
+            for bra, ket, fac in zip (bras, kets, facs):
+                self._put_Svecs_(bra, ket, [fac*vec for vec in vecs], *inv)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
@@ -451,7 +453,7 @@ def contract_ham_ci (las, h1, h2, ci_fr_ket, nelec_frs_ket, ci_fr_bra, nelec_frs
 
     # First pass: single-fragment intermediates
     hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas,
-                                                  screen_linequiv=False)
+                                                  screen_linequiv=False, use_cache=False)
 
     # Second pass: upper-triangle
     t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
@@ -0,0 +1,298 @@
+import numpy as np
+from scipy.sparse import linalg as sparse_linalg
+from pyscf import lib
+from pyscf.lib import logger
+from mrh.my_pyscf.lassi.citools import umat_dot_1frag_
+from mrh.my_pyscf.lassi.op_o1 import frag
+from mrh.my_pyscf.lassi.op_o1.hams2ovlp import HamS2Ovlp, soc_context
+from mrh.my_pyscf.lassi.op_o1.utilities import *
+
+class HamS2OvlpOperators (HamS2Ovlp):
+    __doc__ = HamS2Ovlp.__doc__ + '''
+
+    SUBCLASS: Matrix-vector product
+
+    Instead of the operator matrices, `kernel` crunches and caches only the unique fragment-
+    interaction blocks of the Hamiltonian and spin-squared operators, which are replayed over the
+    spectator fragments whenever the operators are applied to a vector. The memory cost is
+    therefore that of the unique blocks plus O(nstates) per vector.
+
+    Additional methods:
+        get_ham_op, get_s2_op, get_ovlp_op
+            Take no arguments and return LinearOperators of shape (nstates,nstates) which apply the
+            respective operator to a SI trial vector.
+        get_hdiag
+            Take no arguments and return an ndarray of shape (nstates,) which contains the
+            Hamiltonian diagonal
+        get_ovlp_diag
+            Take no arguments and return an ndarray of shape (nstates,) which contains the
+            overlap-matrix diagonal
+    '''
+    def __init__(self, ints, nlas, hopping_index, lroots, h1, h2, mask_bra_space=None,
+                 mask_ket_space=None, log=None, max_memory=2000, dtype=np.float64):
+        HamS2Ovlp.__init__(self, ints, nlas, hopping_index, lroots, h1, h2,
+                           mask_bra_space=mask_bra_space, mask_ket_space=mask_ket_space,
+                           log=log, max_memory=max_memory, dtype=dtype)
+        self.ham_blocks = None
+        self.x = self.ox = None
+
+    def kernel (self):
+        ''' Crunch and cache the unique operator blocks. Must be called before any of the
+        operators are applied.
+
+        Returns:
+            self : instance of :class:`HamS2OvlpOperators`
+            t0 : tuple of length 2
+                timestamp of entry into this function, for profiling by caller
+        '''
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        self.init_profiling ()
+        self.ham_blocks = []
+        self._crunch_all_()
+        return self, t0
+
+    def _crunch_env_(self, _crunch_fn, *row):
+        if self._fn_row_has_spin (_crunch_fn):
+            inv = row[2:-1]
+        else:
+            inv = row[2:]
+        ham, s2, ninv = _crunch_fn (*row)
+        ham = self.canonical_operator_order (ham, ninv)
+        s2 = self.canonical_operator_order (s2, ninv)
+        self.ham_blocks.append ((row[0], row[1], ham, s2, inv))
+
+    def _add_transpose_(self): pass
+
+    def _iter_spec_blocks (self, bra, ket, op, *inv):
+        '''Iterate over the images of a cached operator block among all pairs of rootspaces and
+        spectator-fragment states to which it applies.
+
+        Args:
+            bra: integer
+                Index of the bra rootspace of the cached block
+            ket: integer
+                Index of the ket rootspace of the cached block
+            op: ndarray
+                Operator block in canonical order
+            *inv: integers
+                Indices of nonspectator fragments
+
+        Yields:
+            bra_idx: ndarray of shape (nbra,nspec)
+                Model-state indices of the bra for each nonspectator state (row) and spectator
+                state pair (column)
+            ket_idx: ndarray of shape (nket,nspec)
+                Model-state indices of the ket for each nonspectator state (row) and spectator
+                state pair (column)
+            op: ndarray of shape (nbra,nket)
+                The operator block
+            o: ndarray of shape (nspec,)
+                Overlap * permutation factors of the spectator state pairs
+        '''
+        bra_rng = self._get_addr_range (bra, *inv)
+        ket_rng = self._get_addr_range (ket, *inv)
+        op = op.reshape (len (bra_rng), len (ket_rng))
+        self._prepare_spec_addr_ovlp_(bra, ket, *inv)
+        braenv = self.envaddr[bra_rng]
+        ketenv = self.envaddr[ket_rng]
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        for (rbra1, rket1, b, k, o) in self._spec_addr_ovlp_cache:
+            bra_idx = b[None,:] + np.dot (braenv, self.strides[rbra1])[:,None]
+            ket_idx = k[None,:] + np.dot (ketenv, self.strides[rket1])[:,None]
+            dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+            self.dt_g, self.dw_g = self.dt_g + dt, self.dw_g + dw
+            yield bra_idx, ket_idx, op, o
+            t0, w0 = logger.process_clock (), logger.perf_counter ()
+
+    def _opuniq_x_(self, op, bra, ket, *inv):
+        '''Apply one cached operator block and its transpose to self.x, adding the result to
+        self.ox'''
+        for bra_idx, ket_idx, op, o in self._iter_spec_blocks (bra, ket, op, *inv):
+            t0, w0 = logger.process_clock (), logger.perf_counter ()
+            nbra, nspec = bra_idx.shape
+            nket = ket_idx.shape[0]
+            ox = np.dot (op, (self.x[ket_idx] * o[None,:,None]).reshape (nket, -1))
+            np.add.at (self.ox, bra_idx.ravel (), ox.reshape (nbra*nspec, -1))
+            ox = np.dot (op.T, (self.x[bra_idx] * o[None,:,None]).reshape (nbra, -1))
+            np.add.at (self.ox, ket_idx.ravel (), ox.reshape (nket*nspec, -1))
+            dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+            self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
+
+    def _umat_x_(self, x, transpose=False):
+        '''Apply all linear-equivalence unitary transformations to a stack of vectors'''
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        for ifrag, inti in enumerate (self.ints):
+            for iroot, umat in inti.umat_root.items ():
+                if transpose: umat = umat.T
+                x = umat_dot_1frag_(x, umat, self.lroots, ifrag, iroot, axis=0)
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_u, self.dw_u = self.dt_u + dt, self.dw_u + dw
+        return x
+
+    def _prepare_x_(self, x):
+        x = np.asarray (x)
+        is_vec = (x.ndim == 1)
+        x = np.array (x.reshape (self.nstates, -1), dtype=np.result_type (x, self.dtype))
+        self.x = self._umat_x_(x, transpose=True)
+        self.ox = np.zeros_like (self.x)
+        return is_vec
+
+    def _finalize_ox_(self, is_vec):
+        ox = self._umat_x_(self.ox)
+        self.x = self.ox = None
+        if is_vec: ox = ox[:,0]
+        return ox
+
+    def _ham_op (self, x):
+        is_vec = self._prepare_x_(x)
+        for bra, ket, ham, s2, inv in self.ham_blocks:
+            self._opuniq_x_(ham, bra, ket, *inv)
+        return self._finalize_ox_(is_vec)
+
+    def _s2_op (self, x):
+        is_vec = self._prepare_x_(x)
+        for bra, ket, ham, s2, inv in self.ham_blocks:
+            if s2 is not None: self._opuniq_x_(s2, bra, ket, *inv)
+        return self._finalize_ox_(is_vec)
+
+    def _ovlp_op (self, x):
+        is_vec = self._prepare_x_(x)
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        nvec = self.x.shape[1]
+        def kron_ovlp_x (bra_sp, ket_sp, x):
+            # Remember: COLUMN-MAJOR ORDER!! Fragment 0 is the fastest-moving index
+            x = x.reshape (list (self.lroots[::-1,ket_sp]) + [nvec,])
+            for ifrag, i in enumerate (self.ints):
+                b, k = i.unique_root[bra_sp], i.unique_root[ket_sp]
+                axis = self.nfrags - ifrag - 1
+                x = np.moveaxis (np.tensordot (i.ovlp[b][k], x, axes=((1),(axis))), 0, axis)
+            x = x * self.spin_shuffle[bra_sp] * self.spin_shuffle[ket_sp]
+            return x.reshape (-1, nvec)
+        for bra_sp, ket_sp in self.exc_null:
+            i0, i1 = self.offs_lroots[bra_sp]
+            j0, j1 = self.offs_lroots[ket_sp]
+            fac = 1.0 / (1 + int (bra_sp==ket_sp))
+            self.ox[i0:i1] += fac * kron_ovlp_x (bra_sp, ket_sp, self.x[j0:j1])
+            self.ox[j0:j1] += fac * kron_ovlp_x (ket_sp, bra_sp, self.x[i0:i1])
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_o, self.dw_o = self.dt_o + dt, self.dw_o + dw
+        return self._finalize_ox_(is_vec)
+
+    def get_ham_op (self):
+        return sparse_linalg.LinearOperator ([self.nstates,]*2, dtype=self.dtype,
+                                             matvec=self._ham_op, matmat=self._ham_op)
+
+    def get_s2_op (self):
+        return sparse_linalg.LinearOperator ([self.nstates,]*2, dtype=self.dtype,
+                                             matvec=self._s2_op, matmat=self._s2_op)
+
+    def get_ovlp_op (self):
+        return sparse_linalg.LinearOperator ([self.nstates,]*2, dtype=self.dtype,
+                                             matvec=self._ovlp_op, matmat=self._ovlp_op)
+
+    def _umat_diag_(self, diag):
+        # Approximate: neglects the off-diagonal elements of the untransformed operator within
+        # each linearly-equivalent block
+        for ifrag, inti in enumerate (self.ints):
+            for iroot, umat in inti.umat_root.items ():
+                umat = (umat * umat.conj ()).real
+                diag = umat_dot_1frag_(diag, umat, self.lroots, ifrag, iroot, axis=0)
+        return diag
+
+    def get_hdiag (self):
+        '''Diagonal of the Hamiltonian matrix. Exact unless linearly-equivalent rootspaces are
+        present, in which case the off-diagonal elements within the equivalent blocks are
+        neglected in the transformation.'''
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        hdiag = np.zeros (self.nstates, dtype=self.dtype)
+        for bra, ket, ham, s2, inv in self.ham_blocks:
+            for bra_idx, ket_idx, op, o in self._iter_spec_blocks (bra, ket, ham, *inv):
+                idx = bra_idx[:,None,:] == ket_idx[None,:,:]
+                if not np.any (idx): continue
+                ib, ik, im = np.where (idx)
+                np.add.at (hdiag, bra_idx[ib,im], 2 * op[ib,ik] * o[im])
+        hdiag = self._umat_diag_(hdiag)
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
+        return hdiag
+
+    def get_ovlp_diag (self):
+        '''Diagonal of the overlap matrix'''
+        odiag = []
+        for iroot in range (self.nroots):
+            d = np.ones (1, dtype=self.dtype)
+            for i in self.ints[::-1]:
+                r = i.unique_root[iroot]
+                d = np.multiply.outer (d, np.diag (i.ovlp[r][r])).ravel ()
+            odiag.append (d)
+        odiag = np.concatenate (odiag)
+        return self._umat_diag_(odiag)
+
+def gen_contract_op_si_hdiag (las, h1, h2, ci, nelec_frs, soc=0, nlas=None,
+                              _HamS2Ovlp_class=HamS2OvlpOperators, **kwargs):
+    ''' Build Hamiltonian, spin-squared, and overlap matrix-vector product operators in the LAS
+    product state basis, along with the Hamiltonian and overlap diagonals, without building any
+    nroots-by-nroots matrix
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        h1 : ndarray of size ncas**2
+            Contains effective 1-electron Hamiltonian amplitudes in second quantization
+        h2 : ndarray of size ncas**4
+            Contains 2-electron Hamiltonian amplitudes in second quantization
+        ci : list of list of ndarrays
+            Contains all CI vectors
+        nelec_frs : ndarray of shape (nfrags,nroots,2)
+            Number of electrons of each spin in each rootspace in each
+            fragment
+
+    Kwargs:
+        soc : integer
+            Order of spin-orbit coupling included in the Hamiltonian
+        nlas : sequence of length (nfrags)
+            Number of orbitals in each fragment
+        _HamS2Ovlp_class : class
+            The main intermediate class
+
+    Returns:
+        ham_op : LinearOperator of shape (nstates,nstates)
+            Hamiltonian in LAS product state basis
+        s2_op : LinearOperator of shape (nstates,nstates)
+            Spin-squared operator in LAS product state basis
+        ovlp_op : LinearOperator of shape (nstates,nstates)
+            Overlap matrix of LAS product states
+        hdiag : ndarray of shape (nstates,)
+            Diagonal element of Hamiltonian matrix
+        odiag : ndarray of shape (nstates,)
+            Diagonal element of overlap matrix
+    '''
+    log = lib.logger.new_logger (las, las.verbose)
+    if nlas is None: nlas = las.ncas_sub
+    max_memory = getattr (las, 'max_memory', las.mol.max_memory)
+    dtype = h1.dtype
+    if soc>1: raise NotImplementedError ("Spin-orbit coupling of second order")
+
+    # Handle possible SOC
+    spin_pure, h1, h2, ci, nelec_frs, nlas, spin_shuffle_fac = soc_context (
+        h1, h2, ci, nelec_frs, soc, nlas)
+
+    # First pass: single-fragment intermediates
+    hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas,
+                                                  use_cache=spin_pure)
+
+    # Second pass: upper-triangle
+    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    outerprod = _HamS2Ovlp_class (ints, nlas, hopping_index, lroots, h1, h2, dtype=dtype,
+                                  max_memory=max_memory, log=log)
+    if soc and not spin_pure:
+        outerprod.spin_shuffle = spin_shuffle_fac
+    lib.logger.timer (las, 'LASSI Hamiltonian second intermediate indexing setup', *t0)
+    outerprod, t0 = outerprod.kernel ()
+    lib.logger.timer (las, 'LASSI Hamiltonian second intermediate crunching', *t0)
+    hdiag = outerprod.get_hdiag ()
+    odiag = outerprod.get_ovlp_diag ()
+    ham_op = outerprod.get_ham_op ()
+    s2_op = outerprod.get_s2_op ()
+    ovlp_op = outerprod.get_ovlp_op ()
+    return ham_op, s2_op, ovlp_op, hdiag, odiag
+
@@ -21,6 +21,9 @@ class FragTDMInt (frag.FragTDMInt):
     are fastest-moving, since RDMs require contracting over these indices
     '''
 
+    # Cached instances of the parent class can be recast to this class
+    _layout_of = frag.FragTDMInt
+
     def setmanip (self, x):
         x = np.ascontiguousarray (np.moveaxis (x, [0,1], [-2,-1]))
         return np.moveaxis (x, [-2,-1], [0,1])
@@ -37,7 +40,6 @@ class LRRDM (stdm.LSTDM):
         si : ndarray of shape (nroots,nroots_si)
             Contains LASSI eigenvectors
     '''
-    # TODO: at some point, if it ever becomes rate-limiting, make this multithread better
     # TODO: SO-LASSI o1 implementation: these density matrices can only be defined in the full
     # spinorbital basis
 
@@ -48,6 +50,16 @@ class LRRDM (stdm.LSTDM):
                                 mask_ket_space=mask_ket_space,
                                 log=log, max_memory=max_memory,
                                 dtype=dtype)
+        self.set_si_(si)
+
+    def set_si_(self, si):
+        '''Replace the SI vectors, keeping the excitation index and the fragment intermediates,
+        so that the same instance can be reused for several batches of LASSI states.
+
+        Args:
+            si : ndarray of shape (nroots,nroots_si)
+                Contains LASSI eigenvectors
+        '''
         self.nroots_si = si.shape[-1]
         self.si = si.copy ()
         self._umat_linequiv_loop_(self.si)
@@ -55,10 +67,23 @@ class LRRDM (stdm.LSTDM):
         self._si_c = c_arr (self.si)
         self._si_c_nrow = c_int (self.si.shape[0])
         self._si_c_ncol = c_int (self.si.shape[1])
-        self.d1buf = self.d1 = np.empty ((self.nroots_si,self.d1.size), dtype=self.d1.dtype)
-        self.d2buf = self.d2 = np.empty ((self.nroots_si,self.d2.size), dtype=self.d2.dtype)
+        d1size, d2size = self.d1.shape[-1], self.d2.shape[-1]
+        if self.d1.shape != (self.nroots_si, d1size):
+            self.d1 = np.empty ((self.nroots_si,d1size), dtype=self.d1.dtype)
+        if self.d2.shape != (self.nroots_si, d2size):
+            self.d2 = np.empty ((self.nroots_si,d2size), dtype=self.d2.dtype)
+        self.d1buf, self.d2buf = self.d1, self.d2
         self._d1buf_c = c_arr (self.d1buf)
         self._d2buf_c = c_arr (self.d2buf)
+        return self
+
+    def _get_crunch_worker (self):
+        worker = super ()._get_crunch_worker ()
+        worker.d1buf = worker.d1
+        worker.d2buf = worker.d2
+        worker._d1buf_c = c_arr (worker.d1buf)
+        worker._d2buf_c = c_arr (worker.d2buf)
+        return worker
 
     def _add_transpose_(self):
         self.rdm1s += self.rdm1s.conj ().transpose (0,1,3,2)
@@ -502,18 +527,20 @@ class LRRDM (stdm.LSTDM):
     def _put_D1_(self):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
         fn = self._put_SD1_c_fn
-        fn (self._rdm1s_c, self._d1buf_c,
-            self._si_c_ncol, self._norb_c, self._nsrc_c,
-            self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
+        with self._put_lock:
+            fn (self._rdm1s_c, self._d1buf_c,
+                self._si_c_ncol, self._norb_c, self._nsrc_c,
+                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
     def _put_D2_(self):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
         fn = self._put_SD2_c_fn
-        fn (self._rdm2s_c, self._d2buf_c,
-            self._si_c_ncol, self._norb_c, self._nsrc_c, self._pdest,
-            self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
+        with self._put_lock:
+            fn (self._rdm2s_c, self._d2buf_c,
+                self._si_c_ncol, self._norb_c, self._nsrc_c, self._pdest,
+                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
@@ -600,8 +627,17 @@ def get_fdm1_maker (las, ci, nelec_frs, si, **kwargs):
         return fdm
     return make_fdm1
 
-def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
-    ''' Build spin-separated LASSI 1- and 2-body reduced density matrices
+def get_rdm12s_batch_size (las, ncas, dtype, nroots_si, max_memory=None):
+    ''' Number of LASSI states whose 1- and 2-RDMs can be held in memory at once '''
+    if max_memory is None: max_memory = getattr (las, 'max_memory', las.mol.max_memory)
+    # Output arrays plus their copies in the PySCF index convention
+    mem_per_state = 2*np.dtype (dtype).itemsize*(2*(ncas**2)+4*(ncas**4))/1e6
+    mem_avail = max_memory - lib.current_memory ()[0]
+    return max (0, min (nroots_si, int (mem_avail / mem_per_state)))
+
+def iter_roots_make_rdm12s (las, ci, nelec_frs, si, batch_size=None, **kwargs):
+    ''' Generate spin-separated LASSI 1- and 2-body reduced density matrices in batches of
+    columns of si. The single-fragment intermediates are built only once.
 
     Args:
         las : instance of :class:`LASCINoSymm`
@@ -613,10 +649,17 @@ def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
         si : ndarray of shape (nroots,nroots_si)
             Contains LASSI eigenvectors
 
-    Returns:
-        rdm1s : ndarray of shape (nroots_si,2,ncas,ncas)
+    Kwargs:
+        batch_size : integer
+            Number of columns of si processed at once. Defaults to as many as fit in
+            las.max_memory.
+
+    Yields:
+        cols : ndarray of shape (nbatch,)
+            Column indices of si in this batch
+        rdm1s : ndarray of shape (nbatch,2,ncas,ncas)
             Spin-separated 1-body reduced density matrices of LASSI states
-        rdm2s : ndarray of shape (nroots_si,2,ncas,ncas,2,ncas,ncas)
+        rdm2s : ndarray of shape (nbatch,2,ncas,ncas,2,ncas,ncas)
             Spin-separated 2-body reduced density matrices of LASSI states
     '''
     log = lib.logger.new_logger (las, las.verbose)
@@ -632,6 +675,7 @@ def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
     # Handle possible SOC
     nelec_rs = [tuple (x) for x in nelec_frs.sum (0)]
     spin_pure = len (set (nelec_rs)) == 1
+    ix = None
     if not spin_pure: # Engage the ``spinless mapping''
         ci = ci_map2spinless (ci, nlas, nelec_frs)
         ix = spin_shuffle_idx (nlas)
@@ -644,27 +688,45 @@ def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
 
     # First pass: single-fragment intermediates
     hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas,
+                                                  use_cache=spin_pure,
                                                   _FragTDMInt_class=FragTDMInt)
     nstates = np.sum (np.prod (lroots, axis=0))
     
     # Memory check
+    if batch_size is None:
+        batch_size = get_rdm12s_batch_size (las, ncas, dtype, nroots_si, max_memory=max_memory)
+        batch_size = max (1, batch_size)
+    batch_size = min (batch_size, nroots_si)
     current_memory = lib.current_memory ()[0]
-    required_memory = dtype.itemsize*nroots_si*(2*(ncas**2)+4*(ncas**4))/1e6
+    required_memory = dtype.itemsize*batch_size*(2*(ncas**2)+4*(ncas**4))/1e6
     if current_memory + required_memory > max_memory:
         raise MemoryError ("current: {}; required: {}; max: {}".format (
             current_memory, required_memory, max_memory))
+    log.debug ('LASSI root RDM12s: %d of %d states at a time', batch_size, nroots_si)
 
-    # Second pass: upper-triangle
+    # Second pass: upper-triangle. The excitation index is built once; only si changes
+    # between batches.
     t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
-    outerprod = LRRDM (ints, nlas, hopping_index, lroots, si, dtype=dtype,
-                          max_memory=max_memory, log=log)
+    outerprod = LRRDM (ints, nlas, hopping_index, lroots, si[:,:batch_size], dtype=dtype,
+                       max_memory=max_memory, log=log)
     if not spin_pure:
         outerprod.spin_shuffle = spin_shuffle_fac
     lib.logger.timer (las, 'LASSI root RDM12s second intermediate indexing setup', *t0)
-    rdm1s, rdm2s, t0 = outerprod.kernel ()
-    lib.logger.timer (las, 'LASSI root RDM12s second intermediate crunching', *t0)
-    if las.verbose >= lib.logger.TIMER_LEVEL:
-        lib.logger.info (las, 'LASSI root RDM12s crunching profile:\n%s', outerprod.sprint_profile ())
+
+    for p0 in range (0, nroots_si, batch_size):
+        p1 = min (p0+batch_size, nroots_si)
+        if p0 > 0: outerprod.set_si_(si[:,p0:p1])
+        rdm1s, rdm2s, t0 = outerprod.kernel ()
+        lib.logger.timer (las, 'LASSI root RDM12s second intermediate crunching', *t0)
+        if las.verbose >= lib.logger.TIMER_LEVEL:
+            lib.logger.info (las, 'LASSI root RDM12s crunching profile:\n%s',
+                             outerprod.sprint_profile ())
+        outerprod.rdm1s = outerprod.rdm2s = None
+        rdm1s, rdm2s = _rdm12s_pyscf_convention (rdm1s, rdm2s, spin_pure, ncas, ix=ix)
+        yield np.arange (p0, p1), rdm1s, rdm2s
+
+def _rdm12s_pyscf_convention (rdm1s, rdm2s, spin_pure, ncas, ix=None):
+    nroots_si = rdm1s.shape[0]
 
     # Clean up the ``spinless mapping''
     if not spin_pure:
@@ -688,6 +750,28 @@ def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
 
     return rdm1s, rdm2s
 
+def roots_make_rdm12s (las, ci, nelec_frs, si, **kwargs):
+    ''' Build spin-separated LASSI 1- and 2-body reduced density matrices
 
-        
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        ci : list of list of ndarrays
+            Contains all CI vectors
+        nelec_frs : ndarray of shape (nfrags,nroots,2)
+            Number of electrons of each spin in each rootspace in each
+            fragment
+        si : ndarray of shape (nroots,nroots_si)
+            Contains LASSI eigenvectors
 
+    Returns:
+        rdm1s : ndarray of shape (nroots_si,2,ncas,ncas)
+            Spin-separated 1-body reduced density matrices of LASSI states
+        rdm2s : ndarray of shape (nroots_si,2,ncas,ncas,2,ncas,ncas)
+            Spin-separated 2-body reduced density matrices of LASSI states
+    '''
+    gen = iter_roots_make_rdm12s (las, ci, nelec_frs, si, batch_size=si.shape[-1], **kwargs)
+    cols, rdm1s, rdm2s = next (gen)
+    return rdm1s, rdm2s
+
+
+        
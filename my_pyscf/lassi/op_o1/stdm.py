@@ -1,7 +1,11 @@
+import copy
+import threading
 import numpy as np
 from pyscf import lib
 from pyscf.lib import logger
+from pyscf import __config__
 from itertools import product
+from concurrent.futures import ThreadPoolExecutor
 from mrh.my_pyscf.lassi.citools import get_rootaddr_fragaddr, umat_dot_1frag_
 from mrh.my_pyscf.lassi.op_o1 import frag
 from mrh.my_pyscf.lassi.op_o1.utilities import *
@@ -13,6 +17,16 @@ liblassi = load_library ('liblassi')
 def c_arr (arr): return arr.ctypes.data_as(ctypes.c_void_p)
 c_int = ctypes.c_int
 
+# Maximum number of threads among which the rows of the excitation tables are distributed by
+# _crunch_all_. None means lib.num_threads (). Opt-in, because the crunching is mostly
+# GIL-bound Python and the accumulation is serialized, while the OpenMP threads of the C
+# kernels are divided among the threads.
+CRUNCH_NTHREADS = getattr (__config__, 'lassi_op_o1_crunch_nthreads', 1)
+
+# Maximum memory in MB of the TDMs of the many pairs of model states which are crunched at once
+# by each call to a cruncher function (see _loop_lroots_)
+CRUNCH_BATCH_MAX_MEMORY = getattr (__config__, 'lassi_op_o1_crunch_batch_max_memory', 200)
+
 def mask_exc_table (exc, col=0, mask_space=None):
     if mask_space is None: return np.ones (exc.shape[0], dtype=bool)
     mask_space = np.asarray (mask_space)
@@ -67,12 +81,22 @@ class LSTDM (object):
                 computed.
             dtype : instance of np.dtype
                 Currently not used; TODO: generalize to ms-broken fragment-local states?
+
+        The rows of the excitation tables are distributed among up to `crunch_nthreads` threads
+        (default: CRUNCH_NTHREADS = 1; None means lib.num_threads ()), each of which crunches with a shallow copy of this object
+        with its own d1 and d2 buffers, as many as max_memory permits. The OpenMP threads are
+        divided among them. Accumulation into the shared output arrays is serialized by
+        `_put_lock`, so subclasses which write to output arrays must do so under that lock.
+
+        Within each row, the cruncher functions build the TDMs of all pairs of model states in the
+        outer product of ranges of bra and ket states at once, as stacks no larger than
+        `crunch_batch_max_memory` MB (default: CRUNCH_BATCH_MAX_MEMORY), which are added to the
+        output arrays with one C call per row and range.
         '''
     # TODO: SO-LASSI o1 implementation: a SOMF implementation using spin-pure LAS product states
     # states as a basis requires the sz-breaking sector of the 1-body stdm1 to be added here. I.E.,
     # in addition to the interactions listed above, we also need "sm" (total spin lowering; ap'bq)
     # (N.B.: "sp" is just the adjoint of "sm"). 
-    # TODO: at some point, if it ever becomes rate-limiting, make this multithread better
 
     def __init__(self, ints, nlas, hopping_index, lroots, mask_bra_space=None, mask_ket_space=None,
                  log=None, max_memory=2000, dtype=np.float64):
@@ -107,7 +131,12 @@ class LSTDM (object):
                              for nelec_sf in self.nelec_rf]
         self.nelec_rf = self.nelec_rf.sum (1)
 
-        exc = self.make_exc_tables (hopping_index)
+        # make_ints may provide storage for the excitation tables via a tag on hopping_index
+        exc = getattr (hopping_index, 'exc_tables', None)
+        if not exc:
+            exc_tables = exc
+            exc = self.make_exc_tables (hopping_index)
+            if exc_tables is not None: exc_tables.update (exc)
         self.nonuniq_exc = {}
         self.exc_null = self.mask_exc_table_(exc['null'], 'null', mask_bra_space, mask_ket_space)
         self.exc_1d = self.mask_exc_table_(exc['1d'], '1d', mask_bra_space, mask_ket_space)
@@ -126,13 +155,22 @@ class LSTDM (object):
         self._norb_c = c_int (self.norb)
         self._orbidx = np.ones (self.norb, dtype=bool)
 
+        # threading
+        self.crunch_nthreads = CRUNCH_NTHREADS
+        self.crunch_batch_max_memory = CRUNCH_BATCH_MAX_MEMORY
+        self._put_lock = threading.Lock ()
+
         # C fns
         if self.dtype==np.float64:
             self._put_SD1_c_fn = liblassi.LASSIRDMdputSD1
             self._put_SD2_c_fn = liblassi.LASSIRDMdputSD2
+            self._scatter_SD1_c_fn = liblassi.LASSIRDMdscatterSD1
+            self._scatter_SD2_c_fn = liblassi.LASSIRDMdscatterSD2
         elif self.dtype==np.complex128:
             self._put_SD1_c_fn = liblassi.LASSIRDMzputSD1
             self._put_SD2_c_fn = liblassi.LASSIRDMzputSD2
+            self._scatter_SD1_c_fn = liblassi.LASSIRDMzscatterSD1
+            self._scatter_SD2_c_fn = liblassi.LASSIRDMzscatterSD2
         else:
             raise NotImplementedError (self.dtype)
 
@@ -326,6 +364,9 @@ class LSTDM (object):
 
     all_interactions_full_square = False
     interaction_has_spin = ('_1c_', '_1c1d_', '_2c_')
+    # The cruncher functions of this class accept arrays of bra and ket model states. Subclasses
+    # whose cruncher functions accept one pair of model states at a time set this to False.
+    crunch_lroots_batched = True
 
     def mask_exc_table_(self, exc, lbl, mask_bra_space=None, mask_ket_space=None):
         # Part 1: restrict to the caller-specified rectangle
@@ -506,6 +547,58 @@ class LSTDM (object):
         self.dt_g, self.dw_g = self.dt_g + dt, self.dw_g + dw
         return bra_rng, ket_rng, facs
 
+    def _get_spec_addr_ovlp_rng (self, bra_rng, ket_rng, *inv):
+        '''Vectorized version of _get_spec_addr_ovlp for all pairs of model states in the
+        outer product of bra_rng and ket_rng, which must all belong to the rootspaces for which
+        the cache was prepared by _prepare_spec_addr_ovlp_.
+
+        Args:
+            bra_rng: ndarray of integers
+                Indices of model states
+            ket_rng: ndarray of integers
+                Indices of model states
+            *inv: integers
+                Indices of nonspectator fragments.
+
+        Returns:
+            bra_spec: ndarray of integers
+                Indices of model states in which fragments *inv have the same state as a member of
+                bra_rng
+            ket_spec: ndarray of integers
+                Indices of model states in which fragments *inv have the same state as a member of
+                ket_rng
+            facs: ndarray of floats
+                Overlap * permutation factors (cf. get_ovlp_fac) corresponding to the interactions
+                bra_spec, ket_spec.
+            ix: ndarray of integers
+                Index of the pair in the (flattened) outer product of bra_rng and ket_rng to which
+                each element of bra_spec, ket_spec, facs corresponds
+        '''
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        nbra, nket = len (bra_rng), len (ket_rng)
+        ix = np.arange (nbra*nket).reshape (nbra, nket, 1)
+        braenv = self.envaddr[bra_rng]
+        ketenv = self.envaddr[ket_rng]
+        bra_spec = []
+        ket_spec = []
+        facs = []
+        ixs = []
+        for (rbra1, rket1, b, k, o) in self._spec_addr_ovlp_cache:
+            dbra = np.dot (braenv, self.strides[rbra1])
+            dket = np.dot (ketenv, self.strides[rket1])
+            shape = (nbra, nket, len (o))
+            bra_spec.append (np.broadcast_to (dbra[:,None,None] + b[None,None,:], shape).ravel ())
+            ket_spec.append (np.broadcast_to (dket[None,:,None] + k[None,None,:], shape).ravel ())
+            facs.append (np.broadcast_to (o[None,None,:], shape).ravel ())
+            ixs.append (np.broadcast_to (ix, shape).ravel ())
+        bra_spec = np.concatenate (bra_spec)
+        ket_spec = np.concatenate (ket_spec)
+        facs = np.concatenate (facs)
+        ixs = np.concatenate (ixs)
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_g, self.dw_g = self.dt_g + dt, self.dw_g + dw
+        return bra_spec, ket_spec, facs, ixs
+
     def _get_spec_addr_ovlp_1space (self, rbra, rket, *inv):
         '''Obtain the integer indices and overlap*permutation factors for all pairs of model states
         in the same rootspaces as bra, ket for which a specified list of nonspectator fragments are
@@ -562,63 +655,111 @@ class LSTDM (object):
         self.d2[:] = 0.0
         return self.d2
 
+    def _get_D1_lroots (self, bra, ket):
+        return np.zeros ((len (bra)*len (ket),) + self.d1.shape, dtype=self.dtype)
+
+    def _get_D2_lroots (self, bra, ket):
+        return np.zeros ((len (bra)*len (ket),) + self.d2.shape, dtype=self.dtype)
+
+    def _get_frag_lroots (self, i, getter, bra, ket, *args):
+        '''Stack a fragment-local intermediate over all pairs of model states in the outer product
+        of bra and ket.
+
+        Args:
+            i: integer
+                Index of a fragment
+            getter: string
+                Name of the rootspace-pair getter method of FragTDMInt (e.g., 'get_p')
+            bra: ndarray of integers
+                Indices of model states in a single rootspace
+            ket: ndarray of integers
+                Indices of model states in a single rootspace
+            *args: integers
+                Additional arguments of getter (i.e., spin)
+
+        Returns:
+            x: ndarray of shape (len (bra)*len (ket),) + intermediate shape
+        '''
+        inti = self.ints[i]
+        rbra, rket = self.rootaddr[bra[0]], self.rootaddr[ket[0]]
+        x = getattr (inti, getter) (rbra, rket, *args)
+        x = x[np.ix_(inti.fragaddr[bra], inti.fragaddr[ket])]
+        return x.reshape ((-1,) + x.shape[2:])
+
     def _put_D1_(self, bra, ket, D1, *inv):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        bra1, ket1, wgt = self._get_spec_addr_ovlp (bra, ket, *inv)
-        self._put_SD1_(bra1, ket1, D1, wgt)
+        bra1, ket1, wgt, ix = self._get_spec_addr_ovlp_rng (bra, ket, *inv)
+        self._put_SD1_(bra1, ket1, D1, wgt, ix)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
-    def _put_SD1_(self, bra, ket, D1, wgt):
+    def _put_SD1_(self, bra, ket, D1, wgt, ix):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
         #idx = self._orbidx
         #idx = np.ix_([True,]*2,idx,idx)
-        #for b, k, w in zip (bra, ket, wgt):
-        fn = self._put_SD1_c_fn
-        c_one = c_int (1)
-        for b, k, w in zip (bra, ket, wgt):
-            D1w = D1 * w
-            fn (c_arr (self.tdm1s[b,k]), c_arr (D1w),
-                c_one, self._norb_c, self._nsrc_c,
-                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
-        #    self.tdm1s[b,k][idx] += np.multiply.outer (w, D1)
+        #for b, k, w, i in zip (bra, ket, wgt, ix):
+        #    self.tdm1s[b,k][idx] += np.multiply.outer (w, D1[i])
+        self._scatter_SD1_(self.tdm1s, bra, ket, D1, wgt, ix)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_s, self.dw_s = self.dt_s + dt, self.dw_s + dw
 
+    def _scatter_SD1_(self, tdm1s, bra, ket, D1, wgt, ix):
+        '''tdm1s[bra[i],ket[i]] += wgt[i] * D1[ix[i]] for all i, in one C call'''
+        fn = self._scatter_SD1_c_fn
+        bra = np.ascontiguousarray (bra, dtype=np.int64)
+        ket = np.ascontiguousarray (ket, dtype=np.int64)
+        ix = np.ascontiguousarray (ix, dtype=np.int64)
+        wgt = np.ascontiguousarray (wgt, dtype=self.dtype)
+        D1 = np.ascontiguousarray (D1)
+        with self._put_lock:
+            fn (c_arr (tdm1s), c_arr (D1), c_arr (wgt),
+                c_arr (bra), c_arr (ket), c_arr (ix), c_int (len (wgt)), c_int (tdm1s.shape[1]),
+                self._norb_c, self._nsrc_c,
+                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
+
     def _put_D2_(self, bra, ket, D2, *inv):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        bra1, ket1, wgt = self._get_spec_addr_ovlp (bra, ket, *inv)
-        self._put_SD2_(bra1, ket1, D2, wgt)
+        bra1, ket1, wgt, ix = self._get_spec_addr_ovlp_rng (bra, ket, *inv)
+        self._put_SD2_(bra1, ket1, D2, wgt, ix)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_p, self.dw_p = self.dt_p + dt, self.dw_p + dw
 
-    def _put_SD2_(self, bra, ket, D2, wgt):
+    def _put_SD2_(self, bra, ket, D2, wgt, ix):
         t0, w0 = logger.process_clock (), logger.perf_counter ()
         #idx = self._orbidx
         #idx = np.ix_([True,]*4,idx,idx,idx,idx)
-        #for b, k, w in zip (bra, ket, wgt):
-        #    self.tdm2s[b,k][idx] += np.multiply.outer (w, D2)
-        fn = self._put_SD2_c_fn
-        c_one = c_int (1)
-        for b, k, w in zip (bra, ket, wgt):
-            D2w = D2 * w
-            fn (c_arr (self.tdm2s[b,k]), c_arr (D2w),
-                c_one, self._norb_c, self._nsrc_c, self._pdest,
-                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
+        #for b, k, w, i in zip (bra, ket, wgt, ix):
+        #    self.tdm2s[b,k][idx] += np.multiply.outer (w, D2[i])
+        self._scatter_SD2_(self.tdm2s, bra, ket, D2, wgt, ix)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_s, self.dw_s = self.dt_s + dt, self.dw_s + dw
 
+    def _scatter_SD2_(self, tdm2s, bra, ket, D2, wgt, ix):
+        '''tdm2s[bra[i],ket[i]] += wgt[i] * D2[ix[i]] for all i, in one C call'''
+        fn = self._scatter_SD2_c_fn
+        bra = np.ascontiguousarray (bra, dtype=np.int64)
+        ket = np.ascontiguousarray (ket, dtype=np.int64)
+        ix = np.ascontiguousarray (ix, dtype=np.int64)
+        wgt = np.ascontiguousarray (wgt, dtype=self.dtype)
+        D2 = np.ascontiguousarray (D2)
+        with self._put_lock:
+            fn (c_arr (tdm2s), c_arr (D2), c_arr (wgt),
+                c_arr (bra), c_arr (ket), c_arr (ix), c_int (len (wgt)), c_int (tdm2s.shape[1]),
+                self._norb_c, self._nsrc_c, self._pdest,
+                self._dblk_idx, self._sblk_idx, self._lblk, self._nblk)
+
     # Cruncher functions
+    # The arguments bra and ket are arrays of model states in a single rootspace each (see
+    # _loop_lroots_), and the TDMs of all pairs in their outer product are built at once, stacked
+    # along a leading axis.
     def _crunch_1d_(self, bra, ket, i):
         '''Compute a single-fragment density fluctuation, for both the 1- and 2-RDMs.'''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d1 = self._get_D1_(bra, ket)
-        d2 = self._get_D2_(bra, ket)
+        d1 = self._get_D1_lroots (bra, ket)
+        d2 = self._get_D2_lroots (bra, ket)
         p, q = self.get_range (i)
-        inti = self.ints[i]
-        d1_s_ii = inti.get_1_dm1 (bra, ket)
-        d1[:,p:q,p:q] = np.asarray (d1_s_ii)
-        d2[:,p:q,p:q,p:q,p:q] = np.asarray (inti.get_1_dm2 (bra, ket))
+        d1[:,:,p:q,p:q] = self._get_frag_lroots (i, 'get_dm1', bra, ket)
+        d2[:,:,p:q,p:q,p:q,p:q] = self._get_frag_lroots (i, 'get_dm2', bra, ket)
         self._put_D1_(bra, ket, d1, i)
         self._put_D2_(bra, ket, d2, i)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
@@ -627,19 +768,18 @@ class LSTDM (object):
     def _crunch_2d_(self, bra, ket, i, j):
         '''Compute a two-fragment density fluctuation.'''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d2 = self._get_D2_(bra, ket)
-        inti, intj = self.ints[i], self.ints[j]
+        d2 = self._get_D2_lroots (bra, ket)
         p, q = self.get_range (i)
         r, s = self.get_range (j)
-        d1_s_ii = inti.get_1_dm1 (bra, ket)
-        d1_s_jj = intj.get_1_dm1 (bra, ket)
-        d2_s_iijj = np.multiply.outer (d1_s_ii, d1_s_jj).transpose (0,3,1,2,4,5)
-        d2_s_iijj = d2_s_iijj.reshape (4, q-p, q-p, s-r, s-r)
-        d2[:,p:q,p:q,r:s,r:s] = d2_s_iijj
-        d2[(0,3),r:s,r:s,p:q,p:q] = d2_s_iijj[(0,3),...].transpose (0,3,4,1,2)
-        d2[(1,2),r:s,r:s,p:q,p:q] = d2_s_iijj[(2,1),...].transpose (0,3,4,1,2)
-        d2[(0,3),p:q,r:s,r:s,p:q] = -d2_s_iijj[(0,3),...].transpose (0,1,4,3,2)
-        d2[(0,3),r:s,p:q,p:q,r:s] = -d2_s_iijj[(0,3),...].transpose (0,3,2,1,4)
+        d1_s_ii = self._get_frag_lroots (i, 'get_dm1', bra, ket)
+        d1_s_jj = self._get_frag_lroots (j, 'get_dm1', bra, ket)
+        d2_s_iijj = np.einsum ('xapq,xbrs->xabpqrs', d1_s_ii, d1_s_jj)
+        d2_s_iijj = d2_s_iijj.reshape (-1, 4, q-p, q-p, s-r, s-r)
+        d2[:,:,p:q,p:q,r:s,r:s] = d2_s_iijj
+        d2[:,(0,3),r:s,r:s,p:q,p:q] = d2_s_iijj[:,(0,3),...].transpose (0,1,4,5,2,3)
+        d2[:,(1,2),r:s,r:s,p:q,p:q] = d2_s_iijj[:,(2,1),...].transpose (0,1,4,5,2,3)
+        d2[:,(0,3),p:q,r:s,r:s,p:q] = -d2_s_iijj[:,(0,3),...].transpose (0,1,2,5,4,3)
+        d2[:,(0,3),r:s,p:q,p:q,r:s] = -d2_s_iijj[:,(0,3),...].transpose (0,1,4,3,2,5)
         self._put_D2_(bra, ket, d2, i, j)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_2d, self.dw_2d = self.dt_2d + dt, self.dw_2d + dw
@@ -656,36 +796,35 @@ class LSTDM (object):
         and conjugate transpose
         '''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d1 = self._get_D1_(bra, ket)
-        d2 = self._get_D2_(bra, ket)
-        inti, intj = self.ints[i], self.ints[j]
+        d1 = self._get_D1_lroots (bra, ket)
+        d2 = self._get_D2_lroots (bra, ket)
         p, q = self.get_range (i)
         r, s = self.get_range (j)
         fac = 1
-        nelec_f_bra = self.nelec_rf[self.rootaddr[bra]]
-        nelec_f_ket = self.nelec_rf[self.rootaddr[ket]]
+        nelec_f_bra = self.nelec_rf[self.rootaddr[bra[0]]]
+        nelec_f_ket = self.nelec_rf[self.rootaddr[ket[0]]]
         fac *= fermion_des_shuffle (nelec_f_bra, (i, j), i)
         fac *= fermion_des_shuffle (nelec_f_ket, (i, j), j)
-        d1_ij = np.multiply.outer (self.ints[i].get_1_p (bra, ket, s1),
-                                   self.ints[j].get_1_h (bra, ket, s1))
-        d1[s1,p:q,r:s] = fac * d1_ij
+        p_i = self._get_frag_lroots (i, 'get_p', bra, ket, s1)
+        h_j = self._get_frag_lroots (j, 'get_h', bra, ket, s1)
+        d1[:,s1,p:q,r:s] = fac * np.einsum ('xp,xq->xpq', p_i, h_j)
         s12l = s1 * 2   # aa: 0 OR ba: 2
         s12h = s12l + 1 # ab: 1 OR bb: 3 
         s21l = s1       # aa: 0 OR ab: 1
         s21h = s21l + 2 # ba: 2 OR bb: 3
         s1s1 = s1 * 3   # aa: 0 OR bb: 3
         def _crunch_1c_tdm2 (d2_ijkk, i0, i1, j0, j1, k0, k1):
-            d2[(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
-            d2[(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,3,4,1,2)
-            d2[s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[s1,...].transpose (0,3,2,1)
-            d2[s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[s1,...].transpose (2,1,0,3)
+            d2[:,(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
+            d2[:,(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,1,4,5,2,3)
+            d2[:,s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[:,s1,...].transpose (0,1,4,3,2)
+            d2[:,s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[:,s1,...].transpose (0,3,2,1,4)
         # pph (transpose from Dirac order to Mulliken order)
-        d2_ijii = fac * np.multiply.outer (self.ints[i].get_1_pph (bra,ket,s1),
-                                           self.ints[j].get_1_h (bra,ket,s1)).transpose (0,1,4,2,3)
+        pph_i = self._get_frag_lroots (i, 'get_pph', bra, ket, s1)
+        d2_ijii = fac * np.einsum ('xspab,xq->xspqab', pph_i, h_j)
         _crunch_1c_tdm2 (d2_ijii, p, q, r, s, p, q)
         # phh (transpose to bring spin to outside and then from Dirac order to Mulliken order)
-        d2_ijjj = fac * np.multiply.outer (self.ints[i].get_1_p (bra,ket,s1),
-                                           self.ints[j].get_1_phh (bra,ket,s1)).transpose (1,0,4,2,3)
+        phh_j = self._get_frag_lroots (j, 'get_phh', bra, ket, s1)
+        d2_ijjj = fac * np.einsum ('xp,xsabq->xspqab', p_i, phh_j)
         _crunch_1c_tdm2 (d2_ijjj, p, q, r, s, r, s)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_1c, self.dw_1c = self.dt_1c + dt, self.dw_1c + dw
@@ -696,14 +835,13 @@ class LSTDM (object):
         '''Compute the reduced density matrix elements of a coupled electron-hop and
         density fluctuation.'''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d2 = self._get_D2_(bra, ket)
-        inti, intj, intk = self.ints[i], self.ints[j], self.ints[k]
+        d2 = self._get_D2_lroots (bra, ket)
         p, q = self.get_range (i)
         r, s = self.get_range (j)
         t, u = self.get_range (k)
         fac = 1
-        nelec_f_bra = self.nelec_rf[self.rootaddr[bra]]
-        nelec_f_ket = self.nelec_rf[self.rootaddr[ket]]
+        nelec_f_bra = self.nelec_rf[self.rootaddr[bra[0]]]
+        nelec_f_ket = self.nelec_rf[self.rootaddr[ket[0]]]
         fac *= fermion_des_shuffle (nelec_f_bra, (i, j, k), i)
         fac *= fermion_des_shuffle (nelec_f_ket, (i, j, k), j)
         s12l = s1 * 2   # aa: 0 OR ba: 2
@@ -712,14 +850,14 @@ class LSTDM (object):
         s21h = s21l + 2 # ba: 2 OR bb: 3
         s1s1 = s1 * 3   # aa: 0 OR bb: 3
         def _crunch_1c_tdm2 (d2_ijkk, i0, i1, j0, j1, k0, k1):
-            d2[(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
-            d2[(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,3,4,1,2)
-            d2[s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[s1,...].transpose (0,3,2,1)
-            d2[s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[s1,...].transpose (2,1,0,3)
-        d1_ij = np.multiply.outer (self.ints[i].get_1_p (bra, ket, s1),
-                                   self.ints[j].get_1_h (bra, ket, s1))
-        d1_skk = self.ints[k].get_1_dm1 (bra, ket)
-        d2_ijkk = fac * np.multiply.outer (d1_ij, d1_skk).transpose (2,0,1,3,4)
+            d2[:,(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
+            d2[:,(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,1,4,5,2,3)
+            d2[:,s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[:,s1,...].transpose (0,1,4,3,2)
+            d2[:,s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[:,s1,...].transpose (0,3,2,1,4)
+        p_i = self._get_frag_lroots (i, 'get_p', bra, ket, s1)
+        h_j = self._get_frag_lroots (j, 'get_h', bra, ket, s1)
+        d1_skk = self._get_frag_lroots (k, 'get_dm1', bra, ket)
+        d2_ijkk = fac * np.einsum ('xp,xq,xsab->xspqab', p_i, h_j, d1_skk)
         _crunch_1c_tdm2 (d2_ijkk, p, q, r, s, t, u)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_1c1d, self.dw_1c1d = self.dt_1c1d + dt, self.dw_1c1d + dw
@@ -738,14 +876,15 @@ class LSTDM (object):
         and conjugate transpose
         '''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d2 = self._get_D2_(bra, ket) # aa, ab, ba, bb -> 0, 1, 2, 3
+        d2 = self._get_D2_lroots (bra, ket) # aa, ab, ba, bb -> 0, 1, 2, 3
         p, q = self.get_range (i)
         r, s = self.get_range (j)
         fac = -1
-        d2_spsm = fac * np.multiply.outer (self.ints[i].get_1_sp (bra, ket),
-                                           self.ints[j].get_1_sm (bra, ket))
-        d2[1,p:q,r:s,r:s,p:q] = d2_spsm.transpose (0,3,2,1)
-        d2[2,r:s,p:q,p:q,r:s] = d2_spsm.transpose (2,1,0,3)
+        d2_spsm = fac * np.einsum ('xab,xcd->xabcd',
+                                   self._get_frag_lroots (i, 'get_sp', bra, ket),
+                                   self._get_frag_lroots (j, 'get_sm', bra, ket))
+        d2[:,1,p:q,r:s,r:s,p:q] = d2_spsm.transpose (0,1,4,3,2)
+        d2[:,2,r:s,p:q,p:q,r:s] = d2_spsm.transpose (0,3,2,1,4)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_1s, self.dw_1s = self.dt_1s + dt, self.dw_1s + dw
         self._put_D2_(bra, ket, d2, i, j)
@@ -763,20 +902,22 @@ class LSTDM (object):
         and conjugate transpose
         '''
         t0, w0 = logger.process_clock (), logger.perf_counter ()
-        d2 = self._get_D2_(bra, ket) # aa, ab, ba, bb -> 0, 1, 2, 3
+        d2 = self._get_D2_lroots (bra, ket) # aa, ab, ba, bb -> 0, 1, 2, 3
         p, q = self.get_range (i)
         r, s = self.get_range (j)
         t, u = self.get_range (k)
-        nelec_f_bra = self.nelec_rf[self.rootaddr[bra]]
-        nelec_f_ket = self.nelec_rf[self.rootaddr[ket]]
+        nelec_f_bra = self.nelec_rf[self.rootaddr[bra[0]]]
+        nelec_f_ket = self.nelec_rf[self.rootaddr[ket[0]]]
         fac = -1 # a'bb'a -> a'ab'b sign
         fac *= fermion_des_shuffle (nelec_f_bra, (i, j, k), i)
         fac *= fermion_des_shuffle (nelec_f_ket, (i, j, k), j)
-        sp = np.multiply.outer (self.ints[i].get_1_p (bra, ket, 0), self.ints[j].get_1_h (bra, ket, 1))
-        sm = self.ints[k].get_1_sm (bra, ket)
-        d2_ikkj = fac * np.multiply.outer (sp, sm).transpose (0,3,2,1) # a'bb'a -> a'ab'b transpose
-        d2[1,p:q,t:u,t:u,r:s] = d2_ikkj
-        d2[2,t:u,r:s,p:q,t:u] = d2_ikkj.transpose (2,3,0,1)
+        p_i = self._get_frag_lroots (i, 'get_p', bra, ket, 0)
+        h_j = self._get_frag_lroots (j, 'get_h', bra, ket, 1)
+        sm = self._get_frag_lroots (k, 'get_sm', bra, ket)
+        # a'bb'a -> a'ab'b transpose
+        d2_ikkj = fac * np.einsum ('xp,xq,xab->xpbaq', p_i, h_j, sm)
+        d2[:,1,p:q,t:u,t:u,r:s] = d2_ikkj
+        d2[:,2,t:u,r:s,p:q,t:u] = d2_ikkj.transpose (0,3,4,1,2)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_1s1c, self.dw_1s1c = self.dt_1s1c + dt, self.dw_1s1c + dw
         self._put_D2_(bra, ket, d2, i, j, k)
@@ -814,40 +955,42 @@ class LSTDM (object):
         s2T = (0, 2, 3)[s2lt] # aa, ba, bb -> when you populate the e1 <-> e2 permutation
         s11 = s2 // 2
         s12 = s2 % 2
-        nelec_f_bra = self.nelec_rf[self.rootaddr[bra]]
-        nelec_f_ket = self.nelec_rf[self.rootaddr[ket]]
-        d2 = self._get_D2_(bra, ket)
+        nelec_f_bra = self.nelec_rf[self.rootaddr[bra[0]]]
+        nelec_f_ket = self.nelec_rf[self.rootaddr[ket[0]]]
+        d2 = self._get_D2_lroots (bra, ket)
         fac = 1
         if i == k:
-            pp = self.ints[i].get_1_pp (bra, ket, s2lt)
-            if s2lt != 1: assert (np.all (np.abs (pp + pp.T)) < 1e-8), '{}'.format (
-                np.amax (np.abs (pp + pp.T)))
+            pp = self._get_frag_lroots (i, 'get_pp', bra, ket, s2lt)
+            if s2lt != 1: assert (np.all (np.abs (pp + pp.transpose (0,2,1))) < 1e-8), '{}'.format (
+                np.amax (np.abs (pp + pp.transpose (0,2,1))))
         else:
-            pp = np.multiply.outer (self.ints[i].get_1_p (bra, ket, s11),
-                                    self.ints[k].get_1_p (bra, ket, s12))
+            pp = np.einsum ('xp,xq->xpq',
+                            self._get_frag_lroots (i, 'get_p', bra, ket, s11),
+                            self._get_frag_lroots (k, 'get_p', bra, ket, s12))
             fac *= (1,-1)[int (i>k)]
             fac *= fermion_des_shuffle (nelec_f_bra, (i, j, k, l), i)
             fac *= fermion_des_shuffle (nelec_f_bra, (i, j, k, l), k)
         if j == l:
-            hh = self.ints[j].get_1_hh (bra, ket, s2lt)
-            if s2lt != 1: assert (np.all (np.abs (hh + hh.T)) < 1e-8), '{}'.format (
-                np.amax (np.abs (hh + hh.T)))
+            hh = self._get_frag_lroots (j, 'get_hh', bra, ket, s2lt)
+            if s2lt != 1: assert (np.all (np.abs (hh + hh.transpose (0,2,1))) < 1e-8), '{}'.format (
+                np.amax (np.abs (hh + hh.transpose (0,2,1))))
         else:
-            hh = np.multiply.outer (self.ints[l].get_1_h (bra, ket, s12),
-                                    self.ints[j].get_1_h (bra, ket, s11))
+            hh = np.einsum ('xp,xq->xpq',
+                            self._get_frag_lroots (l, 'get_h', bra, ket, s12),
+                            self._get_frag_lroots (j, 'get_h', bra, ket, s11))
             fac *= (1,-1)[int (j>l)]
             fac *= fermion_des_shuffle (nelec_f_ket, (i, j, k, l), j)
             fac *= fermion_des_shuffle (nelec_f_ket, (i, j, k, l), l)
-        d2_ijkl = fac * np.multiply.outer (pp, hh).transpose (0,3,1,2) # Dirac -> Mulliken transp
+        d2_ijkl = fac * np.einsum ('xpq,xab->xpbqa', pp, hh) # Dirac -> Mulliken transp
         p, q = self.get_range (i)
         r, s = self.get_range (j)
         t, u = self.get_range (k) 
         v, w = self.get_range (l)
-        d2[s2, p:q,r:s,t:u,v:w] = d2_ijkl
-        d2[s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (2,3,0,1)
+        d2[:,s2, p:q,r:s,t:u,v:w] = d2_ijkl
+        d2[:,s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (0,3,4,1,2)
         if s2 == s2T: # same-spin only: exchange happens
-            d2[s2,p:q,v:w,t:u,r:s] = -d2_ijkl.transpose (0,3,2,1)
-            d2[s2,t:u,r:s,p:q,v:w] = -d2_ijkl.transpose (2,1,0,3)
+            d2[:,s2,p:q,v:w,t:u,r:s] = -d2_ijkl.transpose (0,1,4,3,2)
+            d2[:,s2,t:u,r:s,p:q,v:w] = -d2_ijkl.transpose (0,3,2,1,4)
         dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
         self.dt_2c, self.dw_2c = self.dt_2c + dt, self.dw_2c + dw
         self._put_D2_(bra, ket, d2, i, j, k, l)
@@ -919,19 +1062,85 @@ class LSTDM (object):
         bra_rng = self._get_addr_range (row[0], *inv)
         ket_rng = self._get_addr_range (row[1], *inv)
         lrow = [l for l in row]
-        for lrow[0], lrow[1] in product (bra_rng, ket_rng):
+        if not self.crunch_lroots_batched:
+            for lrow[0], lrow[1] in product (bra_rng, ket_rng):
+                _crunch_fn (*lrow)
+            return
+        bblk, kblk = self._get_lroots_blksize (len (bra_rng), len (ket_rng))
+        for b0, k0 in product (range (0, len (bra_rng), bblk), range (0, len (ket_rng), kblk)):
+            lrow[0], lrow[1] = bra_rng[b0:b0+bblk], ket_rng[k0:k0+kblk]
             _crunch_fn (*lrow)
 
+    def _get_lroots_blksize (self, nbra, nket):
+        '''Numbers of bra and ket model states to crunch at once, such that the stacked TDMs and
+        their intermediates fit in crunch_batch_max_memory MB'''
+        mem_pair = 3 * (self.d1.nbytes + self.d2.nbytes) / 1e6
+        mem_avail = min (self.crunch_batch_max_memory,
+                         self.max_memory - lib.current_memory ()[0])
+        npair = max (1, int (mem_avail // mem_pair))
+        bblk = max (1, min (nbra, npair))
+        kblk = max (1, min (nket, npair // bblk))
+        return bblk, kblk
+
+    def _get_crunch_tasks (self):
+        tasks = [('_crunch_1d_', row) for row in self.exc_1d]
+        tasks += [('_crunch_2d_', row) for row in self.exc_2d]
+        tasks += [('_crunch_1c_', row) for row in self.exc_1c]
+        tasks += [('_crunch_1c1d_', row) for row in self.exc_1c1d]
+        tasks += [('_crunch_1s_', row) for row in self.exc_1s]
+        tasks += [('_crunch_1s1c_', row) for row in self.exc_1s1c]
+        tasks += [('_crunch_2c_', row) for row in self.exc_2c]
+        return tasks
+
     def _crunch_all_(self):
-        for row in self.exc_1d: self._crunch_env_(self._crunch_1d_, *row)
-        for row in self.exc_2d: self._crunch_env_(self._crunch_2d_, *row)
-        for row in self.exc_1c: self._crunch_env_(self._crunch_1c_, *row)
-        for row in self.exc_1c1d: self._crunch_env_(self._crunch_1c1d_, *row)
-        for row in self.exc_1s: self._crunch_env_(self._crunch_1s_, *row)
-        for row in self.exc_1s1c: self._crunch_env_(self._crunch_1s1c_, *row)
-        for row in self.exc_2c: self._crunch_env_(self._crunch_2c_, *row)
+        tasks = self._get_crunch_tasks ()
+        nthreads = self._get_crunch_nthreads (len (tasks))
+        if nthreads > 1:
+            self._crunch_tasks_threaded_(tasks, nthreads)
+        else:
+            for fn, row in tasks: self._crunch_env_(getattr (self, fn), *row)
         self._add_transpose_()
 
+    def _get_crunch_nthreads (self, ntasks):
+        nthreads = self.crunch_nthreads
+        if nthreads is None: nthreads = lib.num_threads ()
+        nthreads = min (nthreads, ntasks)
+        if nthreads < 2: return 1
+        mem_worker = (self.d1.nbytes + self.d2.nbytes) / 1e6
+        if self.crunch_lroots_batched: mem_worker += self.crunch_batch_max_memory
+        mem_avail = self.max_memory - lib.current_memory ()[0]
+        return max (1, min (nthreads, int (mem_avail // mem_worker)))
+
+    def _get_crunch_worker (self):
+        '''Get a shallow copy of self which shares the output arrays and the put lock but owns
+        its scratch buffers and profiling counters, for crunching in a separate thread'''
+        worker = copy.copy (self)
+        worker.d1 = np.zeros_like (self.d1)
+        worker.d2 = np.zeros_like (self.d2)
+        worker.init_profiling ()
+        return worker
+
+    def _crunch_tasks_threaded_(self, tasks, nthreads):
+        nthreads_omp = max (1, lib.num_threads () // nthreads)
+        workers = [self._get_crunch_worker () for i in range (nthreads)]
+        task_iter = iter (tasks)
+        task_lock = threading.Lock ()
+        def crunch_worker (worker):
+            with lib.with_omp_threads (nthreads_omp):
+                while True:
+                    with task_lock:
+                        task = next (task_iter, None)
+                    if task is None: break
+                    fn, row = task
+                    worker._crunch_env_(getattr (worker, fn), *row)
+        with ThreadPoolExecutor (max_workers=nthreads) as executor:
+            futures = [executor.submit (crunch_worker, worker) for worker in workers]
+            for future in futures: future.result ()
+        for worker in workers:
+            for key, val in vars (worker).items ():
+                if key.startswith ('dt_') or key.startswith ('dw_'):
+                    setattr (self, key, getattr (self, key) + val)
+
     def _add_transpose_(self):
         self.tdm1s += self.tdm1s.conj ().transpose (1,0,2,4,3)
         self.tdm2s += self.tdm2s.conj ().transpose (1,0,2,4,3,6,5)
@@ -987,7 +1196,268 @@ class LSTDM (object):
         profile += '\n' + fmt_str.format ('putS', self.dt_s, self.dw_s)
         return profile
 
-def make_stdm12s (las, ci, nelec_frs, **kwargs):
+class LSTDMBlocks (LSTDM):
+    ''' LAS state transition density matrix intermediate 2 - whole-system DMs, block-sparse
+
+        Same as LSTDM, except that the transition density matrices are stored as a dictionary
+        of blocks keyed by (bra rootspace, ket rootspace), and only those blocks connected by at
+        least one interaction in the excitation tables (plus their transposes) are allocated.
+        The blocks can also be computed a few at a time (see iter_kernel), so that they need not
+        all be held in memory at once.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        LSTDM.__init__(self, *args, **kwargs)
+        self.nprods = np.prod (self.lroots, axis=0)
+        self.nonzero_blocks = self.get_nonzero_blocks ()
+        self.tdm_blocks = None
+
+    def get_nonzero_blocks (self):
+        '''List all (bra rootspace, ket rootspace) pairs with nonzero transition density
+        matrices, in lexical order'''
+        blocks = set (map (tuple, self.exc_null.tolist ()))
+        for images in self.nonuniq_exc.values ():
+            blocks.update (map (tuple, np.asarray (images).tolist ()))
+        blocks.update ([(rket, rbra) for rbra, rket in blocks])
+        return sorted (blocks)
+
+    def get_memory_required (self, blocks=None):
+        '''Memory in MB required to store the nonzero blocks (default: all of them)'''
+        if blocks is None: blocks = self.nonzero_blocks
+        nelem = sum ([self.nprods[rbra]*self.nprods[rket] for rbra, rket in blocks])
+        return np.dtype (self.dtype).itemsize*nelem*(2*(self.norb**2)+4*(self.norb**4))/1e6
+
+    def get_block_groups (self, max_memory):
+        '''Partition the nonzero blocks into groups, each closed under transposition, which
+        require no more than max_memory MB apiece (except for a single pair of blocks which is
+        larger than that by itself).
+
+        Returns:
+            groups : list of lists of tuples
+                (bra rootspace, ket rootspace) pairs of each group, in lexical order
+        '''
+        groups, group, mem_group = [], [], 0
+        for rbra, rket in self.nonzero_blocks:
+            if rbra > rket: continue
+            pair = [(rbra,rket),] if rbra == rket else [(rbra,rket),(rket,rbra)]
+            mem_pair = self.get_memory_required (blocks=pair)
+            if len (group) and mem_group + mem_pair > max_memory:
+                groups.append (sorted (group))
+                group, mem_group = [], 0
+            group.extend (pair)
+            mem_group += mem_pair
+        if len (group): groups.append (sorted (group))
+        return groups
+
+    def _get_crunch_tasks (self):
+        tasks = super ()._get_crunch_tasks ()
+        if len (self.tdm_blocks) == len (self.nonzero_blocks): return tasks
+        # Only the interactions which contribute to at least one of the allocated blocks
+        def is_needed (fn, row):
+            key = tuple (row[:-1]) if self._fn_row_has_spin (getattr (self, fn)) else tuple (row)
+            return any ((tuple (braket) in self.tdm_blocks
+                         for braket in np.asarray (self.nonuniq_exc[key]).tolist ()))
+        return [(fn, row) for fn, row in tasks if is_needed (fn, row)]
+
+    def _iter_blocks (self, bra, ket, wgt, ix):
+        '''Group model-state pairs by rootspace pair and convert to block-local indices'''
+        rbra, rket = self.rootaddr[bra], self.rootaddr[ket]
+        keys, inv = np.unique (rbra*self.nroots + rket, return_inverse=True)
+        inv = np.ravel (inv)
+        for ikey, key in enumerate (keys):
+            rb, rk = divmod (int (key), self.nroots)
+            if (rb, rk) not in self.tdm_blocks: continue
+            idx = inv==ikey
+            b = bra[idx] - self.offs_lroots[rb,0]
+            k = ket[idx] - self.offs_lroots[rk,0]
+            yield (rb, rk), b, k, wgt[idx], ix[idx]
+
+    def _put_SD1_(self, bra, ket, D1, wgt, ix):
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        for key, b, k, w, i in self._iter_blocks (bra, ket, wgt, ix):
+            self._scatter_SD1_(self.tdm_blocks[key][0], b, k, D1, w, i)
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_s, self.dw_s = self.dt_s + dt, self.dw_s + dw
+
+    def _put_SD2_(self, bra, ket, D2, wgt, ix):
+        t0, w0 = logger.process_clock (), logger.perf_counter ()
+        for key, b, k, w, i in self._iter_blocks (bra, ket, wgt, ix):
+            self._scatter_SD2_(self.tdm_blocks[key][1], b, k, D2, w, i)
+        dt, dw = logger.process_clock () - t0, logger.perf_counter () - w0
+        self.dt_s, self.dw_s = self.dt_s + dt, self.dw_s + dw
+
+    def _add_transpose_(self):
+        for rbra, rket in list (self.tdm_blocks.keys ()):
+            if rbra < rket: continue
+            d1_bk, d2_bk = self.tdm_blocks[(rbra,rket)]
+            d1_kb, d2_kb = self.tdm_blocks[(rket,rbra)]
+            d1_kbT = d1_kb.conj ().transpose (1,0,2,4,3).copy ()
+            d2_kbT = d2_kb.conj ().transpose (1,0,2,4,3,6,5).copy ()
+            if rbra != rket:
+                d1_kb += d1_bk.conj ().transpose (1,0,2,4,3)
+                d2_kb += d2_bk.conj ().transpose (1,0,2,4,3,6,5)
+            d1_bk += d1_kbT
+            d2_bk += d2_kbT
+
+    def _umat_linequiv_(self, ifrag, iroot, umat, *args):
+        lroots = self.lroots[:,iroot:iroot+1]
+        for (rbra, rket), (d1, d2) in self.tdm_blocks.items ():
+            for axis, r in enumerate ((rbra, rket)):
+                if r != iroot: continue
+                d1 = umat_dot_1frag_(d1, umat, lroots, ifrag, 0, axis=axis)
+                d2 = umat_dot_1frag_(d2, umat, lroots, ifrag, 0, axis=axis)
+            self.tdm_blocks[(rbra,rket)] = (d1, d2)
+
+    def kernel (self, blocks=None):
+        ''' Main driver method of class.
+
+        Kwargs:
+            blocks : list of tuples
+                (bra rootspace, ket rootspace) pairs to compute, closed under transposition.
+                Defaults to all nonzero blocks.
+
+        Returns:
+            tdm_blocks : dict
+                Keys are (bra rootspace, ket rootspace) and values are tuples of
+                stdm1s : ndarray of shape (nbra,nket,2,ncas,ncas)
+                stdm2s : ndarray of shape (nbra,nket,4,ncas,ncas,ncas,ncas)
+                in the same convention as LSTDM.kernel
+            t0 : tuple of length 2
+                timestamp of entry into this function, for profiling by caller
+        '''
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        self.init_profiling ()
+        if blocks is None: blocks = self.nonzero_blocks
+        self.tdm_blocks = {}
+        for rbra, rket in blocks:
+            nbra, nket = self.nprods[rbra], self.nprods[rket]
+            self.tdm_blocks[(rbra,rket)] = (
+                np.zeros ((nbra,nket,2) + (self.norb,)*2, dtype=self.dtype),
+                np.zeros ((nbra,nket,4) + (self.norb,)*4, dtype=self.dtype))
+        self._crunch_all_()
+        self._umat_linequiv_loop_()
+        return self.tdm_blocks, t0
+
+    def iter_kernel (self, max_memory):
+        '''Compute the nonzero blocks in groups requiring no more than max_memory MB apiece (see
+        get_block_groups).
+
+        Yields:
+            tdm_blocks : dict
+                As returned by kernel, for one group of blocks
+            t0 : tuple of length 2
+                timestamp of entry into the crunching of this group, for profiling by caller
+        '''
+        for blocks in self.get_block_groups (max_memory):
+            tdm_blocks, t0 = self.kernel (blocks=blocks)
+            self.tdm_blocks = None
+            yield tdm_blocks, t0
+
+class STDM12sBlocks (object):
+    ''' Block-sparse container of spin-separated LAS product-state 1- and 2-body transition
+        density matrices, returned by make_stdm12s with block_sparse=True. Indexing with a
+        (bra rootspace, ket rootspace) pair returns a tuple of
+
+            stdm1s : ndarray of shape (nbra,2,ncas,ncas,nket)
+            stdm2s : ndarray of shape (nbra,2,ncas,ncas,2,ncas,ncas,nket)
+
+        in the same convention as the dense return values of make_stdm12s. Blocks which are not
+        stored are zero.
+
+        Args:
+            offs : ndarray of shape (nroots,2)
+                Beginning and end of the model-state range of each rootspace
+
+        Kwargs:
+            h5 : instance of h5py.Group
+                If provided, blocks are stored in it instead of in memory
+    '''
+    def __init__(self, offs, ncas, dtype=np.float64, h5=None):
+        self.offs = np.asarray (offs)
+        self.nstates = self.offs[-1,1]
+        self.ncas = ncas
+        self.dtype = dtype
+        self.h5 = h5
+        self._blocks = {}
+
+    def _h5key (self, key):
+        return '{}_{}'.format (*key)
+
+    def __setitem__(self, key, value):
+        key = tuple (int (k) for k in key)
+        if self.h5 is None:
+            self._blocks[key] = value
+            return
+        grp = self.h5.require_group (self._h5key (key))
+        for lbl, arr in zip (('stdm1s', 'stdm2s'), value):
+            if lbl in grp: del grp[lbl]
+            grp.create_dataset (lbl, data=arr)
+        self._blocks[key] = None
+
+    def __getitem__(self, key):
+        key = tuple (int (k) for k in key)
+        if self.h5 is None: return self._blocks[key]
+        grp = self.h5[self._h5key (key)]
+        return grp['stdm1s'][()], grp['stdm2s'][()]
+
+    def __contains__(self, key): return tuple (key) in self._blocks
+    def __len__(self): return len (self._blocks)
+    def keys (self): return list (self._blocks.keys ())
+    def items (self):
+        for key in self.keys (): yield key, self[key]
+
+    def todense (self):
+        '''Returns stdm1s, stdm2s as dense arrays, as from make_stdm12s with block_sparse=False'''
+        nstates = self.nstates
+        shape1, shape2 = self.get_rdm_shapes ()
+        stdm1s = np.zeros ((nstates, nstates) + shape1, dtype=self.dtype)
+        stdm1s = np.moveaxis (stdm1s, 1, -1)
+        stdm2s = np.zeros ((nstates, nstates) + shape2, dtype=self.dtype)
+        stdm2s = np.moveaxis (stdm2s, 1, -1)
+        for (rbra, rket), (d1, d2) in self.items ():
+            i, j = self.offs[rbra]
+            k, l = self.offs[rket]
+            stdm1s[i:j,...,k:l] = d1
+            stdm2s[i:j,...,k:l] = d2
+        return stdm1s, stdm2s
+
+    def roots_make_rdm12s (self, si):
+        '''Contract with SI vectors to obtain spin-separated 1- and 2-RDMs of LASSI states,
+        streaming over the stored blocks. This is for STDMs which have already been stored;
+        lassi.roots_make_rdm12s does not build the STDMs at all, but contracts the SI vectors
+        directly with the fragment intermediates (see rdm.LRRDM).
+
+        Args:
+            si : ndarray of shape (nstates,nroots_si)
+
+        Returns:
+            rdm1s : ndarray of shape (nroots_si,2,ncas,ncas) or (nroots_si,2*ncas,2*ncas)
+            rdm2s : ndarray of shape (nroots_si,2,ncas,ncas,2,ncas,ncas)
+        '''
+        nroots_si = si.shape[1]
+        shape1, shape2 = self.get_rdm_shapes ()
+        dtype = np.result_type (self.dtype, si.dtype)
+        rdm1s = np.zeros ((nroots_si, np.prod (shape1)), dtype=dtype)
+        rdm2s = np.zeros ((nroots_si, np.prod (shape2)), dtype=dtype)
+        for (rbra, rket), (d1, d2) in self.items ():
+            si_bra = si[self.offs[rbra,0]:self.offs[rbra,1]].conj ()
+            si_ket = si[self.offs[rket,0]:self.offs[rket,1]]
+            d1 = d1.reshape (d1.shape[0], -1, d1.shape[-1])
+            d2 = d2.reshape (d2.shape[0], -1, d2.shape[-1])
+            rdm1s += lib.einsum ('ai,apb,bi->ip', si_bra, d1, si_ket)
+            rdm2s += lib.einsum ('ai,apb,bi->ip', si_bra, d2, si_ket)
+        return rdm1s.reshape ((nroots_si,) + shape1), rdm2s.reshape ((nroots_si,) + shape2)
+
+    def get_rdm_shapes (self):
+        '''Shapes of a single 1- and 2-body density matrix'''
+        n = self.ncas
+        shape1, shape2 = (2, n, n), (2, n, n, 2, n, n)
+        if len (self):
+            d1, d2 = self[self.keys ()[0]]
+            shape1, shape2 = d1.shape[1:-1], d2.shape[1:-1]
+        return shape1, shape2
+
+def make_stdm12s (las, ci, nelec_frs, block_sparse=False, h5=None, **kwargs):
     ''' Build spin-separated LAS product-state 1- and 2-body transition density matrices
 
     Args:
@@ -998,11 +1468,24 @@ def make_stdm12s (las, ci, nelec_frs, **kwargs):
             Number of electrons of each spin in each rootspace in each
             fragment
 
+    Kwargs:
+        block_sparse : logical
+            If True, allocate and return only the nonzero (bra rootspace, ket rootspace) blocks
+            as an instance of :class:`STDM12sBlocks`
+        h5 : instance of h5py.Group
+            If provided, the blocks of the STDM12sBlocks return value are stored in it as they
+            are computed, a group of blocks at a time, so that only as many of them as fit in
+            max_memory are ever held in memory. Implies block_sparse=True.
+
     Returns:
         tdm1s : ndarray of shape (nroots,2,ncas,ncas,nroots)
             Contains 1-body LAS state transition density matrices
         tdm2s : ndarray of shape (nroots,2,ncas,ncas,2,ncas,ncas,nroots)
             Contains 2-body LAS state transition density matrices
+
+        OR, if block_sparse
+
+        tdm12s : instance of :class:`STDM12sBlocks`
     '''
     log = lib.logger.new_logger (las, las.verbose)
     nlas = las.ncas_sub
@@ -1014,6 +1497,7 @@ def make_stdm12s (las, ci, nelec_frs, **kwargs):
     # Handle possible SOC
     nelec_rs = [tuple (x) for x in nelec_frs.sum (0)]
     spin_pure = len (set (nelec_rs)) == 1
+    ix = None
     if not spin_pure: # Engage the ``spinless mapping''
         ci = ci_map2spinless (ci, nlas, nelec_frs)
         ix = spin_shuffle_idx (nlas)
@@ -1024,54 +1508,98 @@ def make_stdm12s (las, ci, nelec_frs, **kwargs):
         nelec_frs[:,:,1] = 0
         ncas = ncas * 2
 
+    if h5 is not None: block_sparse = True
+
     # First pass: single-fragment intermediates
-    hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas)
+    hopping_index, ints, lroots = frag.make_ints (las, ci, nelec_frs, nlas=nlas,
+                                                  use_cache=spin_pure)
     nstates = np.sum (np.prod (lroots, axis=0))
 
+    # Second pass: upper-triangle
+    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+    _LSTDM_class = LSTDMBlocks if block_sparse else LSTDM
+    outerprod = _LSTDM_class (ints, nlas, hopping_index, lroots, dtype=dtype,
+                              max_memory=max_memory, log=log)
+    if not spin_pure:
+        outerprod.spin_shuffle = spin_shuffle_fac
+    lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)
+
     # Memory check
     current_memory = lib.current_memory ()[0]
-    required_memory = dtype.itemsize*nstates*nstates*(2*(ncas**2)+4*(ncas**4))/1e6
+    if h5 is not None:
+        # Blocks are written to disk a group at a time; the largest pair must still fit. The
+        # conversion to the PySCF convention needs a second copy of each block.
+        mem_avail = (max_memory - current_memory) / 2
+        groups = outerprod.get_block_groups (mem_avail)
+        required_memory = 2 * max ([0,] + [outerprod.get_memory_required (blocks=g)
+                                           for g in groups])
+    elif block_sparse:
+        required_memory = outerprod.get_memory_required ()
+    else:
+        required_memory = dtype.itemsize*nstates*nstates*(2*(ncas**2)+4*(ncas**4))/1e6
     if current_memory + required_memory > max_memory:
         raise MemoryError ("current: {}; required: {}; max: {}".format (
             current_memory, required_memory, max_memory))
 
-    # Second pass: upper-triangle
-    t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
-    outerprod = LSTDM (ints, nlas, hopping_index, lroots, dtype=dtype,
-                           max_memory=max_memory, log=log)
-    if not spin_pure:
-        outerprod.spin_shuffle = spin_shuffle_fac
-    lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)
-    tdm1s, tdm2s, t0 = outerprod.kernel ()
+    if h5 is not None:
+        t0 = (lib.logger.process_clock (), lib.logger.perf_counter ())
+        ncas_out = ncas if spin_pure else ncas // 2
+        tdm12s = STDM12sBlocks (outerprod.offs_lroots, ncas_out, dtype=dtype, h5=h5)
+        for tdm_blocks, t1 in outerprod.iter_kernel (mem_avail):
+            for key in list (tdm_blocks.keys ()):
+                tdm1s, tdm2s = tdm_blocks.pop (key)
+                tdm12s[key] = _stdm12s_pyscf_convention (tdm1s, tdm2s, spin_pure, ncas_out,
+                                                         ix=ix)
+            tdm_blocks = tdm1s = tdm2s = None
+        lib.logger.timer (las, 'LAS-state TDM12s second intermediate crunching', *t0)
+        return tdm12s
+    elif block_sparse:
+        tdm_blocks, t0 = outerprod.kernel ()
+    else:
+        tdm1s, tdm2s, t0 = outerprod.kernel ()
     lib.logger.timer (las, 'LAS-state TDM12s second intermediate crunching', *t0)
     if las.verbose >= lib.logger.TIMER_LEVEL:
         lib.logger.info (las, 'LAS-state TDM12s crunching profile:\n%s', outerprod.sprint_profile ())
+    if not spin_pure: ncas = ncas // 2
 
+    if block_sparse:
+        tdm12s = STDM12sBlocks (outerprod.offs_lroots, ncas, dtype=dtype)
+        for key in list (tdm_blocks.keys ()):
+            tdm1s, tdm2s = tdm_blocks.pop (key)
+            tdm12s[key] = _stdm12s_pyscf_convention (tdm1s, tdm2s, spin_pure, ncas, ix=ix)
+        return tdm12s
+
+    return _stdm12s_pyscf_convention (tdm1s, tdm2s, spin_pure, ncas, ix=ix)
+
+def _stdm12s_pyscf_convention (tdm1s, tdm2s, spin_pure, ncas, ix=None):
+    '''Clean up the ``spinless mapping'' if necessary and transpose LSTDM output arrays of
+    shape (nbra,nket,...) into the return convention of make_stdm12s'''
+    nbra, nket = tdm1s.shape[:2]
 
     # Clean up the ``spinless mapping''
     if not spin_pure:
         kx = [True,]*2
-        jx = [True,]*nstates
-        tdm1s = tdm1s[np.ix_(jx,jx,kx,ix,ix)]
-        tdm2s = tdm2s[np.ix_(jx,jx,kx*2,ix,ix,ix,ix)]
-        n = ncas = ncas // 2
-        tdm2s_ = np.zeros ((nstates, nstates, 2, 2, n, n, n, n), dtype=tdm2s.dtype)
+        jx = [True,]*nbra
+        lx = [True,]*nket
+        tdm1s = tdm1s[np.ix_(jx,lx,kx,ix,ix)]
+        tdm2s = tdm2s[np.ix_(jx,lx,kx*2,ix,ix,ix,ix)]
+        n = ncas
+        tdm2s_ = np.zeros ((nbra, nket, 2, 2, n, n, n, n), dtype=tdm2s.dtype)
         tdm2s_[:,:,0,0,:,:,:,:] = tdm2s[:,:,0,:n,:n,:n,:n]
         tdm2s_[:,:,0,1,:,:,:,:] = tdm2s[:,:,0,:n,:n,n:,n:]
         tdm2s_[:,:,1,0,:,:,:,:] = tdm2s[:,:,0,n:,n:,:n,:n]
         tdm2s_[:,:,1,1,:,:,:,:] = tdm2s[:,:,0,n:,n:,n:,n:]
         tdm2s = tdm2s_
         if spin_pure: # Need this if you want to always do "spinless mapping" for testing
-            tdm1s_ = np.zeros ((nstates, nstates, 2, n, n), dtype=tdm1s.dtype)
+            tdm1s_ = np.zeros ((nbra, nket, 2, n, n), dtype=tdm1s.dtype)
             tdm1s_[:,:,0,:,:] = tdm1s[:,:,0,:n,:n]
             tdm1s_[:,:,1,:,:] = tdm1s[:,:,0,n:,n:]
             tdm1s = tdm1s_
 
-
     # Put tdm1s in PySCF convention: [p,q] -> q'p
     if spin_pure: tdm1s = tdm1s.transpose (0,2,4,3,1)
     else: tdm1s = tdm1s[:,:,0,:,:].transpose (0,3,2,1)
-    tdm2s = tdm2s.reshape (nstates,nstates,2,2,ncas,ncas,ncas,ncas).transpose (0,2,4,5,3,6,7,1)
+    tdm2s = tdm2s.reshape (nbra,nket,2,2,ncas,ncas,ncas,ncas).transpose (0,2,4,5,3,6,7,1)
 
     return tdm1s, tdm2s
 
@@ -139,6 +139,8 @@ def kernel(mc, mo_coeff=None, ot=None, **kwargs):
     if mo_coeff is None: mo_coeff = mc.mo_coeff
     mc.optimize_mcscf_(mo_coeff=mo_coeff, **kwargs)
     mc.lpdft_ham, mc.e_states, mc.si_pdft, mc.rootsym, mc.s2_roots, s2_mat = mc.make_lpdft_ham_(ot=ot)
+    if getattr(mc, 'rdmsh5', None) is not None: mc.rdmsh5.close()
+    if getattr(mc, 'ints_cache', None) is not None: mc.ints_cache.clear()
     logger.debug(mc, f"L-PDFT Hamiltonian in LASSI Basis:\n{mc.get_lpdft_ham()}")
 
     logger.debug(mc, f"L-PDFT SI:\n{mc.si_pdft}")
@@ -2,7 +2,6 @@ from pyscf import ao2mo, lib
 from pyscf.mcscf.addons import StateAverageMCSCFSolver
 import numpy as np
 from mrh.my_pyscf.lassi import lassi
-import h5py
 import tempfile
 from pyscf.mcpdft.otfnal import transfnal, get_transfnal
 from pyscf.mcpdft.mcpdft import _get_e_decomp
@@ -17,24 +16,18 @@ except ImportError:
 
 def make_casdm1s(filename, i):
     """
-    This function stores the rdm1s for the given state 'i' in a tempfile
+    This function reads the rdm1s for the given state 'i' from a tempfile
     """
-    with h5py.File(filename, 'r') as f:
-        rdm1s_key = f'rdm1s_{i}'
-        rdm1s = f[rdm1s_key][:]
-        rdm1s = np.array(rdm1s)
-    return rdm1s
+    with lassi.RootsRDM12sH5(filename) as rdms:
+        return rdms.get_rdm1s(i)
 
 
 def make_casdm2s(filename, i):
     """
-    This function stores the rdm2s for the given state 'i' in a tempfile
+    This function reads the rdm2s for the given state 'i' from a tempfile
     """
-    with h5py.File(filename, 'r') as f:
-        rdm2s_key = f'rdm2s_{i}'
-        rdm2s = f[rdm2s_key][:]
-        rdm2s = np.array(rdm2s)
-    return rdm2s
+    with lassi.RootsRDM12sH5(filename) as rdms:
+        return rdms.get_rdm2s(i)
 
 
 class _LASPDFT(_PDFT):
@@ -79,6 +72,7 @@ def get_mcpdft_child_class(mc, ot, DoLASSI=False, states=None, **kwargs):
         setattr(_mc_class, 'states', None)
         setattr(_mc_class, 'statlis', None)
         setattr(_mc_class, 'rdmstmpfile', None)
+        setattr(_mc_class, 'rdmsh5', None)
 
         def get_h2eff(self, mo_coeff=None):
             if self._in_mcscf_env:
@@ -133,54 +127,31 @@ def get_mcpdft_child_class(mc, ot, DoLASSI=False, states=None, **kwargs):
             calling it 2n time for n-states becomes prohibitively expensive. One alternative 
             can be just call it once and store all the generated casdm1 and casdm2 and later on
             just call a reader function which will read the rdms from this temp file.
+            All reads go through the single handle self.rdmsh5, which is closed at the end
+            of kernel and reopened on demand by any later read.
             '''
 
             def _store_rdms(self):
                 # MRH: I made it loop over blocks of states to handle the O(N^5) memory cost
                 # If there's enough memory it'll still do them all at once
-                log = lib.logger.new_logger(self, self.verbose)
-                safety_factor = 1.3
-                mem_per_state = safety_factor * 8 * (2 * (self.ncas ** 2) + 4 * (self.ncas ** 4)) / 1e6
-                current_mem = lib.current_memory()[0]
-
-                if current_mem > self.max_memory:
-                    log.warn("Current memory usage (%d MB) exceeds maximum memory (%d MB)",
-                             current_mem, self.max_memory)
-                    nblk = 1
-                else:
-                    nblk = max(1, int((self.max_memory - current_mem) / mem_per_state) - 1)
-
-                log.debug('_store_rdms: looping over %d states at a time of %d total', len(self.states),
-                          nblk)
-
-                rdmstmpfile = self.rdmstmpfile
-                with h5py.File(rdmstmpfile, 'a') as f:
-                    for i in range(0, len(self.states), nblk):
-                        j = min(i + nblk, len(self.states))
-
-                        rdm1s, rdm2s = lassi.root_make_rdm12s(self, self.ci, self.si,
-                                                              state=self.states[i:j])
-
-                        if len(self.states[i:j]) == 1:
-                            rdm1s = [rdm1s]
-                            rdm2s = [rdm2s]
-
-                        for k in range(i, j):
-                            stateno = self.states[k]
-                            rdm1s_dname = f'rdm1s_{stateno}'
-                            f.create_dataset(rdm1s_dname, data=rdm1s[k])
-                            rdm2s_dname = f'rdm2s_{stateno}'
-                            f.create_dataset(rdm2s_dname, data=rdm2s[k])
-
-                        rdm1s = rdm2s = None
+                # The batches are streamed straight into the tempfile, so at most one batch
+                # of density matrices is ever held in memory
+                if self.rdmsh5 is not None: self.rdmsh5.close()
+                self.rdmsh5 = lassi.dump_roots_rdm12s(self, self.ci, self.si, self.rdmstmpfile,
+                                                      state=self.states)
 
             def make_one_casdm1s(self, ci=None, state=0, **kwargs):
-                rdmstmpfile = self.rdmstmpfile
-                return make_casdm1s(rdmstmpfile, self.states[state])
+                return self.rdmsh5.get_rdm1s(self.states[state])
 
             def make_one_casdm2(self, ci=None, state=0, **kwargs):
-                rdmstmpfile = self.rdmstmpfile
-                return make_casdm2s(rdmstmpfile, self.states[state]).sum((0, 3))
+                return self.rdmsh5.get_rdm2s(self.states[state]).sum((0, 3))
+
+            def kernel(self, *args, **kwargs):
+                try:
+                    return _LASPDFT.kernel(self, *args, **kwargs)
+                finally:
+                    if self.rdmsh5 is not None: self.rdmsh5.close()
+                    self.ints_cache.clear()
 
         else:
             make_one_casdm1s = mc.__class__.state_make_casdm1s
@@ -1,6 +1,8 @@
 import numpy as np
 from scipy import linalg, special
 from scipy.sparse.linalg import LinearOperator
+from concurrent.futures import ThreadPoolExecutor
+from pyscf import lib
 from pyscf.lib import logger, temporary_env
 from pyscf.mcscf.addons import StateAverageMCSCFSolver, StateAverageMixFCISolver, state_average_mix
 from pyscf.mcscf.addons import StateAverageMixFCISolver_state_args as _state_arg
@@ -220,6 +222,42 @@ def get_h1e_zipped_fcisolver (fcisolver):
     h1ezipped_fcisolver.__dict__.update (fcisolver.__dict__)
     return h1ezipped_fcisolver
 
+def map_frags (fn, frags, nthreads=1, mem_frag=0, max_memory=None):
+    '''Evaluate [fn (i) for i in frags], where the fragment problems are independent,
+    concurrently in up to nthreads Python threads which share the OpenMP threads equally.
+
+    Args:
+        fn : callable
+            Takes one fragment index
+        frags : sequence of integers
+            Fragment indices
+
+    Kwargs:
+        nthreads : integer
+            Maximum number of fragments processed concurrently
+        mem_frag : float
+            Estimated scratch memory in MB of the most expensive fragment problem. The number of
+            threads is limited so that nthreads*mem_frag fits in max_memory.
+        max_memory : float
+            In MB. If omitted, memory is not considered.
+
+    Returns:
+        results : list
+            In the order of frags
+    '''
+    frags = list (frags)
+    nthreads = min (nthreads, len (frags))
+    if max_memory is not None and mem_frag > 0:
+        mem_avail = max_memory - lib.current_memory ()[0]
+        nthreads = min (nthreads, int (mem_avail // mem_frag))
+    if nthreads < 2: return [fn (i) for i in frags]
+    nthreads_omp = max (1, lib.num_threads () // nthreads)
+    def omp_fn (i):
+        with lib.with_omp_threads (nthreads_omp):
+            return fn (i)
+    with ThreadPoolExecutor (max_workers=nthreads) as executor:
+        return list (executor.map (omp_fn, frags))
+
 def las2cas_civec (las):
     from mrh.my_pyscf.lassi.op_o0 import ci_outer_product
     norb_f = las.ncas_sub
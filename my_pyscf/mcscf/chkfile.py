@@ -89,7 +89,8 @@ def dump_las (mc, chkfile=None, method_key='las', mo_coeff=None, ci=None,
             del (fh5[method_key])
         chkdata = fh5.create_group (method_key)
 
-        for key, val in data.items (): chkdata[key] = val
+        for key, val in data.items ():
+            if val is not None: chkdata[key] = val
         # special handling for ragged CI vector
         for i, cii in enumerate (ci):
             chkdata_ci_i = chkdata.create_group ('ci/'+str(i))
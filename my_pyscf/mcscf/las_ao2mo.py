@@ -1,7 +1,211 @@
 import numpy as np
+import threading
 from scipy import linalg
 from pyscf import ao2mo, lib
 from mrh.my_pyscf.df.sparse_df import sparsedf_array
+from pyscf import __config__
+
+# Largest norm of the component of new active orbitals outside the span of the cached ones
+# for which the cached half-transformed DF integrals are rotated instead of recomputed
+DF_WORKSPACE_ROTATE_TOL = getattr (__config__, 'las_ao2mo_df_workspace_rotate_tol', 1e-10)
+
+# If bmPu = (mu P|u) does not fit in memory, store it on disk (see OutcoreBmPu) rather than
+# dropping it
+DF_OUTCORE_BMPU = getattr (__config__, 'las_ao2mo_df_outcore_bmPu', True)
+
+# Guards DFWorkspace caches against concurrent impurity solvers. Module-level so that
+# DFWorkspace (and therefore LAS) instances remain copyable.
+_DF_WORKSPACE_LOCK = threading.RLock ()
+
+class OutcoreBmPu (object):
+    '''Disk-backed bmPu = (mu P|u) for when it does not fit in memory. It is stored
+    aux-index-major in a temporary HDF5 file and read back in blocks of aux indices with
+    loop_bmPu. Rotations of the active index are accumulated in umat and applied to each block
+    as it is read, so that the file is never rewritten.
+
+    Args:
+        nao : integer
+        naux : integer
+        ncas : integer
+
+    Kwargs:
+        dtype : numpy dtype
+        max_memory : float
+            In MB; determines the default size of the blocks read back
+    '''
+    def __init__(self, nao, naux, ncas, dtype=np.float64, max_memory=2000):
+        self.shape = (nao, naux, ncas)
+        self.dtype = np.dtype (dtype)
+        self.max_memory = max_memory
+        self.umat = None
+        self.feri = lib.H5TmpFile ()
+        chunks = (max (1, min (naux, int (4e6 // max (1, nao*ncas*self.dtype.itemsize)))),
+                  nao, ncas)
+        self.dset = self.feri.create_dataset ('bmPu', (naux, nao, ncas), dtype=self.dtype,
+                                              chunks=chunks)
+
+    @property
+    def naux (self): return self.shape[1]
+
+    def write (self, p0, p1, bmPu_blk):
+        '''Store bmPu[:,p0:p1,:]'''
+        assert (self.umat is None), 'cannot write to a rotated OutcoreBmPu'
+        self.dset[p0:p1] = np.asarray (bmPu_blk).transpose (1,0,2)
+
+    def get_blksize (self, max_memory=None, nbuf=3):
+        if max_memory is None: max_memory = self.max_memory
+        nao, naux = self.shape[:2]
+        ncas = max (self.shape[2], self.dset.shape[2])
+        mem_av = max_memory - lib.current_memory ()[0]
+        mem_per_aux = nbuf * nao * ncas * self.dtype.itemsize / 1e6
+        return max (1, min (naux, int (mem_av / max (mem_per_aux, 1e-6))))
+
+    def loop (self, blksize=None):
+        '''Yield p0, p1, bmPu[:,p0:p1,:]'''
+        if blksize is None: blksize = self.get_blksize ()
+        for p0, p1 in lib.prange (0, self.naux, blksize):
+            blk = self.dset[p0:p1].transpose (1,0,2)
+            if self.umat is not None: blk = np.dot (blk, self.umat)
+            yield p0, p1, blk
+
+    def rotate (self, umat):
+        '''A new OutcoreBmPu with the active index transformed by umat, sharing this one's
+        file'''
+        nao, naux, ncas = self.shape
+        new = self.__class__.__new__ (self.__class__)
+        new.__dict__.update (self.__dict__)
+        new.umat = umat if self.umat is None else np.dot (self.umat, umat)
+        new.shape = (nao, naux, umat.shape[1])
+        new.dtype = np.result_type (self.dtype, umat)
+        return new
+
+def loop_bmPu (bmPu, blksize=None):
+    '''Iterate over blocks of aux indices of bmPu, which is either an ndarray of shape
+    (nao,naux,ncas) or an OutcoreBmPu. Yields p0, p1, bmPu[:,p0:p1,:].'''
+    if isinstance (bmPu, OutcoreBmPu):
+        yield from bmPu.loop (blksize=blksize)
+    else:
+        yield 0, bmPu.shape[1], bmPu
+
+def rotate_bmPu (bmPu, umat):
+    '''Transform the active index of bmPu, in memory or on disk, by umat'''
+    if isinstance (bmPu, OutcoreBmPu): return bmPu.rotate (umat)
+    return np.dot (bmPu, umat)
+
+class DFWorkspace (object):
+    '''Persistent density-fitting intermediates of a LAS instance, shared by get_h2eff,
+    fast_veffa, and the lasscf_async impurity Hamiltonians:
+
+    - the AO-pair sparsity index of each block of with_df.loop (),
+    - the sparsedf_array wrapper of an in-core with_df._cderi,
+    - bmPu = (mu P|u), the three-center integrals half-transformed to the current active
+      orbitals, in memory if they fit in max_memory and otherwise as an OutcoreBmPu.
+
+    When the active orbitals change only by a rotation among themselves, bmPu is rotated
+    rather than recomputed. Use get_df_workspace to access the workspace of a LAS instance.
+    lasci_sync.kernel calls free_bmPu before returning; reset drops all of the intermediates.
+    '''
+    def __init__(self, las):
+        self.with_df = las.with_df
+        self.cderi = getattr (las.with_df, '_cderi', None)
+        self.mol = las.mol
+        self.max_memory = las.max_memory
+        self.mo_cas = None
+        self.bmPu = None
+        self._ovlp = None
+        self._bPmn = None
+        self._sparsity = {}
+
+    def get_ovlp (self):
+        if self._ovlp is None: self._ovlp = self.mol.intor_symmetric ('int1e_ovlp')
+        return self._ovlp
+
+    @property
+    def bPmn (self):
+        '''sparsedf_array of the in-core CDERIs with its sparsity index, or None if out-of-core'''
+        with _DF_WORKSPACE_LOCK:
+            if not isinstance (self.cderi, np.ndarray): return None
+            if self._bPmn is None:
+                self._bPmn = sparsedf_array (self.cderi)
+                self._bPmn.get_sparsity_ ()
+            return self._bPmn
+
+    def loop (self, blksize):
+        '''Like with_df.loop, but yields each block both as it is and as a sparsedf_array whose
+        sparsity index is computed only once'''
+        if blksize not in self._sparsity: self._sparsity = {blksize: {}}
+        sparsity = self._sparsity[blksize]
+        for iblk, cderi in enumerate (self.with_df.loop (blksize=blksize)):
+            bPmn = sparsedf_array (cderi)
+            if iblk in sparsity:
+                bPmn.__dict__.update (sparsity[iblk])
+            else:
+                bPmn.get_sparsity_ ()
+                sparsity[iblk] = {key: getattr (bPmn, key) for key in ('iao_nent', 'nent_max',
+                    'iao_entlist', 'iao_sort', 'nentpair', 'entpair')}
+            yield cderi, bPmn
+
+    def get_bmPu (self, mo_cas):
+        '''Cached bmPu for the active orbitals mo_cas, rotated from the cached active orbitals if
+        possible. Returns None if nothing usable is cached.'''
+        with _DF_WORKSPACE_LOCK:
+            if self.bmPu is None or self.mo_cas is None: return None
+            if self.mo_cas.shape != mo_cas.shape: return None
+            if np.array_equal (self.mo_cas, mo_cas): return self.bmPu
+            umat = self.mo_cas.conj ().T @ self.get_ovlp () @ mo_cas
+            resid = mo_cas - self.mo_cas @ umat
+            if linalg.norm (resid) > DF_WORKSPACE_ROTATE_TOL: return None
+            bmPu = rotate_bmPu (self.bmPu, umat)
+            self.set_bmPu (mo_cas, bmPu)
+            return bmPu
+
+    def set_bmPu (self, mo_cas, bmPu):
+        with _DF_WORKSPACE_LOCK:
+            if isinstance (bmPu, OutcoreBmPu):
+                self.mo_cas, self.bmPu = mo_cas.copy (), bmPu
+                return
+            # bmPu has already been allocated, so it is counted in current_memory; the array it
+            # replaces is released
+            mem = bmPu.nbytes / 1e6
+            mem_avail = self.max_memory - lib.current_memory ()[0] + mem
+            if isinstance (self.bmPu, np.ndarray):
+                mem_avail += self.bmPu.nbytes / 1e6
+            if mem > mem_avail:
+                self.mo_cas = self.bmPu = None
+            else:
+                self.mo_cas, self.bmPu = mo_cas.copy (), bmPu
+
+    def free_bmPu (self):
+        '''Drop the reference to bmPu, keeping the CDERI sparsity indices'''
+        with _DF_WORKSPACE_LOCK:
+            self.mo_cas = self.bmPu = None
+
+    def reset (self):
+        with _DF_WORKSPACE_LOCK:
+            self.mo_cas = self.bmPu = self._ovlp = self._bPmn = None
+            self._sparsity = {}
+
+def get_df_workspace (las):
+    '''The DFWorkspace attached to las, created (or re-created, if las.with_df or las.mol has
+    changed) as necessary'''
+    ws = getattr (las, '_df_workspace', None)
+    if (ws is None or ws.with_df is not las.with_df or ws.mol is not las.mol
+            or ws.cderi is not getattr (las.with_df, '_cderi', None)):
+        ws = las._df_workspace = DFWorkspace (las)
+    ws.max_memory = las.max_memory
+    return ws
+
+def _get_h2eff_from_bmPu (mo_coeff, mo_cas, bmPu):
+    nmo, ncas = mo_coeff.shape[1], mo_cas.shape[1]
+    eri = 0
+    for p0, p1, bmPu_blk in loop_bmPu (bmPu):
+        bmuP = bmPu_blk.transpose (0,2,1)
+        buvP = np.tensordot (mo_cas.conjugate (), bmuP, axes=((0),(0)))
+        eri1 = np.tensordot (bmuP, buvP, axes=((2),(2)))
+        eri1 = np.tensordot (mo_coeff.conjugate (), eri1, axes=((0),(0)))
+        eri += lib.pack_tril (eri1.reshape (nmo*ncas, ncas, ncas)).reshape (nmo, -1)
+        bmuP = buvP = eri1 = None
+    return eri
 
 def get_h2eff_df (las, mo_coeff):
     # Store intermediate with one contracted ao index for faster calculation of exchange!
@@ -10,6 +214,12 @@ def get_h2eff_df (las, mo_coeff):
     ncore, ncas = las.ncore, las.ncas
     nocc = ncore + ncas
     mo_cas = mo_coeff[:,ncore:nocc]
+    ws = get_df_workspace (las)
+    bmPu = ws.get_bmPu (mo_cas)
+    if bmPu is not None:
+        log.debug ("LAS DF ERI from cached intermediate")
+        eri = _get_h2eff_from_bmPu (mo_coeff, mo_cas, bmPu)
+        return lib.tag_array (eri, bmPu=bmPu)
     naux = las.with_df.get_naoaux ()
     log.debug2 ("LAS DF ERIs: %d MB used of %d MB total available", lib.current_memory ()[0], las.max_memory)
     mem_eris = 8*(nao+nmo)*ncas*ncas*ncas / 1e6
@@ -21,6 +231,10 @@ def get_h2eff_df (las, mo_coeff):
         mem_av -= mem_int
         bmuP = []
         log.debug ("LAS DF ERI including intermediate cache")
+    elif DF_OUTCORE_BMPU:
+        bmPu_outcore = OutcoreBmPu (nao, naux, ncas, dtype=mo_coeff.dtype,
+                                    max_memory=las.max_memory)
+        log.debug ("LAS DF ERI including intermediate cache on disk")
     else:
         log.debug ("LAS DF ERI not including intermediate cache")
     safety_factor = 1.1
@@ -40,21 +254,28 @@ def get_h2eff_df (las, mo_coeff):
     log.debug2 ("LAS DF ERI blksize = %d, mem_av = %d MB, mem_per_aux = %d MB", blksize, mem_av, mem_per_aux)
     log.debug2 ("LAS DF ERI naux = %d, nao = %d, nmo = %d", naux, nao, nmo)
     eri = 0
-    for cderi in las.with_df.loop (blksize=blksize):
-        bPmn = sparsedf_array (cderi)
+    p1 = 0
+    for cderi, bPmn in ws.loop (blksize):
+        p0, p1 = p1, p1 + bPmn.shape[0]
         log.debug2 ("LAS DF ERI bPmn shape = %s; shares memory? %s %s; C_CONTIGUOUS? %s",
                   str (bPmn.shape), str (np.shares_memory (bPmn, cderi)),
                   str (np.may_share_memory (bPmn, cderi)),
                   str (bPmn.flags['C_CONTIGUOUS']))
         bmuP1 = bPmn.contract1 (mo_cas)
         if mem_enough_int: bmuP.append (bmuP1)
+        elif DF_OUTCORE_BMPU: bmPu_outcore.write (p0, p1, bmuP1.transpose (0,2,1))
         buvP = np.tensordot (mo_cas.conjugate (), bmuP1, axes=((0),(0)))
         eri1 = np.tensordot (bmuP1, buvP, axes=((2),(2)))
         eri1 = np.tensordot (mo_coeff.conjugate (), eri1, axes=((0),(0)))
         eri += lib.pack_tril (eri1.reshape (nmo*ncas, ncas, ncas)).reshape (nmo, -1)
         cderi = bPmn = bmuP1 = buvP = eri1 = None
     if mem_enough_int:
-        eri = lib.tag_array (eri, bmPu=np.concatenate (bmuP, axis=-1).transpose (0,2,1))
+        bmPu = np.concatenate (bmuP, axis=-1).transpose (0,2,1)
+        ws.set_bmPu (mo_cas, bmPu)
+        eri = lib.tag_array (eri, bmPu=bmPu)
+    elif DF_OUTCORE_BMPU:
+        ws.set_bmPu (mo_cas, bmPu_outcore)
+        eri = lib.tag_array (eri, bmPu=bmPu_outcore)
     if las.verbose > lib.logger.DEBUG:
         eri_comp = las.with_df.ao2mo (mo_coeff, compact=True)
         eri_comp = eri_comp[:,ncore:nocc,ncore:nocc,ncore:nocc]
@@ -89,17 +310,52 @@ def get_h2eff (las, mo_coeff=None):
             eri = ao2mo.restore ('2kl', eri, nmo).reshape (nmo, ncas*ncas*(ncas+1)//2)
     return eri
 
+def _tril_addr (idx_r, idx_s):
+    '''Addresses of the index pairs (r,s) in a lower-triangular-packed symmetric matrix'''
+    r = np.asarray (idx_r)[:,None]
+    s = np.asarray (idx_s)[None,:]
+    return np.where (r>=s, r*(r+1)//2+s, s*(s+1)//2+r)
+
+def get_h2eff_block (las, h2eff, idx, ncore=None, ncas=None):
+    '''Extract a block (pq|rs) of the active-space ERIs directly from the packed h2eff array,
+    without unpacking the whole active-space block to ncas**4.
+
+    Args:
+        h2eff : ndarray of shape (nmo,ncas**2*(ncas+1)/2)
+            Contains ERIs (p1a1|a2a3), lower-triangular in the a2a3 indices
+        idx : sequence of length 4
+            Slices or integer arrays addressing active orbitals for each of p,q,r,s
+
+    Kwargs:
+        ncore : integer
+            Defaults to las.ncore
+        ncas : integer
+            Defaults to las.ncas
+
+    Returns:
+        eri : ndarray of shape (len(p),len(q),len(r),len(s))
+    '''
+    if ncore is None: ncore = las.ncore
+    if ncas is None: ncas = las.ncas
+    nmo = h2eff.shape[0]
+    p, q, r, s = [np.arange (ncas)[ix] for ix in idx]
+    eri = np.asarray (h2eff).reshape (nmo, ncas, -1)
+    eri = eri[np.ix_(ncore+p, q, _tril_addr (r, s).ravel ())]
+    return eri.reshape (len (p), len (q), len (r), len (s))
+
 def get_h2eff_slice (las, h2eff, idx, compact=None):
+    '''Extract the ERIs (ij|kl) of fragment idx from h2eff. If h2eff carries a dict-valued tag
+    "slice_cache" (see ci_cycle), the result is memoized there for the lifetime of that tag.'''
+    cache = getattr (h2eff, 'slice_cache', None)
+    if cache is not None and (idx, compact) in cache:
+        return cache[(idx, compact)]
     ncas_cum = np.cumsum ([0] + las.ncas_sub.tolist ())
     i = ncas_cum[idx]
     j = ncas_cum[idx+1]
-    ncore = las.ncore
-    nocc = ncore + las.ncas
-    eri = h2eff[ncore:nocc,:].reshape (las.ncas*las.ncas, -1)
-    ix_i, ix_j = np.tril_indices (las.ncas)
-    eri = eri[(ix_i*las.ncas)+ix_j,:]
-    eri = ao2mo.restore (1, eri, las.ncas)[i:j,i:j,i:j,i:j]
+    frag = slice (i, j)
+    eri = get_h2eff_block (las, h2eff, (frag, frag, frag, frag))
     if compact: eri = ao2mo.restore (compact, eri, j-i)
+    if cache is not None: cache[(idx, compact)] = eri
     return eri
 
 def get_h2cas (las, mo_coeff=None):
@@ -270,17 +270,21 @@ def h1e_for_las (las, mo_coeff=None, ncas=None, ncore=None, nelecas=None, ci=Non
     moH_cas = mo_cas.conj ().T 
     h1e = moH_cas @ (las.get_hcore ()[None,:,:] + veff) @ mo_cas
     h1e_r = np.empty ((las.nroots, 2, ncas, ncas), dtype=h1e.dtype)
-    h2e = lib.numpy_helper.unpack_tril (h2eff_sub.reshape (nmo*ncas,
-        ncas*(ncas+1)//2)).reshape (nmo, ncas, ncas, ncas)[ncore:nocc,:,:,:]
-    avgdm1s = np.stack ([linalg.block_diag (*[dm[spin] for dm in casdm1s_sub])
-                         for spin in range (2)], axis=0)
-    for state in range (las.nroots):
-        statedm1s = np.stack ([linalg.block_diag (*[dm[state][spin] for dm in casdm1frs])
-                               for spin in range (2)], axis=0)
-        dm1s = statedm1s - avgdm1s 
-        j = np.tensordot (dm1s, h2e, axes=((1,2),(2,3)))
-        k = np.tensordot (dm1s, h2e, axes=((1,2),(2,1)))
-        h1e_r[state] = h1e + j + j[::-1] - k
+    h1e_r[:,:,:,:] = h1e[None,:,:,:]
+    # The density-matrix differences are block-diagonal, so only the (aa|ff) and (af|fa) blocks
+    # of the ERIs are needed, where f spans one fragment
+    ncas_cum = np.cumsum ([0] + list (ncas_sub))
+    frags = [slice (i, j) for i, j in zip (ncas_cum[:-1], ncas_cum[1:])]
+    allcas = slice (0, ncas)
+    h2e_j = [las_ao2mo.get_h2eff_block (las, h2eff_sub, (allcas, allcas, f, f), ncore=ncore,
+                                        ncas=ncas) for f in frags]
+    h2e_k = [las_ao2mo.get_h2eff_block (las, h2eff_sub, (allcas, f, f, allcas), ncore=ncore,
+                                        ncas=ncas) for f in frags]
+    for casdm1s_r, casdm1s, eri_j, eri_k in zip (casdm1frs, casdm1s_sub, h2e_j, h2e_k):
+        dm1rs = np.asarray (casdm1s_r) - casdm1s[None,:,:,:]
+        j = np.tensordot (dm1rs, eri_j, axes=((2,3),(2,3)))
+        k = np.tensordot (dm1rs, eri_k, axes=((2,3),(2,1)))
+        h1e_r += j + j[:,::-1] - k
 
 
     # Second pass: split by fragment and subtract double-counting
@@ -1844,40 +1848,34 @@ class LASCINoSymm (casci.CASCI):
         h1eff = self.get_hcore () + veff_core
         e0 = 2*np.dot (((h1eff-(veff_core/2)) @ mo_core).ravel (), mo_core.conj().ravel ())
         h1eff = mo_cas.conj ().T @ h1eff @ mo_cas
-        eri_cas = lib.numpy_helper.unpack_tril (h2eff.reshape (nmo*ncas, ncas*(ncas+1)//2))
-        eri_cas = eri_cas.reshape (nmo, ncas, ncas, ncas)
-        eri_cas = eri_cas[ncore:nocc]
+        eri_cas = h2eff.reshape (nmo, ncas*ncas*(ncas+1)//2)[ncore:nocc]
+        eri_cas = lib.numpy_helper.unpack_tril (eri_cas.reshape (ncas*ncas, ncas*(ncas+1)//2))
+        eri_cas = eri_cas.reshape (ncas, ncas, ncas, ncas)
         casdm1rs = self.states_make_casdm1s (ci=ci, ncas_sub=ncas_sub, nelecas_sub=nelecas_sub,
                                              casdm1frs=casdm1frs)
         vj_r = np.tensordot (casdm1rs.sum (1), eri_cas, axes=2)
         vk_rs = np.tensordot (casdm1rs, eri_cas, axes=((2,3),(2,1)))
         veff_rs = vj_r[:,None,:,:] - vk_rs
 
-        energy_elec = []
-        for idx, (dm1s, v) in enumerate (zip (casdm1rs, veff_rs)):
-            casdm1fs = [dm[idx] for dm in casdm1frs]
-            casdm2f = [dm[idx] for dm in casdm2fr]
-            
-            # 1-body veff terms
-            h1e = h1eff[None,:,:] + v/2
-            e1 = np.dot (h1e.ravel (), dm1s.ravel ())
-
-            # 2-body cumulant terms
-            e2 = 0
-            for isub, (dm1s, dm2) in enumerate (zip (casdm1fs, casdm2f)):
-                dm1a, dm1b = dm1s[0], dm1s[1]
-                dm1 = dm1a + dm1b
-                cdm2 = dm2 - np.multiply.outer (dm1, dm1)
-                cdm2 += np.multiply.outer (dm1a, dm1a).transpose (0,3,2,1)
-                cdm2 += np.multiply.outer (dm1b, dm1b).transpose (0,3,2,1)
-                eri = self.get_h2eff_slice (h2eff, isub)
-                te2 = np.tensordot (eri, cdm2, axes=4) / 2
-                e2 += te2
-            energy_elec.append (e0 + e1 + e2)
-            self._e1_ref = e0 + e1
-            self._e2_ref = e2
-
-        return energy_elec
+        # 1-body veff terms
+        h1e = h1eff[None,None,:,:] + veff_rs/2
+        e1 = np.einsum ('rspq,rspq->r', h1e, casdm1rs)
+
+        # 2-body cumulant terms, all states at once
+        e2 = 0
+        for isub, (dm1rs, dm2r) in enumerate (zip (casdm1frs, casdm2fr)):
+            dm1rs, dm2r = np.asarray (dm1rs), np.asarray (dm2r)
+            dm1r = dm1rs.sum (1)
+            cdm2r = dm2r - lib.einsum ('rij,rkl->rijkl', dm1r, dm1r)
+            cdm2r += lib.einsum ('rij,rkl->rilkj', dm1rs[:,0], dm1rs[:,0])
+            cdm2r += lib.einsum ('rij,rkl->rilkj', dm1rs[:,1], dm1rs[:,1])
+            eri = self.get_h2eff_slice (h2eff, isub)
+            e2 = e2 + np.tensordot (cdm2r, eri, axes=4) / 2
+        energy_elec = e0 + e1 + e2
+        self._e1_ref = e0 + e1[-1]
+        self._e2_ref = (e2 + np.zeros_like (e1))[-1]
+
+        return list (energy_elec)
 
     def energy_elec (self, mo_coeff=None, ncore=None, ncas=None,
             ncas_sub=None, nelecas_sub=None, ci=None, h2eff=None, veff=None,
@@ -1945,6 +1943,25 @@ class LASCINoSymm (casci.CASCI):
         return bPij
 
     def fast_veffa (self, casdm1s_sub, h2eff_sub, mo_coeff=None, ci=None, _full=False):
+        casdm1frs = [np.asarray (dm)[None,:,:,:] for dm in casdm1s_sub]
+        return self.states_fast_veffa (casdm1frs, h2eff_sub, mo_coeff=mo_coeff, ci=ci,
+                                       _full=_full)[0]
+
+    def states_fast_veffa (self, casdm1frs, h2eff_sub, mo_coeff=None, ci=None, _full=True):
+        ''' fast_veffa for all states at once: the J and K matrices of the active-space 1-RDMs
+        of every state are built together, and the block-diagonal structure of those 1-RDMs is
+        exploited in the K matrices.
+
+        Args:
+            casdm1frs : list (length=nfrags) of ndarrays of shape (nroots,2,ncas_sub[i],ncas_sub[i])
+                Spin-separated 1-RDMs for each state in the localized active subspaces
+            h2eff_sub : ndarray of shape (nmo,ncas**2*(ncas+1)/2)
+                Possibly tagged with bmPu
+
+        Returns:
+            veffa : ndarray of shape (nroots,2,nao,nao) if _full else (nroots,nao,nao)
+                Spin-separated (or spin-summed) effective potential of the active electrons
+        '''
         if mo_coeff is None: mo_coeff = self.mo_coeff
         if ci is None: ci = self.ci
         assert (isinstance (self, _DFLASCI) or _full)
@@ -1953,34 +1970,54 @@ class LASCINoSymm (casci.CASCI):
         ncas = sum (ncas_sub)
         nocc = ncore + ncas
         nao, nmo = mo_coeff.shape
+        nroots = len (casdm1frs[0])
+        ncas_cum = np.cumsum ([0] + list (ncas_sub))
+        frags = [(i, j) for i, j in zip (ncas_cum[:-1], ncas_cum[1:])]
 
         mo_cas = mo_coeff[:,ncore:nocc]
         moH_cas = mo_cas.conjugate ().T
-        moH_coeff = mo_coeff.conjugate ().T
-        dma = linalg.block_diag (*[dm[0] for dm in casdm1s_sub])
-        dmb = linalg.block_diag (*[dm[1] for dm in casdm1s_sub])
-        casdm1s = np.stack ([dma, dmb], axis=0)
+        casdm1rs = np.zeros ((nroots, 2, ncas, ncas), dtype=mo_coeff.dtype)
+        for (i, j), dm in zip (frags, casdm1frs):
+            casdm1rs[:,:,i:j,i:j] = dm
         if not (isinstance (self, _DFLASCI)):
-            dm1s = np.dot (mo_cas, np.dot (casdm1s, moH_cas)).transpose (1,0,2)
-            return self.get_veff (dm1s = dm1s, spin_sep=True)
-        casdm1 = casdm1s.sum (0)
-        dm1 = np.dot (mo_cas, np.dot (casdm1, moH_cas))
-        bPmn = sparsedf_array (self.with_df._cderi)
+            dm1rs = np.dot (mo_cas, np.dot (casdm1rs, moH_cas)).transpose (1,2,0,3)
+            vj, vk = self._scf.get_jk (self.mol, dm1rs.reshape (nroots*2, nao, nao), hermi=1)
+            vj = vj.reshape (nroots, 2, nao, nao)
+            vk = vk.reshape (nroots, 2, nao, nao)
+            return vj.sum (1)[:,None,:,:] - vk
+        casdm1r = casdm1rs.sum (1)
+        dm1r = np.dot (mo_cas, np.dot (casdm1r, moH_cas)).transpose (1,0,2)
+        ws = las_ao2mo.get_df_workspace (self)
+        bPmn = ws.bPmn
 
         # vj
-        dm_tril = dm1 + dm1.T - np.diag (np.diag (dm1.T))
-        rho = np.dot (bPmn, lib.pack_tril (dm_tril))
-        vj = lib.unpack_tril (np.dot (rho, bPmn))
-
-        # vk
-        bmPu = h2eff_sub.bmPu
+        dm_tril = dm1r + dm1r.transpose (0,2,1)
+        idx = np.arange (nao)
+        dm_tril[:,idx,idx] -= dm1r[:,idx,idx]
+        rho = np.dot (bPmn, lib.pack_tril (dm_tril).T)
+        vj = lib.unpack_tril (np.dot (rho.T, bPmn))
+
+        # vk: only the diagonal fragment blocks of the 1-RDMs are nonzero
+        bmPu = getattr (h2eff_sub, 'bmPu', None)
+        if bmPu is None: bmPu = ws.get_bmPu (mo_cas)
+        vk = np.zeros ((nroots, 2, nao, nao) if _full else (nroots, nao, nao), dtype=vj.dtype)
+        for p0, p1, bmPu_blk in las_ao2mo.loop_bmPu (bmPu):
+            for i, j in frags:
+                bmPf = np.ascontiguousarray (bmPu_blk[:,:,i:j])
+                mem = max (self.max_memory - lib.current_memory ()[0], 0)
+                rblk = max (1, int (mem*1e6/8 / (2*nao*(p1-p0)*(j-i))) // 2)
+                for r0, r1 in lib.prange (0, nroots, rblk):
+                    if _full:
+                        vmPrsf = np.dot (bmPf, casdm1rs[r0:r1,:,i:j,i:j])
+                        vk[r0:r1] += np.tensordot (vmPrsf, bmPf,
+                                                   axes=((1,4),(1,2))).transpose (1,2,0,3)
+                    else:
+                        vmPrf = np.dot (bmPf, casdm1r[r0:r1,i:j,i:j])
+                        vk[r0:r1] += np.tensordot (vmPrf, bmPf,
+                                                   axes=((1,3),(1,2))).transpose (1,0,2)
         if _full:
-            vmPsu = np.dot (bmPu, casdm1s)
-            vk = np.tensordot (vmPsu, bmPu, axes=((1,3),(1,2))).transpose (1,0,2)
-            return vj[None,:,:] - vk
+            return vj[:,None,:,:] - vk
         else:
-            vmPu = np.dot (bmPu, casdm1)
-            vk = np.tensordot (vmPu, bmPu, axes=((1,2),(1,2)))
             return vj - vk/2
 
     @lib.with_doc(run_lasci.__doc__)
@@ -1,9 +1,36 @@
 from pyscf import lib, symm
+from pyscf.fci import cistring
+from pyscf.fci.direct_spin1 import _unpack_nelec
 from mrh.my_pyscf.fci.csfstring import ImpossibleCIvecError
 from mrh.my_pyscf.mcscf import _DFLASCI
+from mrh.my_pyscf.mcscf.addons import map_frags
+from mrh.my_pyscf.mcscf.las_ao2mo import rotate_bmPu
 from scipy.sparse import linalg as sparse_linalg
 from scipy import linalg 
 import numpy as np
+from pyscf import __config__
+
+# Maximum number of fragment CI problems solved concurrently by ci_cycle. None means
+# lib.num_threads (). Opt-in, because the OpenMP threads are divided equally among the
+# fragments regardless of their size.
+CI_CYCLE_NTHREADS = getattr (__config__, 'lasci_sync_ci_cycle_nthreads', 1)
+
+# h2eff_sub is rotated incrementally between macrocycles (see
+# LASCI_HessianOperator._update_h2eff_sub). If nonzero, it is instead recomputed from scratch
+# every this many macrocycles to bound the accumulation of roundoff error.
+H2EFF_REFRESH_CYCLE = getattr (__config__, 'lasci_sync_h2eff_refresh_cycle', 0)
+
+# Microiteration engine: 'cg' (scipy.sparse.linalg.cg), 'pcg' (lasci_sync.pcg, which reports
+# the residual without an extra matvec and is warm-started from the previous macrocycle's step), or
+# 'minres' (scipy.sparse.linalg.minres, which does not assume that the Hessian is positive-definite)
+MICROIT_SOLVER = getattr (__config__, 'lasci_sync_microit_solver', 'cg')
+# Microiteration preconditioner: 'diag' (LASCI_HessianOperator.get_prec) or 'block'
+# (LASCI_HessianOperator.get_prec_block, which inverts the CI-CI block of each fragment and state
+# exactly in its eigenbasis, with the same level shift and masking as get_prec)
+MICROIT_PREC = getattr (__config__, 'lasci_sync_microit_prec', 'diag')
+# Largest CI block (number of CSFs of one fragment and state) inverted exactly by
+# LASCI_HessianOperator.get_prec_block; larger blocks are treated diagonally
+PREC_BLOCK_MAXSIZE = getattr (__config__, 'lasci_sync_prec_block_maxsize', 64)
 
 # This must be locked to CSF solver for the forseeable future, because I know of no other way to
 # handle spin-breaking potentials while retaining spin constraint
@@ -11,6 +38,84 @@ import numpy as np
 class MicroIterInstabilityException (Exception):
     pass
 
+def pcg (A, b, x0=None, M=None, atol=0.0, rtol=1e-5, maxiter=None, callback=None, xguess=None):
+    '''Preconditioned conjugate gradient for Ax = b. Unlike scipy.sparse.linalg.cg, the
+    recursively-updated residual r = b - Ax is passed to the callback as callback (x, r), so
+    that it need not be recomputed with an extra matvec.
+
+    Args:
+        A : LinearOperator
+        b : ndarray of shape (n,)
+
+    Kwargs:
+        x0 : ndarray of shape (n,)
+            Initial guess
+        M : LinearOperator
+            Preconditioner
+        atol, rtol : float
+            Converged when |r| <= max (atol, rtol*|b|)
+        maxiter : integer
+        callback : callable
+            Called as callback (x, r) after each iteration
+        xguess : list of ndarrays of shape (n,)
+            Additional vectors (e.g., the step of a previous problem). If provided, the
+            iterations start from the minimizer of the quadratic model in the span of x0 and
+            xguess, at the cost of one extra matvec per vector.
+
+    Returns:
+        x : ndarray of shape (n,)
+        info : integer
+            0 if converged; otherwise, the number of iterations
+    '''
+    b = np.asarray (b)
+    n = b.size
+    if maxiter is None: maxiter = 10*n
+    if x0 is None: x0 = np.zeros_like (b)
+    precond = (lambda r: r) if M is None else getattr (M, 'matvec', M)
+    x = np.array (x0, copy=True)
+    Ax = A.matvec (x)
+    if xguess is not None:
+        xguess = [v for v in xguess if v is not None and v.shape == b.shape and np.any (v)]
+    if xguess:
+        vecs = [x,] + xguess
+        Avecs = [Ax,] + [A.matvec (v) for v in xguess]
+        vAv = np.array ([[v.dot (Av) for Av in Avecs] for v in vecs])
+        vAv = (vAv + vAv.T) / 2
+        vb = np.array ([v.dot (b) for v in vecs])
+        try:
+            c = linalg.solve (vAv, vb, assume_a='sym')
+            c0 = np.zeros_like (c)
+            c0[0] = 1
+            qmodel = lambda c: c.dot (vAv).dot (c) / 2 - c.dot (vb)
+            x1 = sum ([ci*v for ci, v in zip (c, vecs)])
+            Ax1 = sum ([ci*Av for ci, Av in zip (c, Avecs)])
+            # Only accept the warm start if it is better in every sense
+            if (qmodel (c) < qmodel (c0)) and (linalg.norm (b-Ax1) < linalg.norm (b-Ax)):
+                x, Ax = x1, Ax1
+        except (linalg.LinAlgError, ValueError):
+            pass
+    r = b - Ax
+    tol = max (atol, rtol*linalg.norm (b))
+    if linalg.norm (r) <= tol: return x, 0
+    z = precond (r)
+    p = z.copy ()
+    rz = r.dot (z)
+    for it in range (maxiter):
+        Ap = A.matvec (p)
+        pAp = p.dot (Ap)
+        # Breakdown (e.g., the preconditioner masks the entire residual): not converged
+        if pAp == 0 or rz == 0: return x, it+1
+        alpha = rz / pAp
+        x += alpha * p
+        r -= alpha * Ap
+        if callback is not None: callback (x, r)
+        if linalg.norm (r) <= tol: return x, 0
+        z = precond (r)
+        rz_new = r.dot (z)
+        p = z + (rz_new / rz) * p
+        rz = rz_new
+    return x, maxiter
+
 def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4, 
         assert_no_dupes=False, verbose=lib.logger.NOTE):
     from mrh.my_pyscf.mcscf.lasci import _eig_inactive_virtual
@@ -55,11 +160,15 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
     t1 = log.timer('LASCI initial get_veff', *t1)
 
     ugg = None
+    x_prev = None
     converged = False
     ci1 = ci0
     t2 = (t1[0], t1[1])
     it = 0
     for it in range (las.max_cycle_macro):
+        if it and H2EFF_REFRESH_CYCLE and (it % H2EFF_REFRESH_CYCLE == 0):
+            h2eff_sub = las.get_h2eff (mo_coeff)
+            t1 = log.timer ('LASCI integral transformation refresh', *t1)
         e_cas, ci1 = ci_cycle (las, mo_coeff, ci1, veff, h2eff_sub, casdm1frs, log)
         if ugg is None: ugg = las.get_ugg (mo_coeff, ci1)
         log.info ('LASCI subspace CI energies: {}'.format (e_cas))
@@ -75,7 +184,10 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
         mo_coeff = mo_coeff @ umat
         if orbsym is not None:
             mo_coeff = lib.tag_array (mo_coeff, orbsym=orbsym)
-        h2eff_sub[:,:] = umat.conj ().T @ h2eff_sub
+        # umat is block-diagonal and leaves the active orbitals alone
+        ncore, nocc = las.ncore, las.ncore + las.ncas
+        for i, j in ((0, ncore), (nocc, umat.shape[0])):
+            if j > i: h2eff_sub[i:j,:] = umat[i:j,i:j].conj ().T @ h2eff_sub[i:j]
 
         casdm1s_new = las.make_casdm1s_sub (ci=ci1)
         if not isinstance (las, _DFLASCI) or las.verbose > lib.logger.DEBUG:
@@ -113,7 +225,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
             err = linalg.norm (g_ci_test - g_vec[ugg.nvar_orb:])
             assert (err < 1e-5), '{}'.format (err)
         gx = H_op.get_gx ()
-        prec_op = H_op.get_prec ()
+        # MINRES requires a positive-definite preconditioner
+        prec_kwargs = {'positive': (MICROIT_SOLVER == 'minres')}
+        if MICROIT_PREC == 'block':
+            prec_op = H_op.get_prec_block (**prec_kwargs)
+        else:
+            prec_op = H_op.get_prec (**prec_kwargs)
         prec = prec_op (np.ones_like (g_vec)) # Check for divergences
         norm_gorb = linalg.norm (g_vec[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
         norm_gci = linalg.norm (g_vec[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
@@ -139,7 +256,7 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
         microit = [0]
         last_x = [0]
         first_norm_x = [None]
-        def my_callback (x):
+        def my_callback (x, r=None):
             microit[0] += 1
             norm_xorb = linalg.norm (x[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
             norm_xci = linalg.norm (x[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
@@ -148,8 +265,12 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
             x_max = x[addr_max]/np.pi
             log.debug ('Maximum step vector element x[{}] = {}*pi ({})'.format (addr_max, x_max, id_max))
             if las.verbose > lib.logger.INFO:
-                Hx = H_op._matvec (x) # This doubles the price of each iteration!!
-                resid = g_vec + Hx
+                if r is None: # minres only
+                    Hx = H_op._matvec (x) # This doubles the price of each iteration!!
+                    resid = g_vec + Hx
+                else: # r = -g_vec - Hx
+                    resid = -r
+                    Hx = resid - g_vec
                 norm_gorb = linalg.norm (resid[:ugg.nvar_orb]) if ugg.nvar_orb else 0.0
                 norm_gci = linalg.norm (resid[ugg.nvar_orb:]) if ugg.ncsf_sub.sum () else 0.0
                 xorb, xci = ugg.unpack (x)
@@ -177,9 +298,23 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
 
         my_tol = max (conv_tol_grad, norm_gx/10)
         try:
-            x = sparse_linalg.cg (H_op, -g_vec, x0=x0, atol=my_tol,
-                                  maxiter=las.max_cycle_micro, callback=my_callback,
-                                  M=prec_op)[0]
+            if MICROIT_SOLVER == 'pcg' or (MICROIT_SOLVER == 'cg'
+                                           and las.verbose > lib.logger.INFO):
+                # For 'cg', this is the same algorithm as scipy's, but the callback receives the
+                # residual, so the verbose energy printout does not cost an extra matvec
+                xguess = [x_prev] if MICROIT_SOLVER == 'pcg' else None
+                x = pcg (H_op, -g_vec, x0=x0, atol=my_tol, maxiter=las.max_cycle_micro,
+                         callback=my_callback, M=prec_op, xguess=xguess)[0]
+            elif MICROIT_SOLVER == 'minres':
+                norm_g = linalg.norm (g_vec)
+                x = sparse_linalg.minres (H_op, -g_vec, x0=x0, rtol=my_tol/norm_g,
+                                          maxiter=las.max_cycle_micro, callback=my_callback,
+                                          M=prec_op)[0]
+            else:
+                x = sparse_linalg.cg (H_op, -g_vec, x0=x0, atol=my_tol,
+                                      maxiter=las.max_cycle_micro, callback=my_callback,
+                                      M=prec_op)[0]
+            x_prev = x.copy ()
             t1 = log.timer ('LASCI {} microcycles'.format (microit[0]), *t1)
             mo_coeff, ci1, h2eff_sub = H_op.update_mo_ci_eri (x, h2eff_sub)
             t1 = log.timer ('LASCI Hessian update', *t1)
@@ -192,6 +327,7 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
             log.info ('Unstable microiteration aborted: %s', str (e))
             t1 = log.timer ('LASCI {} microcycles'.format (microit[0]), *t1)
             x = last_x[0]
+            x_prev = None
             for i in range (3): # Make up to 3 attempts to scale-down x if necessary
                 mo2, ci2, h2eff_sub2 = H_op.update_mo_ci_eri (x, h2eff_sub)
                 t1 = log.timer ('LASCI Hessian update', *t1)
@@ -220,9 +356,7 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
         e_tot_test = las.get_hop (ugg=ugg, mo_coeff=mo_coeff, ci=ci1, h2eff_sub=h2eff_sub,
                                   veff=veff, do_init_eri=False).e_tot
     dm_core = 2 * mo_coeff[:,:las.ncore] @ mo_coeff[:,:las.ncore].conj ().T
-    veff_a = np.stack ([las.fast_veffa ([d[state] for d in casdm1frs], h2eff_sub,
-                                        mo_coeff=mo_coeff, ci=ci1, _full=True)
-                        for state in range (las.nroots)], axis=0)
+    veff_a = las.states_fast_veffa (casdm1frs, h2eff_sub, mo_coeff=mo_coeff, ci=ci1, _full=True)
     veff_c = las.get_veff (dm1s=dm_core)
     # veff's spin-summed component should be correct because I called get_veff with spin-summed rdm
     veff = veff_c[None,None,:,:] + veff_a 
@@ -251,19 +385,30 @@ def kernel (las, mo_coeff=None, ci0=None, casdm0_fr=None, conv_tol_grad=1e-4,
 
     las.dump_chk (mo_coeff=mo_coeff, ci=ci1)
 
+    # bmPu survives in h2eff_sub if the caller keeps it; the workspace need not hold it too
+    ws = getattr (las, '_df_workspace', None)
+    if ws is not None: ws.free_bmPu ()
+
     return converged, e_tot, e_states, mo_energy, mo_coeff, e_cas, ci1, h2eff_sub, veff
 
-def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log):
+def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log, nthreads=None):
+    '''Solve the CI problems of all fragments in the mean field of each other. The fragment
+    problems are independent, so they are solved concurrently in up to nthreads Python threads
+    (default: CI_CYCLE_NTHREADS = 1; None means lib.num_threads ()), as many as max_memory permits, which
+    share the OpenMP threads equally.'''
     if ci0 is None: ci0 = [None for idx in range (las.nfrags)]
     frozen_ci = las.frozen_ci
     if frozen_ci is None: frozen_ci = []
+    if nthreads is None: nthreads = CI_CYCLE_NTHREADS
+    if nthreads is None: nthreads = lib.num_threads ()
     # CI problems
     t1 = (lib.logger.process_clock(), lib.logger.perf_counter())
+    # Fragment ERI slices are memoized on this view of h2eff_sub for the rest of this cycle
+    h2eff_sub = lib.tag_array (h2eff_sub, slice_cache={})
     h1eff_sub = las.get_h1eff (mo, veff=veff, h2eff_sub=h2eff_sub, casdm1frs=casdm1frs)
     ncas_cum = np.cumsum ([0] + las.ncas_sub.tolist ()) + las.ncore
-    e_cas = []
-    ci1 = []
     e0 = 0.0 
+    kernel_args = []
     for isub, (fcibox, ncas, nelecas, h1e, fcivec) in enumerate (zip (las.fciboxes, las.ncas_sub,
                                                                       las.nelecas_sub, h1eff_sub,
                                                                       ci0)):
@@ -292,7 +437,11 @@ def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log):
                     wfnsym_str = symm.irrep_id2name (las.mol.groupname, wfnsym)
                 log.debug1 ("LASCI subspace {} state {} with wfnsym {}".format (isub, state,
                                                                                 wfnsym_str))
+        kernel_args.append ((fcibox, h1e, eri_cas, ncas, nelecas, fcivec, orbsym))
 
+    def solve_frag (isub):
+        fcibox, h1e, eri_cas, ncas, nelecas, fcivec, orbsym = kernel_args[isub]
+        t1 = (lib.logger.process_clock(), lib.logger.perf_counter())
         if isub not in frozen_ci:
             e_sub, fcivec = fcibox.kernel(h1e, eri_cas, ncas, nelecas,
                                           ci0=fcivec, verbose=log,
@@ -300,11 +449,30 @@ def ci_cycle (las, mo, ci0, veff, h2eff_sub, casdm1frs, log):
                                           ecore=e0, orbsym=orbsym)
         else:
             e_sub = 0 # TODO: proper energy calculation (probably doesn't matter tho)
-        e_cas.append (e_sub)
-        ci1.append (fcivec)
-        t1 = log.timer ('FCI box for subspace {}'.format (isub), *t1)
+        log.timer ('FCI box for subspace {}'.format (isub), *t1)
+        return e_sub, fcivec
+
+    results = map_frags (solve_frag, range (las.nfrags), nthreads=nthreads,
+                         mem_frag=_get_ci_cycle_mem (las), max_memory=las.max_memory)
+    e_cas = [r[0] for r in results]
+    ci1 = [r[1] for r in results]
     return e_cas, ci1
 
+def _get_ci_cycle_mem (las):
+    '''Rough scratch memory in MB of the largest fragment CI problem: Davidson subspace and
+    sigma vectors for all states'''
+    mem = 0
+    for fcibox, ncas, nelecas in zip (las.fciboxes, las.ncas_sub, las.nelecas_sub):
+        mem_f = 0
+        for solver in fcibox.fcisolvers:
+            neleca, nelecb = _unpack_nelec (fcibox._get_nelec (solver, nelecas))
+            ndet = cistring.num_strings (ncas, neleca) * cistring.num_strings (ncas, nelecb)
+            max_space = getattr (solver, 'max_space', 12) or 12
+            nroots = getattr (solver, 'nroots', 1) or 1
+            mem_f += 2 * (max_space+1) * nroots * ndet * 8 / 1e6
+        mem = max (mem, mem_f)
+    return mem
+
 def all_nonredundant_idx (nmo, ncore, ncas_sub):
     ''' Generate a index mask array addressing all nonredundant, lower-triangular elements of an
     nmo-by-nmo orbital-rotation unitary generator amplitude matrix for a LASSCF or LASCI problem
@@ -776,7 +944,9 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         for fcibox, no, ne in zip (self.fciboxes, ncas_sub, nelecas_sub):
             self.linkstrl.append (fcibox.states_gen_linkstr (no, ne, True)) 
             self.linkstr.append (fcibox.states_gen_linkstr (no, ne, False))
-        self.hci0 = self.Hci_all (None, self.h1frs, self.eri_cas, ci)
+        # The zeroth-order Hamiltonian is also needed by every call to ci_response_diag
+        self.hfr0 = self.absorb_h1e_all (self.h1frs, self.eri_cas)
+        self.hci0 = self.Hci_all (None, self.h1frs, self.eri_cas, ci, hfr=self.hfr0)
         self.e0 = [[hc.dot (c) for hc, c in zip (hcr, cr)] for hcr, cr in zip (self.hci0, ci)]
         self.hci0 = [[hc - c*e for hc, c, e in zip (hcr, cr, er)]
                      for hcr, cr, er in zip (self.hci0, ci, self.e0)]
@@ -791,7 +961,7 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
     def shape (self):
         return ((self.ugg.nvar_tot, self.ugg.nvar_tot))
 
-    def Hci (self, fcibox, no, ne, h0r, h1rs, h2, ci, linkstrl=None):
+    def Hci (self, fcibox, no, ne, h0r, h1rs, h2, ci, linkstrl=None, hr=None):
         ''' For a single fragment, evaluate the FCI operation H(i)|ci[i]>, where H(i) is the
         effective Hamiltonian experienced by the fragment in the ith state
 
@@ -813,16 +983,18 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
 
         Kwargs:
             linkstrl : see pyscf.fci module documentation
+            hr : list of length nroots
+                Output of fcibox.states_absorb_h1e for h1rs and h2, if already available
 
         Returns:
             hcr : list of length nroots of ndarray
         '''
-        hr = fcibox.states_absorb_h1e (h1rs, h2, no, ne, 0.5)
+        if hr is None: hr = fcibox.states_absorb_h1e (h1rs, h2, no, ne, 0.5)
         hcr = fcibox.states_contract_2e (hr, ci, no, ne, link_index=linkstrl)
         hcr = [hc + (h0 * c) for hc, h0, c in zip (hcr, h0r, ci)]
         return hcr
 
-    def Hci_all (self, h0fr, h1frs, h2, ci_sub):
+    def Hci_all (self, h0fr, h1frs, h2, ci_sub, hfr=None):
         ''' For all fragments, evaluate the FCI operations H(i,j)|ci_sub[i][j]>, where H(i,j) is
         the effective Hamiltonian experienced by the ith fragment in the jth state.
 
@@ -837,10 +1009,15 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
             ci_sub : list of length nfrags of list of length nroots of ndarray
                 CI vectors
 
+        Kwargs:
+            hfr : list of length nfrags of lists of length nroots
+                Output of absorb_h1e_all for h1frs and h2, if already available
+
         Returns:
             hcfr : list of length nfrags of list of length nroots of ndarray
         '''
         if h0fr is None: h0fr = [[0.0 for h1r in h1rs] for h1rs in h1frs]
+        if hfr is None: hfr = [None for h1rs in h1frs]
         hcfr = []
         for isub, (fcibox, h0, h1rs, ci) in enumerate (zip (self.fciboxes, h0fr, h1frs, ci_sub)):
             if self.linkstrl is not None: linkstrl = self.linkstrl[isub] 
@@ -850,9 +1027,33 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
             j = i + ncas
             h2_i = h2[i:j,i:j,i:j,i:j]
             h1rs_i = h1rs
-            hcfr.append (self.Hci (fcibox, ncas, nelecas, h0, h1rs_i, h2_i, ci, linkstrl=linkstrl))
+            hcfr.append (self.Hci (fcibox, ncas, nelecas, h0, h1rs_i, h2_i, ci, linkstrl=linkstrl,
+                                   hr=hfr[isub]))
         return hcfr
 
+    def absorb_h1e_all (self, h1frs, h2):
+        ''' For all fragments, absorb the 1-electron part of the effective Hamiltonian into the
+        2-electron part, so that the result can be shared by several calls to Hci_all.
+
+        Args:
+            h1frs : list of length nfrags of ndarrays
+                Spin-separated 1-electron parts of the effective Hamiltonian for each fragment and
+                state
+            h2 : ndarray of shape (ncas,ncas,ncas,ncas)
+                Two-electron integrals spanning the entire active space
+
+        Returns:
+            hfr : list of length nfrags of lists of length nroots
+        '''
+        hfr = []
+        for isub, (fcibox, h1rs) in enumerate (zip (self.fciboxes, h1frs)):
+            ncas = self.ncas_sub[isub]
+            nelecas = self.nelecas_sub[isub]
+            i = sum (self.ncas_sub[:isub])
+            j = i + ncas
+            hfr.append (fcibox.states_absorb_h1e (h1rs, h2[i:j,i:j,i:j,i:j], ncas, nelecas, 0.5))
+        return hfr
+
     def make_tdm1s2c_sub (self, ci1):
         ''' Make effective 1-body and 2-body cumulant density matrices to first order
         in a CI rotation vector. 
@@ -903,7 +1104,7 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
 
         return tdm1rs, tcm2    
 
-    def get_veff_Heff (self, odm1s, tdm1rs):
+    def get_veff_Heff (self, odm1s, tdm1rs, veff_mo=None):
         ''' Compute first-order effective potential (relevant to the orbital-rotation sector of the
         Hessian-vector product) and first-order effective 1-body Hamiltonian operator (relevant to
         the CI-rotation sector of the Hessian-vector product) from first-order effective density
@@ -918,6 +1119,11 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
                 Effective spin-separated 1-RDMs from the CI rotation part of the step vector,
                 separated by root
 
+        Kwargs:
+            veff_mo : ndarray of shape (nmo,nmo)
+                Output of get_veff for the effective 1-RDM of get_dm1s_prime, if already
+                available (see _matmat)
+
         Returns:
             veff_mo : ndarray of shape (nmo,nmo)
                 Spin-symmetric effective 1-body potential, including the effects of both the
@@ -930,14 +1136,10 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         '''
 
         ncore, nocc, nroots = self.ncore, self.nocc, self.nroots
-        tdm1s_sa = np.einsum ('rspq,r->spq', tdm1rs, self.weights)
-        dm1s_mo = odm1s + odm1s.transpose (0,2,1)
-        dm1s_mo[:,ncore:nocc,ncore:nocc] += tdm1s_sa
-        mo = self.mo_coeff
-        moH = mo.conjugate ().T
+        dm1s_mo = self.get_dm1s_prime (odm1s, tdm1rs)
 
         # Overall veff for gradient: the one and only jk call per microcycle that I will allow.
-        veff_mo = self.get_veff (dm1s_mo=dm1s_mo)
+        if veff_mo is None: veff_mo = self.get_veff (dm1s_mo=dm1s_mo)
         veff_mo = self.split_veff (veff_mo, dm1s_mo)
 
         # Core-orbital-effect only for individual CI problems
@@ -983,6 +1185,42 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
 
         return veff_mo, h1frs
 
+    def get_dm1s_prime (self, odm1s, tdm1rs):
+        '''Symmetrized, state-averaged first-order effective 1-RDM in the MO basis, whose
+        effective potential is computed by get_veff. See get_veff_Heff for the arguments.
+
+        Returns:
+            dm1s_mo : ndarray of shape (2,nmo,nmo)
+        '''
+        ncore, nocc = self.ncore, self.nocc
+        tdm1s_sa = np.einsum ('rspq,r->spq', tdm1rs, self.weights)
+        dm1s_mo = odm1s + odm1s.transpose (0,2,1)
+        dm1s_mo[:,ncore:nocc,ncore:nocc] += tdm1s_sa
+        return dm1s_mo
+
+    def get_veff_batch (self, dm1s_mo):
+        '''Evaluate get_veff for a batch of 1-RDMs. Without density fitting, the J and K matrices
+        of all 1-RDMs are built together in one call to las.get_veff.
+
+        Args:
+            dm1s_mo : ndarray of shape (nvec,2,nmo,nmo)
+                Contains spin-separated 1-RDMs
+
+        Returns:
+            veff_mo : ndarray of shape (nvec,nmo,nmo)
+                Spin-symmetric effective potentials in the MO basis
+        '''
+        if getattr (self, 'bPpj', None) is not None:
+            return np.stack ([self.get_veff (dm1s_mo=dm) for dm in dm1s_mo], axis=0)
+        return self._get_veff_ao_batch (dm1s_mo)
+
+    def _get_veff_ao_batch (self, dm1s_mo):
+        mo = self.mo_coeff
+        moH = mo.conjugate ().T
+        dm1_ao = np.stack ([mo @ dm.sum (0) @ moH for dm in dm1s_mo], axis=0)
+        veff_ao = self.las.get_veff (dm1s=dm1_ao).reshape (dm1_ao.shape)
+        return np.stack ([moH @ v @ mo for v in veff_ao], axis=0)
+
     def get_veff (self, dm1s_mo=None):
         '''THIS FUNCTION IS OVERWRITTEN WITH A CALL TO LAS.GET_VEFF IN THE LASSCF_O0 CLASS. IT IS
         ONLY RELEVANT TO THE "LASCI" STEP OF THE OLDER, DEPRECATED, DMET-BASED ALGORITHM.
@@ -1061,41 +1299,54 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         return np.stack ([veffa, veffb], axis=0)
 
     def _matvec (self, x):
+        return self._matmat (np.asarray (x).reshape (-1,1))[:,0]
+
+    def _matmat (self, X):
+        '''Hessian-matrix product for a block of step vectors (the columns of X). The
+        zeroth-order absorbed CI Hamiltonians are shared by all columns, and the effective
+        potentials of all columns are evaluated together by get_veff_batch.'''
+        if type (self)._matvec is not LASCI_HessianOperator._matvec:
+            # A subclass with its own _matvec must not be bypassed
+            return np.stack ([self._matvec (x) for x in X.T], axis=1)
         log = lib.logger.new_logger (self.las, self.las.verbose)
         extra_timing = getattr (self.las, '_extra_hessian_timing', False)
         extra_timer = log.timer if extra_timing else log.timer_debug1
         t0 = (lib.logger.process_clock(), lib.logger.perf_counter())
-        kappa1, ci1 = self.ugg.unpack (x)
+        X = np.asarray (X)
+        kappa1, ci1 = zip (*[self.ugg.unpack (x) for x in X.T])
         t1 = extra_timer ('LASCI sync Hessian operator 1: unpack', *t0)
 
         # Effective density matrices, veffs, and overlaps from linear response
-        odm1s = -np.dot (self.dm1s, kappa1)
-        ocm2 = -np.dot (self.cascm2, kappa1[self.ncore:self.nocc])
-        tdm1rs, tcm2 = self.make_tdm1s2c_sub (ci1)
+        odm1s = [-np.dot (self.dm1s, k) for k in kappa1]
+        ocm2 = [-np.dot (self.cascm2, k[self.ncore:self.nocc]) for k in kappa1]
+        tdm1rs, tcm2 = zip (*[self.make_tdm1s2c_sub (c) for c in ci1])
         t1 = extra_timer ('LASCI sync Hessian operator 2: effective density matrices', *t1)
-        veff_prime, h1s_prime = self.get_veff_Heff (odm1s, tdm1rs)
+        dm1s_mo = np.stack ([self.get_dm1s_prime (o, t) for o, t in zip (odm1s, tdm1rs)], axis=0)
+        veff_mo = self.get_veff_batch (dm1s_mo)
+        veff_prime, h1s_prime = zip (*[self.get_veff_Heff (o, t, veff_mo=v)
+                                       for o, t, v in zip (odm1s, tdm1rs, veff_mo)])
         t1 = extra_timer ('LASCI sync Hessian operator 3: effective potentials', *t1)
 
-        # Responses!
-        kappa2 = self.orbital_response (kappa1, odm1s, ocm2, tdm1rs, tcm2, veff_prime)
-        t1 = extra_timer ('LASCI sync Hessian operator 4: (Hx)_orb', *t1)
-        ci2 = self.ci_response_offdiag (kappa1, h1s_prime)
-        t1 = extra_timer ('LASCI sync Hessian operator 5: (Hx)_CI offdiag', *t1)
-        ci2 = [[x+y for x,y in zip (xr, yr)] for xr, yr in zip (ci2, self.ci_response_diag (ci1))]
-        t1 = extra_timer ('LASCI sync Hessian operator 6: (Hx)_CI diag', *t1)
-
-        # LEVEL SHIFT!!
-        kappa3, ci3 = self.ugg.unpack (self.ah_level_shift * np.abs (x))
-        kappa2 += kappa3
-        ci2 = [[x+y for x,y in zip (xr, yr)] for xr, yr in zip (ci2, ci3)]
-        t1 = extra_timer ('LASCI sync Hessian operator 7: level shift', *t1)
-
-        Hx = self.ugg.pack (kappa2, ci2)
-        t1 = extra_timer ('LASCI sync Hessian operator 8: pack', *t1)
+        HX = np.empty_like (X, dtype=np.result_type (X, self.dtype))
+        for col, (x, k1, c1, o1, oc2, t1s, tc2, vp, h1p) in enumerate (zip (X.T, kappa1, ci1,
+          odm1s, ocm2, tdm1rs, tcm2, veff_prime, h1s_prime)):
+            # Responses!
+            kappa2 = self.orbital_response (k1, o1, oc2, t1s, tc2, vp)
+            ci2 = self.ci_response_offdiag (k1, h1p)
+            ci2 = [[x+y for x,y in zip (xr, yr)] for xr, yr in zip (ci2,
+                   self.ci_response_diag (c1))]
+
+            # LEVEL SHIFT!!
+            kappa3, ci3 = self.ugg.unpack (self.ah_level_shift * np.abs (x))
+            kappa2 += kappa3
+            ci2 = [[x+y for x,y in zip (xr, yr)] for xr, yr in zip (ci2, ci3)]
+            HX[:,col] = self.ugg.pack (kappa2, ci2)
+        t1 = extra_timer ('LASCI sync Hessian operator 4: responses', *t1)
         t0 = log.timer ('LASCI sync Hessian operator total', *t0)
-        return Hx
+        return HX
 
     _rmatvec = _matvec # Hessian is Hermitian in this context!
+    _rmatmat = _matmat
 
     def orbital_response (self, kappa, odm1s, ocm2, tdm1rs, tcm2, veff_prime):
         '''Compute the orbital-response sector of the Hessian-vector product. It's conceptually
@@ -1222,12 +1473,13 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         ci1HmEci0 = [[c.dot (Hci) for c, Hci in zip (cr, Hcir)] 
                      for cr, Hcir in zip (ci1, self.hci0)]
         s01 = [[c1.dot (c0) for c1,c0 in zip (c1r, c0r)] for c1r, c0r in zip (ci1, self.ci)]
-        ci2 = self.Hci_all ([[-e for e in er] for er in self.e0], self.h1frs, self.eri_cas, ci1)
+        ci2 = self.Hci_all ([[-e for e in er] for er in self.e0], self.h1frs, self.eri_cas, ci1,
+                            hfr=getattr (self, 'hfr0', None))
         ci2 = [[x-(y*z) for x,y,z in zip (xr,yr,zr)] for xr,yr,zr in zip (ci2, self.ci, ci1HmEci0)]
         ci2 = [[x-(y*z) for x,y,z in zip (xr,yr,zr)] for xr,yr,zr in zip (ci2, self.hci0, s01)]
         return [[x*2 for x in xr] for xr in ci2]
 
-    def get_prec (self):
+    def get_prec (self, positive=False):
         '''Obtain the preconditioner for conjugate-gradient descent using a second-order power
         series of the energy from a given LAS-state keyframe (a single "macrocycle"). In general,
         the preconditioner should approximate multiplication by the matrix-inverse of the Hessian.
@@ -1240,11 +1492,29 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         up on solving Ax=b, because Ax=b is an approximate equation in the first place. The actual
         goal is to minimize successive keyframe (aka "macrocycle" aka "trial") energies.
 
+        Kwargs:
+            positive : logical
+                If True, divide by the absolute value of the Hessian diagonal, so that prec_op is
+                positive-definite (as required by MINRES)
+
         Returns:
             prec_op : LinearOperator
                 Approximately the inverse of the Hessian
         '''
         log = lib.logger.new_logger (self.las, self.las.verbose)
+        Hdiag = self._get_prec_Hdiag ()
+        if positive: Hdiag = np.abs (Hdiag)
+        def prec_op (x):
+            t0 = (lib.logger.process_clock(), lib.logger.perf_counter())
+            Mx = x/Hdiag
+            log.timer ('LASCI sync preconditioner call', *t0)
+            return Mx
+        return sparse_linalg.LinearOperator (self.shape,matvec=prec_op,dtype=self.dtype)
+
+    def _get_prec_Hdiag (self):
+        '''Level-shifted Hessian diagonal for the preconditioner, with unstable degrees of freedom
+        masked by setting them to infinity (see get_prec)'''
+        log = lib.logger.new_logger (self.las, self.las.verbose)
         Hdiag = self._get_Hdiag () + self.ah_level_shift
         Hdiag[np.abs (Hdiag)<1e-8] = 1e-8
         # The quadratic power series is a bad approximation if the magnitude of the gradient in
@@ -1269,13 +1539,86 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
                        ndeg_unstable, ndeg, g_unst)
         else:
             log.warn ('LASCI encountered an unmaskable instability; calculation may not converge')
+        return Hdiag
+
+    def get_prec_block (self, maxsize=None, positive=False):
+        '''Block-Jacobi alternative to get_prec. The CI-CI block of each fragment and state
+        with at most maxsize (default: PREC_BLOCK_MAXSIZE) CSFs is constructed exactly from
+        ci_response_diag, level-shifted like the diagonal of get_prec, and inverted in its
+        eigenbasis. Eigenvectors along which the quadratic model is unstable in the sense of
+        get_prec (a probe step b/|w| > pi/2, where b is the norm of the gradient) are masked,
+        which in particular removes the redundant rotation of each CI vector into itself.
+        Degrees of freedom masked by get_prec stay masked. The orbital sector and larger CI
+        blocks are treated with the diagonal preconditioner of get_prec.
+
+        Kwargs:
+            maxsize : integer
+                Largest CI block treated exactly
+            positive : logical
+                If True, invert the absolute values of the eigenvalues, so that prec_op is
+                positive-definite (as required by MINRES)
+
+        Returns:
+            prec_op : LinearOperator
+                Approximately the inverse of the Hessian
+        '''
+        log = lib.logger.new_logger (self.las, self.las.verbose)
+        if maxsize is None: maxsize = PREC_BLOCK_MAXSIZE
+        Hdiag = self._get_prec_Hdiag ()
+        if positive: Hdiag = np.abs (Hdiag)
+        b = linalg.norm (self.get_grad ())
+        blocks = []
+        for p0, p1, Hblk in self._get_Hci_blocks (maxsize):
+            idx_masked = np.isinf (Hdiag[p0:p1])
+            if np.all (idx_masked): continue
+            w, v = linalg.eigh (Hblk)
+            w[np.abs (w)<1e-8] = 1e-8
+            if positive: w = np.abs (w)
+            idx_unstable = b/np.abs (w) > np.pi*.5
+            if np.all (idx_unstable): continue # Unmaskable; leave it to the diagonal
+            winv = 1/w
+            winv[idx_unstable] = 0
+            Hinv = (v * winv[None,:]) @ v.conj ().T
+            Hinv[idx_masked,:] = Hinv[:,idx_masked] = 0
+            blocks.append ((p0, p1, Hinv))
+        log.debug ('LASCI sync block-Jacobi preconditioner: %d exact CI blocks', len (blocks))
         def prec_op (x):
             t0 = (lib.logger.process_clock(), lib.logger.perf_counter())
             Mx = x/Hdiag
+            for p0, p1, Hinv in blocks:
+                Mx[p0:p1] = Hinv @ x[p0:p1]
             log.timer ('LASCI sync preconditioner call', *t0)
             return Mx
         return sparse_linalg.LinearOperator (self.shape,matvec=prec_op,dtype=self.dtype)
 
+    def _get_Hci_blocks (self, maxsize):
+        '''Exact diagonal CI-CI blocks of the level-shifted Hessian for each fragment and state
+        with at most maxsize CSFs, built from ci_response_diag. The columns of all blocks are
+        evaluated together, so the cost is that of at most maxsize calls to ci_response_diag.
+
+        Returns:
+            blocks : list of tuples (p0, p1, ndarray of shape (p1-p0,p1-p0))
+                The block of the Hessian matrix between variables p0 and p1
+        '''
+        ugg = self.ugg
+        ncsf = ugg.ncsf_sub.ravel ()
+        offs = ugg.nvar_orb + np.cumsum (ncsf) - ncsf
+        idx = [i for i, n in enumerate (ncsf) if 0 < n <= maxsize]
+        if not len (idx): return []
+        blocks = [np.zeros ((ncsf[i], ncsf[i]), dtype=self.dtype) for i in idx]
+        kappa0 = np.zeros ((self.nmo, self.nmo), dtype=self.dtype)
+        for j in range (max ([ncsf[i] for i in idx])):
+            x = np.zeros (ugg.nvar_tot, dtype=self.dtype)
+            for i in idx:
+                if j < ncsf[i]: x[offs[i]+j] = 1
+            ci2 = self.ci_response_diag (ugg.unpack (x)[1])
+            Hx = ugg.pack (kappa0, ci2)
+            for i, blk in zip (idx, blocks):
+                if j < ncsf[i]: blk[:,j] = Hx[offs[i]:offs[i]+ncsf[i]]
+        return [(offs[i], offs[i]+ncsf[i],
+                 (blk + blk.T)/2 + self.ah_level_shift*np.eye (ncsf[i]))
+                for i, blk in zip (idx, blocks)]
+
     def _get_Horb_diag (self):
         fock = np.stack ([np.diag (h) for h in list (self.h1s)], axis=0)
         num = np.stack ([np.diag (d) for d in list (self.dm1s)], axis=0)
@@ -1338,26 +1681,75 @@ class LASCI_HessianOperator (sparse_linalg.LinearOperator):
         return ci1
 
     def _update_h2eff_sub (self, mo1, umat, h2eff_sub):
+        '''Rotate h2eff_sub = (p1a1|a2a3) into the basis mo1 = mo_coeff @ umat without unpacking
+        it to (nmo,ncas,ncas,ncas) all at once. The active indices are rotated only with the
+        active-active block of umat, as is exact in the absence of active<->external rotations
+        (LASSCF children that do have them recompute h2eff_sub from scratch). Rotations which
+        do not mix the active and external spaces, and active-active blocks which do not mix
+        fragments, are applied blockwise, and fragments with unrotated orbitals are skipped.
+        The input array is not modified.'''
         ncore, ncas, nocc, nmo = self.ncore, self.ncas, self.nocc, self.nmo
         ucas = umat[ncore:nocc, ncore:nocc]
         bmPu = None
         if hasattr (h2eff_sub, 'bmPu'): bmPu = h2eff_sub.bmPu
-        h2eff_sub = h2eff_sub.reshape (nmo*ncas, ncas*(ncas+1)//2)
-        h2eff_sub = lib.numpy_helper.unpack_tril (h2eff_sub)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas, ncas)
-        h2eff_sub = np.tensordot (ucas, h2eff_sub, axes=((0),(1))) # bpaa
-        h2eff_sub = np.tensordot (umat, h2eff_sub, axes=((0),(1))) # qbaa
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbab
-        h2eff_sub = np.tensordot (h2eff_sub, ucas, axes=((2),(0))) # qbbb
-        ix_i, ix_j = np.tril_indices (ncas)
-        h2eff_sub = h2eff_sub.reshape (nmo, ncas, ncas*ncas)
-        h2eff_sub = h2eff_sub[:,:,(ix_i*ncas)+ix_j]
+        npair = ncas*(ncas+1)//2
+        h2eff_sub = np.asarray (h2eff_sub).reshape (nmo, ncas*npair)
+
+        # First index: external and active blocks separately if umat does not couple them
+        ext = np.ones (nmo, dtype=bool)
+        ext[ncore:nocc] = False
+        if np.any (umat[ext][:,~ext]) or np.any (umat[~ext][:,ext]):
+            h2eff_sub = umat.T @ h2eff_sub
+        else:
+            h2eff_sub_ext = umat[ext][:,ext].T @ h2eff_sub[ext]
+            h2eff_sub_cas = ucas.T @ h2eff_sub[ncore:nocc]
+            h2eff_sub = np.empty ((nmo, ncas*npair), dtype=h2eff_sub_ext.dtype)
+            h2eff_sub[ext] = h2eff_sub_ext
+            h2eff_sub[ncore:nocc] = h2eff_sub_cas
+            h2eff_sub_ext = h2eff_sub_cas = None
+
+        # Active indices: only the fragment blocks that actually rotate
+        ublks = self._get_ucas_blocks (ucas)
+        if len (ublks):
+            h2eff_sub = h2eff_sub.reshape (nmo, ncas, npair)
+            for frag, u in ublks:
+                h2eff_sub[:,frag,:] = lib.einsum ('pb,qpx->qbx', u, h2eff_sub[:,frag,:])
+            h2eff_sub = h2eff_sub.reshape (nmo*ncas, npair)
+            mem_row = 3*8*ncas*ncas/1e6
+            mem_av = self.las.max_memory - lib.current_memory ()[0]
+            blksize = max (1, min (nmo*ncas, int (mem_av / mem_row)))
+            for p0, p1 in lib.prange (0, nmo*ncas, blksize):
+                eri = lib.unpack_tril (h2eff_sub[p0:p1])
+                for frag, u in ublks:
+                    eri[:,frag,:] = lib.einsum ('ab,xac->xbc', u, eri[:,frag,:])
+                    eri[:,:,frag] = eri[:,:,frag] @ u
+                h2eff_sub[p0:p1] = lib.pack_tril (eri)
+                eri = None
         h2eff_sub = h2eff_sub.reshape (nmo, -1)
         if bmPu is not None:
-            bmPu = np.dot (bmPu, ucas)
+            if len (ublks): bmPu = rotate_bmPu (bmPu, ucas)
             h2eff_sub = lib.tag_array (h2eff_sub, bmPu = bmPu)
         return h2eff_sub
 
+    def _get_ucas_blocks (self, ucas):
+        '''Decompose the active-active orbital rotation into fragment blocks.
+
+        Returns:
+            ublks : list of tuples (slice, ndarray)
+                Orbital range and unitary matrix of each fragment whose orbitals rotate, if
+                ucas is block-diagonal by fragment; otherwise, the whole active space and ucas.
+        '''
+        ncas_cum = np.cumsum ([0] + list (self.ncas_sub))
+        frags = [slice (i, j) for i, j in zip (ncas_cum[:-1], ncas_cum[1:])]
+        offdiag = ucas.copy ()
+        for frag in frags: offdiag[frag,frag] = 0
+        if np.any (offdiag): return [(slice (0, self.ncas), ucas)]
+        ublks = []
+        for frag in frags:
+            u = ucas[frag,frag]
+            if not np.array_equal (u, np.eye (u.shape[0])): ublks.append ((frag, u))
+        return ublks
+
     def get_grad (self):
         gorb = self.fock1 - self.fock1.T
         gci = [[2*hci0 for hci0 in hci0r] for hci0r in self.hci0]
@@ -5,7 +5,7 @@ from pyscf import gto, scf, mcscf, ao2mo, lib, df
 from pyscf.lib import logger
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.mcscf.addons import _state_average_mcscf_solver
-from mrh.my_pyscf.mcscf import _DFLASCI, lasci_sync, lasci
+from mrh.my_pyscf.mcscf import _DFLASCI, lasci_sync, lasci, las_ao2mo
 import copy, json
 
 class ImpurityMole (gto.Mole):
@@ -440,9 +440,10 @@ class ImpuritySolver ():
         fo_coeff, nelec_f = self._imporb_builder (kf.mo_coeff, kf.dm1s, kf.veff, kf.fock1,
                                                   max_size=max_size)
         self._update_space_(fo_coeff, nelec_f)
-        self._update_trial_state_(kf.mo_coeff, kf.ci, veff=kf.veff, dm1s=kf.dm1s)
+        self._update_trial_state_(kf.mo_coeff, kf.ci, veff=kf.veff, dm1s=kf.dm1s, fock=kf.fock)
         self._update_impurity_hamiltonian_(kf.mo_coeff, kf.ci, h2eff_sub=kf.h2eff_sub,
-                                           veff=kf.veff, dm1s=kf.dm1s)
+                                           e_states=kf.e_states, veff=kf.veff, dm1s=kf.dm1s,
+                                           casdm1rs_full=kf.casdm1rs)
         if hasattr (self, '_max_stepsize'): self._max_stepsize = None # PySCF issue #1762
 
     _update_keyframe_ = _pull_keyframe_
@@ -452,9 +453,10 @@ class ImpuritySolver ():
         ImpurityMole object.'''
         self.mol._update_space_(imporb_coeff, nelec_imp)
 
-    def _update_trial_state_(self, mo_coeff, ci, veff, dm1s):
+    def _update_trial_state_(self, mo_coeff, ci, veff, dm1s, fock=None):
         '''Project whole-molecule MO coefficients and CI vectors into the
-        impurity space and store on self.mo_coeff; self.ci.'''
+        impurity space and store on self.mo_coeff; self.ci. The whole-molecule Fock matrix
+        (las.get_fock (veff=veff, dm1s=dm1s)) is computed if not provided.'''
         las = self.mol._las
         mf = las._scf
         log = logger.new_logger(self, self.verbose)
@@ -492,7 +494,7 @@ class ImpuritySolver ():
         self.mo_coeff[:,self.ncore:] = self.mo_coeff[:,self.ncore:] @ u
 
         # Canonicalize core and virtual spaces
-        fock = las.get_fock (veff=veff, dm1s=dm1s)
+        if fock is None: fock = las.get_fock (veff=veff, dm1s=dm1s)
         fock = imporb_coeff.conj ().T @ fock @ imporb_coeff
         if self.ncore:
             mo_core = self.mo_coeff[:,:self.ncore]
@@ -506,7 +508,8 @@ class ImpuritySolver ():
             self.mo_coeff[:,nocc:] = mo_virt @ c
 
     def _update_impurity_hamiltonian_(self, mo_coeff, ci, h2eff_sub=None, e_states=None, veff=None,
-                                      dm1s=None, casdm1rs=None, casdm2rs=None, weights=None):
+                                      dm1s=None, casdm1rs=None, casdm2rs=None, weights=None,
+                                      casdm1rs_full=None):
         '''Update the Hamiltonian data contained within this impurity solver and all encapsulated
         impurity objects'''
         las = self.mol._las
@@ -538,7 +541,8 @@ class ImpuritySolver ():
 
         # Set state-separated Hamiltonian 1-body
         mo_cas_full = mo_coeff[:,las.ncore:][:,:las.ncas]
-        dm1rs_full = las.states_make_casdm1s (ci=ci)
+        dm1rs_full = casdm1rs_full
+        if dm1rs_full is None: dm1rs_full = las.states_make_casdm1s (ci=ci)
         dm1s_full = np.tensordot (weights, dm1rs_full, axes=1)
         dm1rs_stateshift = dm1rs_full - dm1s_full
         for ifrag in self._ifrags:
@@ -546,6 +550,8 @@ class ImpuritySolver ():
             j = i + las.ncas_sub[ifrag]
             dm1rs_stateshift[:,:,i:j,:] = dm1rs_stateshift[:,:,:,i:j] = 0
         bmPu = getattr (h2eff_sub, 'bmPu', None)
+        if bmPu is None and isinstance (las, _DFLASCI):
+            bmPu = las_ao2mo.get_df_workspace (las).get_bmPu (mo_cas_full)
         vj_r = self.get_vj_ext (mo_cas_full, dm1rs_stateshift.sum(1), bmPu=bmPu)
         vk_rs = self.get_vk_ext (mo_cas_full, dm1rs_stateshift, bmPu=bmPu)
         vext = vj_r[:,None,:,:] - vk_rs
@@ -574,10 +580,12 @@ class ImpuritySolver ():
         output_shape = list (dm1rs_ext.shape[:-2]) + [self.mol.nao (), self.mol.nao ()]
         dm1 = dm1rs_ext.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
         if bmPu is not None:
-            bPuu = np.tensordot (bmPu, mo_ext, axes=((0),(0)))
-            rho = np.tensordot (dm1, bPuu, axes=((1,2),(1,2)))
             bPii = self._scf._cderi
-            vj = lib.unpack_tril (np.tensordot (rho, bPii, axes=((-1),(0))))
+            vj = 0
+            for p0, p1, bmPu_blk in las_ao2mo.loop_bmPu (bmPu):
+                bPuu = np.tensordot (bmPu_blk, mo_ext, axes=((0),(0)))
+                rho = np.tensordot (dm1, bPuu, axes=((1,2),(1,2)))
+                vj += lib.unpack_tril (np.tensordot (rho, bPii[p0:p1], axes=((-1),(0))))
         else: # Safety case: AO-basis SCF driver
             imporb_coeff = self.mol.get_imporb_coeff ()
             dm1 = np.dot (mo_ext, np.dot (dm1, mo_ext.conj().T)).transpose (1,0,2)
@@ -590,9 +598,11 @@ class ImpuritySolver ():
         dm1 = dm1rs_ext.reshape (-1, mo_ext.shape[1], mo_ext.shape[1])
         imporb_coeff = self.mol.get_imporb_coeff ()
         if bmPu is not None:
-            biPu = np.tensordot (imporb_coeff, bmPu, axes=((0),(0)))
-            vuiP = np.tensordot (dm1, biPu, axes=((-1),(-1)))
-            vk = np.tensordot (vuiP, biPu, axes=((-3,-1),(-1,-2)))
+            vk = 0
+            for p0, p1, bmPu_blk in las_ao2mo.loop_bmPu (bmPu):
+                biPu = np.tensordot (imporb_coeff, bmPu_blk, axes=((0),(0)))
+                vuiP = np.tensordot (dm1, biPu, axes=((-1),(-1)))
+                vk += np.tensordot (vuiP, biPu, axes=((-3,-1),(-1,-2)))
         else: # Safety case: AO-basis SCF driver
             dm1 = np.dot (mo_ext, np.dot (dm1, mo_ext.conj().T)).transpose (1,0,2)
             vk = self.mol._las._scf.get_k (dm=dm1)
@@ -889,7 +899,8 @@ class ImpurityLASCI (lasci.LASCINoSymm, ImpuritySolver):
     _hop = ImpurityLASCI_HessianOperator
 
     def _update_impurity_hamiltonian_(self, mo_coeff, ci, h2eff_sub=None, e_states=None, veff=None,
-                                      dm1s=None, casdm1rs=None, casdm2rs=None, weights=None):
+                                      dm1s=None, casdm1rs=None, casdm2rs=None, weights=None,
+                                      casdm1rs_full=None):
         if weights is None: weights = self.weights
         if casdm1rs is None: casdm1rs = self.states_make_casdm1s (ci=self.ci)
         if casdm2rs is None: 
@@ -909,7 +920,7 @@ class ImpurityLASCI (lasci.LASCINoSymm, ImpuritySolver):
                 casdm2rs[:,:,i:j,i:j,i:j,i:j] = d2f[:]
         ImpuritySolver._update_impurity_hamiltonian_(
             self, mo_coeff, ci, h2eff_sub=h2eff_sub, e_states=e_states, veff=veff, dm1s=dm1s,
-            casdm1rs=casdm1rs, casdm2rs=casdm2rs, weights=weights
+            casdm1rs=casdm1rs, casdm2rs=casdm2rs, weights=weights, casdm1rs_full=casdm1rs_full
         )
 
     def get_grad_orb (las, **kwargs):
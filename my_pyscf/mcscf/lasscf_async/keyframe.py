@@ -11,6 +11,7 @@ class LASKeyframe (object):
         self.mo_coeff = mo_coeff
         self.ci = ci
         self._dm1s = self._veff = self._fock1 = self._h1eff_sub = self._h2eff_sub = None
+        self._fock = self._casdm1rs = self._e_states = None
         self.frags = set ()
 
     @property
@@ -46,6 +47,32 @@ class LASKeyframe (object):
                 h2eff_sub=self.h2eff_sub)
         return self._h1eff_sub
 
+    @property
+    def fock (self):
+        if self._fock is None:
+            self._fock = self.las.get_fock (veff=self.veff, dm1s=self.dm1s)
+        return self._fock
+
+    @property
+    def casdm1rs (self):
+        if self._casdm1rs is None:
+            self._casdm1rs = self.las.states_make_casdm1s (ci=self.ci)
+        return self._casdm1rs
+
+    @property
+    def e_states (self):
+        if self._e_states is None:
+            self._e_states = self.las.energy_nuc () + np.array (self.las.states_energy_elec (
+                mo_coeff=self.mo_coeff, ci=self.ci, h2eff=self.h2eff_sub))
+        return self._e_states
+
+    def build_shared_(self):
+        '''Evaluate all of the above intermediates, which are needed by every impurity solver,
+        up front, so that impurity solvers running in concurrent threads only ever read them'''
+        for key in ('dm1s', 'veff', 'h2eff_sub', 'fock1', 'fock', 'casdm1rs', 'e_states'):
+            getattr (self, key)
+        return self
+
     def copy (self):
         ''' MO coefficients deepcopy; CI vectors shallow copy. Everything else, drop. '''
         mo1 = self.mo_coeff.copy ()
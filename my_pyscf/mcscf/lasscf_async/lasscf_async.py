@@ -1,13 +1,22 @@
 import itertools
 import numpy as np
 from scipy import linalg
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from pyscf import lib
 from pyscf.mcscf import mc1step
 from mrh.my_pyscf.mcscf import lasci, lasscf_sync_o0
+from mrh.my_pyscf.mcscf.addons import map_frags
 from mrh.my_pyscf.mcscf.lasscf_guess import interpret_frags_atoms
 from mrh.my_pyscf.mcscf.lasscf_async import keyframe, combine
 from mrh.my_pyscf.mcscf.lasscf_async.split import get_impurity_space_constructor
 from mrh.my_pyscf.mcscf.lasscf_async.crunch import get_impurity_casscf
+from pyscf import __config__
+
+# Maximum number of impurity problems and keyframe combinations processed concurrently
+IMPURITY_NWORKERS = getattr (__config__, 'lasscf_async_impurity_nworkers', 1)
+# Maximum number of impurity spaces and Hamiltonians constructed concurrently by
+# relax_fragments_rigid. None means lib.num_threads (). Opt-in, like IMPURITY_NWORKERS.
+IMPURITY_PULL_NTHREADS = getattr (__config__, 'lasscf_async_impurity_pull_nthreads', 1)
 
 def kernel (las, mo_coeff=None, ci0=None, conv_tol_grad=1e-4,
             assert_no_dupes=False, verbose=lib.logger.NOTE, frags_orbs=None,
@@ -45,38 +54,24 @@ def kernel (las, mo_coeff=None, ci0=None, conv_tol_grad=1e-4,
                   for i, builder in enumerate (imporb_builders)]
     ugg = las.get_ugg ()
     t1 = log.timer_debug1 ('impurity solver construction', *t0)
-    # GRAND CHALLENGE: replace rigid algorithm below with dynamic task scheduling
+    nworkers = min (getattr (las, 'impurity_nworkers', 1), nfrags)
+    nthreads = getattr (las, 'impurity_omp_threads', None)
+    if nworkers > 1:
+        executor = ThreadPoolExecutor (max_workers=nworkers)
+        pulls = pull_fragments_dynamic (impurities, kf1, executor, nworkers, nthreads=nthreads)
     for it in range (las.max_cycle_macro):
         # 1. Divide into fragments
-        for impurity in impurities: impurity._pull_keyframe_(kf1)
-
         # 2. CASSCF on each fragment
-        kf2_list = []
-        for impurity in impurities:
-            impurity.kernel ()
-            kf2_list.append (impurity._push_keyframe (kf1))
-
-        # 3. Combine from fragments. It should not be necessary to do this in any particular order,
-        #    and the below does it March Madness tournament style; e.g.:
-        #
-        #       kf2_list[0] --- kf2_list[1]     kf2_list[2] --- kf2_list[3]
-        #                    |                               |
-        #                   kfi --------------------------- kfj
-        #                                    |
-        #                                   kf2
-        #
-        nkf = len (kf2_list)
-        ncyc = int (np.ceil (np.log2 (nkf)))
-        for i in range (int (np.ceil (np.log2 (nkf)))):
-            nkfi = len (kf2_list)
-            kf3_list = []
-            for kf2, kf3 in zip (kf2_list[::2],kf2_list[1::2]):
-                kf3_list.append (combine.combine_pair (las, kf2, kf3, kf_ref=kf1))
-            if nkfi%2: kf3_list.insert (len(kf3_list)-1, kf2_list[-1])
-            # Insert this at second-to-last position so that it gets "mixed in" next cycle
-            kf2_list = kf3_list
-        assert (len (kf2_list) == 1)
-        kf1 = kf2_list[0]
+        # 3. Combine from fragments
+        if nworkers > 1:
+            kf1 = relax_fragments_dynamic (las, impurities, kf1, nworkers, nthreads=nthreads,
+                                           executor=executor, pulls=pulls)
+            # Pipeline: pull the new keyframe into the impurity problems of the next macrocycle
+            # while the convergence of this one is evaluated
+            pulls = pull_fragments_dynamic (impurities, kf1, executor, nworkers,
+                                            nthreads=nthreads)
+        else:
+            kf1 = relax_fragments_rigid (las, impurities, kf1)
 
         # Evaluate status and break if converged
         e_tot = las.energy_nuc () + las.energy_elec (
@@ -99,6 +94,10 @@ def kernel (las, mo_coeff=None, ci0=None, conv_tol_grad=1e-4,
     ################################### End actual kernel logic ###################################
     ###############################################################################################
 
+    if nworkers > 1:
+        # The last pulls are not needed
+        for pull in pulls: pull.cancel ()
+        executor.shutdown (wait=True)
     for key, val in las._flas_stdout.items (): val.close ()
     # TODO: more elegant model for this
     mo_coeff, ci1, h2eff_sub, veff = kf1.mo_coeff, kf1.ci, kf1.h2eff_sub, kf1.veff
@@ -120,6 +119,150 @@ def kernel (las, mo_coeff=None, ci0=None, conv_tol_grad=1e-4,
     e_cas = None # TODO: get rid of this worthless, meaningless variable
     return converged, e_tot, e_states, mo_energy, mo_coeff, e_cas, ci1, h2eff_sub, veff
 
+def relax_fragments_rigid (las, impurities, kf1, nthreads=None):
+    '''Solve each impurity problem in turn, then combine the resulting keyframes pairwise in a
+    fixed order. The impurity spaces and Hamiltonians, which are independent of one another,
+    are constructed concurrently beforehand.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        impurities : list of length nfrags of instances of :class:`ImpurityCASSCF`
+        kf1 : instance of :class:`LASKeyframe`
+            Current keyframe
+
+    Kwargs:
+        nthreads : integer
+            Maximum number of impurity spaces constructed concurrently. Defaults to
+            IMPURITY_PULL_NTHREADS = 1; None means lib.num_threads ()
+
+    Returns:
+        kf2 : instance of :class:`LASKeyframe`
+            Keyframe after relaxation of all fragments
+    '''
+    if nthreads is None: nthreads = IMPURITY_PULL_NTHREADS
+    if nthreads is None: nthreads = lib.num_threads ()
+
+    # 1. Divide into fragments
+    kf1.build_shared_()
+    map_frags (lambda i: impurities[i]._pull_keyframe_(kf1), range (len (impurities)),
+               nthreads=nthreads)
+
+    # 2. CASSCF on each fragment
+    kf2_list = []
+    for impurity in impurities:
+        impurity.kernel ()
+        kf2_list.append (impurity._push_keyframe (kf1))
+
+    # 3. Combine from fragments. It should not be necessary to do this in any particular order,
+    #    and the below does it March Madness tournament style; e.g.:
+    #
+    #       kf2_list[0] --- kf2_list[1]     kf2_list[2] --- kf2_list[3]
+    #                    |                               |
+    #                   kfi --------------------------- kfj
+    #                                    |
+    #                                   kf2
+    #
+    nkf = len (kf2_list)
+    ncyc = int (np.ceil (np.log2 (nkf)))
+    for i in range (int (np.ceil (np.log2 (nkf)))):
+        nkfi = len (kf2_list)
+        kf3_list = []
+        for kf2, kf3 in zip (kf2_list[::2],kf2_list[1::2]):
+            kf3_list.append (combine.combine_pair (las, kf2, kf3, kf_ref=kf1))
+        if nkfi%2: kf3_list.insert (len(kf3_list)-1, kf2_list[-1])
+        # Insert this at second-to-last position so that it gets "mixed in" next cycle
+        kf2_list = kf3_list
+    assert (len (kf2_list) == 1)
+    return kf2_list[0]
+
+def pull_fragments_dynamic (impurities, kf1, executor, nworkers, nthreads=None):
+    '''Submit the construction of the impurity spaces and Hamiltonians of all impurity problems
+    from a keyframe to a pool of Python threads, without waiting for it to finish.
+
+    Args:
+        impurities : list of length nfrags of instances of :class:`ImpurityCASSCF`
+        kf1 : instance of :class:`LASKeyframe`
+            Current keyframe
+        executor : instance of :class:`ThreadPoolExecutor`
+        nworkers : integer
+            Number of tasks processed concurrently by executor
+
+    Kwargs:
+        nthreads : integer
+            Number of OpenMP threads of each task. Defaults to lib.num_threads () // nworkers
+
+    Returns:
+        pulls : list of length nfrags of instances of :class:`Future`
+            The _pull_keyframe_ task of each impurity problem
+    '''
+    if nthreads is None: nthreads = max (1, lib.num_threads () // nworkers)
+    kf1.build_shared_() # Computed once here; only read by the workers
+    def pull_keyframe (impurity):
+        with lib.with_omp_threads (nthreads):
+            impurity._pull_keyframe_(kf1)
+    return [executor.submit (pull_keyframe, impurity) for impurity in impurities]
+
+def relax_fragments_dynamic (las, impurities, kf1, nworkers, nthreads=None, executor=None,
+                             pulls=None):
+    '''Same as relax_fragments_rigid, except that the impurity problems and the pairwise
+    keyframe combinations are tasks in a pool of Python threads. Each impurity problem is
+    launched as soon as its impurity space and Hamiltonian have been constructed, and each
+    combination is launched as soon as any two keyframes are available, so that the order of
+    combination depends on which tasks finish first.
+
+    Args:
+        las : instance of :class:`LASCINoSymm`
+        impurities : list of length nfrags of instances of :class:`ImpurityCASSCF`
+        kf1 : instance of :class:`LASKeyframe`
+            Current keyframe
+        nworkers : integer
+            Number of tasks processed concurrently
+
+    Kwargs:
+        nthreads : integer
+            Number of OpenMP threads of each task. Defaults to lib.num_threads () // nworkers
+        executor : instance of :class:`ThreadPoolExecutor`
+            Pool of nworkers threads in which to run the tasks. If not provided, one is created
+            and shut down here.
+        pulls : list of length nfrags of instances of :class:`Future`
+            _pull_keyframe_(kf1) tasks previously submitted to executor by
+            pull_fragments_dynamic. If not provided, they are submitted here.
+
+    Returns:
+        kf2 : instance of :class:`LASKeyframe`
+            Keyframe after relaxation of all fragments
+    '''
+    if executor is None:
+        with ThreadPoolExecutor (max_workers=nworkers) as executor:
+            return relax_fragments_dynamic (las, impurities, kf1, nworkers, nthreads=nthreads,
+                                            executor=executor, pulls=pulls)
+    if nthreads is None: nthreads = max (1, lib.num_threads () // nworkers)
+    if pulls is None:
+        pulls = pull_fragments_dynamic (impurities, kf1, executor, nworkers, nthreads=nthreads)
+    def solve_impurity (impurity):
+        with lib.with_omp_threads (nthreads):
+            impurity.kernel ()
+            return impurity._push_keyframe (kf1)
+    def combine_pair (kf2, kf3):
+        with lib.with_omp_threads (nthreads):
+            return combine.combine_pair (las, kf2, kf3, kf_ref=kf1)
+    kf2_list = []
+    pending = set (pulls)
+    impurity_of_pull = {pull: impurity for pull, impurity in zip (pulls, impurities)}
+    while len (pending):
+        done, pending = wait (pending, return_when=FIRST_COMPLETED)
+        for task in done:
+            if task in impurity_of_pull: # Pull done; launch the impurity problem
+                task.result ()
+                pending.add (executor.submit (solve_impurity, impurity_of_pull[task]))
+            else:
+                kf2_list.append (task.result ())
+        while len (kf2_list) > 1:
+            kf2, kf3 = kf2_list.pop (0), kf2_list.pop (0)
+            pending.add (executor.submit (combine_pair, kf2, kf3))
+    assert (len (kf2_list) == 1)
+    return kf2_list[0]
+
 def get_grad (las, mo_coeff=None, ci=None, ugg=None, kf=None):
     '''Return energy gradient for orbital rotation and CI relaxation.
 
@@ -184,6 +327,16 @@ class LASSCFNoSymm (lasci.LASCINoSymm):
         for the ``LASCI'' step.
     combine_pair_max_frags : integer
         Maximum number of frags to simultaneously relax during the combine_pair step.
+    impurity_nworkers : integer
+        Maximum number of impurity problems and combine_pair steps processed concurrently, each
+        in its own Python thread. If greater than 1, each combine_pair step begins as soon as
+        two keyframes are available, each impurity problem begins as soon as its own impurity
+        space is constructed, and the impurity spaces of the next macrocycle are constructed
+        while the convergence of the current one is evaluated. Default is 1: one at a time, in
+        a fixed order.
+    impurity_omp_threads : integer
+        Number of OpenMP threads for each concurrent impurity problem or combine_pair step.
+        Defaults to lib.num_threads () // impurity_nworkers.
     '''
     def __init__(self, mf, ncas, nelecas, ncore=None, spin_sub=None, **kwargs):
         lasci.LASCINoSymm.__init__(self, mf, ncas, nelecas, ncore=ncore, spin_sub=spin_sub,
@@ -195,7 +348,10 @@ class LASSCFNoSymm (lasci.LASCINoSymm):
         for i, j in itertools.combinations (range (self.nfrags), 2):
             self.relax_params[(i,j)] = {}
         self.combine_pair_max_frags = self.nfrags
-        keys = set (('frags_orbs','impurity_params','relax_params','combine_pair_max_frags'))
+        self.impurity_nworkers = IMPURITY_NWORKERS
+        self.impurity_omp_threads = None
+        keys = set (('frags_orbs','impurity_params','relax_params','combine_pair_max_frags',
+                     'impurity_nworkers','impurity_omp_threads'))
         self._keys = self._keys.union (keys)
 
     @property
@@ -267,7 +423,10 @@ class LASSCFSymm (lasci.LASCISymm):
         lasci.LASCISymm.__init__(self, mf, ncas, nelecas, ncore=ncore, spin_sub=spin_sub, **kwargs)
         self.impurity_params = [{} for i in range (self.nfrags)]
         self.relax_params = {}
-        keys = set (('frags_orbs','impurity_params','relax_params'))
+        self.impurity_nworkers = IMPURITY_NWORKERS
+        self.impurity_omp_threads = None
+        keys = set (('frags_orbs','impurity_params','relax_params','impurity_nworkers',
+                     'impurity_omp_threads'))
         self._keys = self._keys.union (keys)
 
     _ugg = lasscf_sync_o0.LASSCFSymm_UnitaryGroupGenerators
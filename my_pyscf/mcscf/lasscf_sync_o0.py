@@ -73,6 +73,9 @@ class LASSCF_HessianOperator (lasci_sync.LASCI_HessianOperator):
         veff_ao = np.squeeze (self.las.get_veff (dm1s=dm1_ao))
         return np.dot (moH, np.dot (veff_ao, mo))
 
+    def get_veff_batch (self, dm1s_mo):
+        return self._get_veff_ao_batch (dm1s_mo)
+
     def split_veff (self, veff_mo, dm1s_mo):
         veff_c = veff_mo.copy ()
         ncore = self.ncore
@@ -183,6 +183,8 @@ class LASSCF_HessianOperator (lasscf_sync_o0.LASSCF_HessianOperator):
 
         return veff_mo, h1frs
 
+    get_veff_batch = lasci_sync.LASCI_HessianOperator.get_veff_batch
+
     def get_veff (self, dm1s_mo=None):
         # I can't do better than O(N^4), but maybe I can do better than O(M^4)
         # Neither dm1_vv nor veff_vv elements are needed here
@@ -6,8 +6,14 @@ from pyscf.fci import cistring
 from pyscf.mcscf.addons import state_average as state_average_mcscf
 from mrh.my_pyscf.fci.csf import CSFFCISolver
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
-from mrh.my_pyscf.mcscf.addons import StateAverageNMixFCISolver
+from mrh.my_pyscf.mcscf.addons import StateAverageNMixFCISolver, map_frags
 from itertools import combinations
+from pyscf import __config__
+
+# Maximum number of fragment problems processed concurrently. None means lib.num_threads ().
+# Opt-in, because the OpenMP threads are divided equally among the fragments regardless of their
+# size.
+PRODUCTSTATE_NTHREADS = getattr (__config__, 'productstate_nthreads', 1)
 
 # TODO: linkstr support
 class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
@@ -16,6 +22,10 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
     |Psi> = A \prod_K |ci_K>
 
     Self-consistently over all ci_K.
+
+    The fragment CI problems of each cycle are independent, so they are solved concurrently in
+    up to self.nthreads Python threads (default: PRODUCTSTATE_NTHREADS = 1; None means
+    lib.num_threads ()), which share the OpenMP threads equally.
     '''
 
     def __init__(self, fcisolvers, stdout=None, verbose=0, **kwargs):
@@ -23,6 +33,12 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
         self.verbose = verbose
         self.stdout = stdout
         self.log = lib.logger.new_logger (self, verbose)
+        self.nthreads = PRODUCTSTATE_NTHREADS
+
+    def get_nthreads (self):
+        nthreads = getattr (self, 'nthreads', None)
+        if nthreads is None: nthreads = lib.num_threads ()
+        return nthreads
 
     def kernel (self, h1, h2, norb_f, nelec_f, ecore=0, ci0=None, orbsym=None,
             conv_tol_grad=1e-4, conv_tol_self=1e-10, max_cycle_macro=50,
@@ -184,16 +200,20 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
         nj = np.cumsum (norb_f)
         ni = nj - norb_f
         zipper = [h0eff, h1eff, ci0, norb_f, nelec_f, self.fcisolvers, ni, nj]
+        zipper = list (zip (*zipper))
         e1 = [e for e in e0]
         ci1 = [c for c in ci0]
-        for ifrag, (h0e, h1e, c, no, ne, solver, i, j) in enumerate (zip (*zipper)):
-            if serialfrag and it % nfrag != ifrag: continue
+        def solve_frag (ifrag):
+            h0e, h1e, c, no, ne, solver, i, j = zipper[ifrag]
             h2e = h2[i:j,i:j,i:j,i:j]
             osym = getattr (solver, 'orbsym', None)
             if orbsym is not None: osym=orbsym[i:j]
             nelec = self._get_nelec (solver, ne)
-            e, c1 = solver.kernel (h1e, h2e, no, nelec, ci0=c, ecore=h0e,
+            return solver.kernel (h1e, h2e, no, nelec, ci0=c, ecore=h0e,
                 orbsym=osym, **kwargs)
+        frags = [ifrag for ifrag in range (nfrag) if not (serialfrag and it % nfrag != ifrag)]
+        for ifrag, (e, c1) in zip (frags, map_frags (solve_frag, frags,
+                                                     nthreads=self.get_nthreads ())):
             e1[ifrag] = e
             ci1[ifrag] = c1
         return e1, ci1
@@ -203,8 +223,10 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
         nj = np.cumsum (norb_f)
         ni = nj - norb_f
         zipper = [h1eff, ci, norb_f, nelec_f, self.fcisolvers, ni, nj]
-        grad = []
-        for h1e, c, no, ne, solver, i, j in zip (*zipper):
+        zipper = list (zip (*zipper))
+        def get_grad_frag (ifrag):
+            h1e, c, no, ne, solver, i, j = zipper[ifrag]
+            grad = []
             nelec = self._get_nelec (solver, ne)
             nroots = solver.nroots
             h2e = h2[i:j,i:j,i:j,i:j]
@@ -229,7 +251,9 @@ class ProductStateFCISolver (StateAverageNMixFCISolver, lib.StreamObject):
                 chc *= np.asarray (solver.weights)[:,None]
                 chc -= chc.T
                 grad.append (chc[np.tril_indices (nroots,k=-1)])
-        return np.concatenate (grad)
+            return grad
+        grad = map_frags (get_grad_frag, range (len (zipper)), nthreads=self.get_nthreads ())
+        return np.concatenate ([g for grad_f in grad for g in grad_f])
 
     def energy_elec (self, h1, h2, ci, norb_f, nelec_f, ecore=0, **kwargs):
         dm1s = np.stack (self.make_rdm1s (ci, norb_f, nelec_f), axis=0)
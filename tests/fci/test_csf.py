@@ -23,9 +23,11 @@ from pyscf import scf
 from pyscf import ao2mo
 from pyscf import fci
 from pyscf import lib
-from pyscf.fci import fci_slow
+from pyscf.fci import fci_slow, cistring
 from pyscf.fci.spin_op import spin_square0
 from mrh.my_pyscf.fci import csf_solver
+from mrh.my_pyscf.fci.csf import contract_2e_csf, make_hdiag_csf, make_hdiag_csf_slower
+from mrh.my_pyscf.fci import csfstring
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
 
 def setUpModule():
@@ -113,6 +115,25 @@ class KnownValues(unittest.TestCase):
             self.assertAlmostEqual (smulttest, smult, 8)
             self.assertAlmostEqual (e, refs[smult-1], 8)
 
+    def test_kernel_nroots(self):
+        nel = (neleci, nelec)
+        for smult in range (1,8):
+          with self.subTest (smult=smult):
+            ne = nel[smult % 2]
+            nroots = min (4, h2mat[smult-1].shape[0])
+            e_ref = np.linalg.eigh (h2mat[smult-1])[0][:nroots]
+            e, ci = sol.kernel (h1e, g2e, norb, ne, smult=smult, nroots=nroots,
+                                davidson_only=True, pspace_size=0)
+            self.assertAlmostEqual (lib.fp (e), lib.fp (e_ref), 8)
+
+    def test_eig_single_vector_op(self):
+        # fci.eig keeps the pyscf contract of a callable acting on one vector
+        h = h2mat[0]
+        x0 = np.eye (h.shape[0])[np.argmin (h.diagonal ())]
+        e, c = sol.eig (lambda x: np.dot (h, x), x0, lambda r, e0, x: r/(h.diagonal ()-e0+1e-4),
+                        tol=1e-10, nroots=1, max_memory=2000)
+        self.assertAlmostEqual (e, np.linalg.eigh (h)[0][0], 8)
+
     def test_hdiag_csf (self):
         nel = (neleci, nelec)
         for smult in range (1,8):
@@ -122,6 +143,18 @@ class KnownValues(unittest.TestCase):
             hdiag_ref = h2mat[smult-1].diagonal ()
             self.assertAlmostEqual (lib.fp (hdiag), lib.fp (hdiag_ref), 8)
 
+    def test_hdiag_csf_slower (self):
+        norb1 = 8
+        h1 = np.random.rand (norb1, norb1)
+        h1 += h1.T
+        h2 = ao2mo.restore (1, ao2mo.restore (8, np.random.rand (norb1**4), norb1), norb1)
+        for smult, ne in ((1,(4,4)), (2,(5,4)), (3,(4,4)), (5,(5,3))):
+          with self.subTest (smult=smult, nelec=ne):
+            t = CSFTransformer (norb1, ne[0], ne[1], smult)
+            hdiag = make_hdiag_csf (h1, h2, norb1, ne, t, max_memory=sol.max_memory)
+            hdiag_ref = make_hdiag_csf_slower (h1, h2, norb1, ne, t, max_memory=sol.max_memory)
+            self.assertAlmostEqual (lib.fp (hdiag), lib.fp (hdiag_ref), 8)
+
     def test_pspace(self):
         nel = (neleci, nelec)
         for smult in range (1,8):
@@ -131,6 +164,96 @@ class KnownValues(unittest.TestCase):
             h0_ref = h2mat[smult-1][addr,:][:,addr]
             self.assertAlmostEqual (lib.fp (h0), lib.fp (h0_ref), 8)
 
+    def test_mat_det2csf_confspace_order(self):
+        nel = (neleci, nelec)
+        for smult in range (1,8):
+          with self.subTest (smult=smult):
+            ne = nel[smult % 2]
+            t = CSFTransformer (norb, ne[0], ne[1], smult)
+            ndet = t.ndeta * t.ndetb
+            hdet = np.random.rand (ndet, ndet)
+            hdet += hdet.T
+            nconf = np.amax (t.econf_csf_mask) + 1
+            confs = np.random.choice (nconf, size=min (7, nconf), replace=False)
+            h_csf, addr = [], []
+            for c in (np.sort (confs), confs):
+                det_addrs = csfstring.get_econf_addrs (norb, ne[0], ne[1], smult, c, t.csd_mask)[0]
+                h, a = t.mat_det2csf_confspace (hdet[np.ix_(det_addrs, det_addrs)], c)
+                h_csf.append (h)
+                addr.append (a)
+            self.assertTrue (np.all (addr[1] == addr[0]))
+            self.assertTrue (np.all (addr[1][1:] > addr[1][:-1]))
+            self.assertAlmostEqual (lib.fp (h_csf[1]), lib.fp (h_csf[0]), 10)
+
+    def test_contract_2e_csf(self):
+        nel = (neleci, nelec)
+        orbsym = np.arange (norb) % 4
+        for smult in range (1,8):
+            ne = nel[smult % 2]
+            h2eff = sol.absorb_h1e (h1e, g2e, norb, ne, .5)
+            for wfnsym in (None, 0, 3):
+              with self.subTest (smult=smult, wfnsym=wfnsym):
+                if wfnsym is None:
+                    t = CSFTransformer (norb, ne[0], ne[1], smult)
+                else:
+                    t = CSFTransformer (norb, ne[0], ne[1], smult, orbsym=orbsym, wfnsym=wfnsym)
+                if t.ncsf == 0: continue
+                x = np.random.rand (t.ncsf)
+                hx_ref = sol.contract_2e (h2eff, t.vec_csf2det (x, normalize=False), norb, ne)
+                hx_ref = t.vec_det2csf (hx_ref, normalize=False)
+                hx_test = contract_2e_csf (sol, h2eff, x, norb, ne, transformer=t)
+                self.assertAlmostEqual (lib.fp (hx_test), lib.fp (hx_ref), 10)
+                xs = np.random.rand (3, t.ncsf)
+                hxs_ref = [contract_2e_csf (sol, h2eff, x, norb, ne, transformer=t) for x in xs]
+                hxs_test = contract_2e_csf (sol, h2eff, xs, norb, ne, transformer=t)
+                self.assertAlmostEqual (lib.fp (hxs_test), lib.fp (hxs_ref), 10)
+
+    def test_umat_cache(self):
+        nel = (neleci, nelec)
+        for smult in range (1,8):
+          with self.subTest (smult=smult):
+            ne = nel[smult % 2]
+            t = CSFTransformer (norb, ne[0], ne[1], smult)
+            ci = np.random.rand (t.ndeta, t.ndetb)
+            ci_csf = t.vec_det2csf (ci)
+            ci_det = t.vec_csf2det (ci_csf)
+            umats = t.umats
+            for nspin, umat in umats.items ():
+                self.assertIs (umat, csfstring.get_spin_evecs_cached (nspin, ne[0], ne[1], smult))
+                self.assertFalse (umat.flags.writeable)
+            with lib.temporary_env (csfstring, UMAT_CACHE_MAX_MEMORY=0):
+                csfstring.clear_umat_cache ()
+                t = CSFTransformer (norb, ne[0], ne[1], smult)
+                self.assertEqual (len (csfstring._umat_cache), 0)
+                self.assertAlmostEqual (lib.fp (t.vec_det2csf (ci)), lib.fp (ci_csf), 12)
+                self.assertAlmostEqual (lib.fp (t.vec_csf2det (ci_csf)), lib.fp (ci_det), 12)
+                self.assertEqual (len (csfstring._umat_cache), 0)
+                self.assertIs (t.umats, t.umats)
+
+    def test_table_cache(self):
+        orbsym = np.arange (norb) % 4
+        for smult in (1,3):
+          with self.subTest (smult=smult):
+            t0 = CSFTransformer (norb, 3, 3, smult, orbsym=orbsym, wfnsym=0)
+            t1 = CSFTransformer (norb, 3, 3, smult, orbsym=orbsym, wfnsym=0)
+            for attr in ('csd_mask', 'econf_det_mask', 'econf_csf_mask', 'confsym'):
+                self.assertIs (getattr (t0, attr), getattr (t1, attr))
+                self.assertFalse (getattr (t0, attr).flags.writeable)
+            t2 = CSFTransformer (norb, 3, 3, smult, orbsym=orbsym[::-1], wfnsym=0)
+            self.assertIsNot (t0.confsym, t2.confsym)
+            with lib.temporary_env (csfstring, TABLE_CACHE_MAX_MEMORY=0):
+                csfstring.clear_table_cache ()
+                t2 = CSFTransformer (norb, 3, 3, smult, orbsym=orbsym, wfnsym=0)
+                self.assertEqual (len (csfstring._table_cache), 0)
+                for attr in ('csd_mask', 'econf_det_mask', 'econf_csf_mask', 'confsym'):
+                    self.assertIsNot (getattr (t0, attr), getattr (t2, attr))
+                    self.assertTrue (np.all (getattr (t0, attr) == getattr (t2, attr)))
+        link_index = csfstring.get_link_index_cached (norb, 3)
+        self.assertIs (link_index, csfstring.get_link_index_cached (norb, 3))
+        link_index_ref = cistring.gen_linkstr_index_trilidx (range (norb), 3)
+        # Column 1 is not used in the trilidx format and is not initialized
+        self.assertTrue (np.all (link_index[:,:,[0,2,3]] == link_index_ref[:,:,[0,2,3]]))
+
 if __name__ == "__main__":
     print("Full Tests for spin1")
     unittest.main()
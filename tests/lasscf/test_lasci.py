@@ -109,6 +109,108 @@ class KnownValues(unittest.TestCase):
         e_lexc = np.concatenate ([item for sublist in las_test.e_lexc for item in sublist])
         self.assertTrue (np.all (e_lexc>-1e-8))
 
+    def test_ci_cycle_nthreads (self):
+        _check_()
+        from mrh.my_pyscf.mcscf import lasci_sync
+        e_states = []
+        for nthreads in (1, 4):
+            with lib.temporary_env (lasci_sync, CI_CYCLE_NTHREADS=nthreads):
+                las_test = las_ref[0].state_average (weights=weights, **states)
+                las_test.lasci (lroots=lroots)
+            self.assertTrue (las_test.converged)
+            e_states.append (las_test.e_states)
+        self.assertAlmostEqual (lib.fp (e_states[1]), lib.fp (e_states[0]), 8)
+
+    def test_h2eff_slice (self):
+        _check_()
+        from pyscf import ao2mo
+        from mrh.my_pyscf.mcscf import las_ao2mo
+        las_test = las_ref[0]
+        ncore, ncas = las_test.ncore, las_test.ncas
+        nmo = las_test.mo_coeff.shape[1]
+        h2eff_sub = las_test.get_h2eff (las_test.mo_coeff)
+        eri_ref = lib.unpack_tril (h2eff_sub.reshape (nmo*ncas, -1)).reshape (nmo, ncas, ncas, ncas)
+        eri_ref = eri_ref[ncore:ncore+ncas]
+        ncas_cum = np.cumsum ([0,] + las_test.ncas_sub.tolist ())
+        for ifrag, (i, j) in enumerate (zip (ncas_cum[:-1], ncas_cum[1:])):
+            with self.subTest (ifrag=ifrag):
+                eri = las_test.get_h2eff_slice (h2eff_sub, ifrag)
+                self.assertAlmostEqual (lib.fp (eri), lib.fp (eri_ref[i:j,i:j,i:j,i:j]), 9)
+                eri = las_test.get_h2eff_slice (h2eff_sub, ifrag, compact=8)
+                self.assertAlmostEqual (lib.fp (eri),
+                    lib.fp (ao2mo.restore (8, eri_ref[i:j,i:j,i:j,i:j], j-i)), 9)
+                eri = las_ao2mo.get_h2eff_block (las_test, h2eff_sub,
+                                                 (slice (0, ncas), slice (i, j), slice (i, j),
+                                                  slice (0, ncas)))
+                self.assertAlmostEqual (lib.fp (eri), lib.fp (eri_ref[:,i:j,i:j,:]), 9)
+
+    def test_update_h2eff_sub (self):
+        _check_()
+        las_test = las_ref[0]
+        ncore, ncas = las_test.ncore, las_test.ncas
+        nocc = ncore + ncas
+        mo_coeff = las_test.mo_coeff
+        nmo = mo_coeff.shape[1]
+        h2eff_sub = las_test.get_h2eff (mo_coeff)
+        h2eff_sub_ref = h2eff_sub.copy ()
+        h_op = las_test.get_hop (h2eff_sub=h2eff_sub)
+        ncas_cum = np.cumsum ([0,] + las_test.ncas_sub.tolist ())
+        rng = np.random.default_rng (0)
+        for cas_rot in ('interfrag', 'intrafrag', 'none'):
+            with self.subTest (cas_rot=cas_rot):
+                kappa = np.zeros ((nmo, nmo))
+                kappa[nocc:,:ncore] = rng.random ((nmo-nocc, ncore)) / 10
+                for i, j in zip (ncas_cum[:-1], ncas_cum[1:]):
+                    i += ncore
+                    j += ncore
+                    if cas_rot == 'interfrag':
+                        kappa[j:nocc,i:j] = rng.random ((nocc-j, j-i)) / 10
+                    elif cas_rot == 'intrafrag':
+                        kappa[i:j,i:j] = np.tril (rng.random ((j-i, j-i)), k=-1) / 10
+                kappa -= kappa.T
+                umat = linalg.expm (kappa)
+                mo1 = mo_coeff @ umat
+                h2eff_test = h_op._update_h2eff_sub (mo1, umat, h2eff_sub)
+                self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (las_test.get_h2eff (mo1)), 8)
+                self.assertEqual (lib.fp (h2eff_sub), lib.fp (h2eff_sub_ref))
+
+    def test_states_batched (self):
+        _check_()
+        las_test = las_ref[0]
+        h2eff_sub = las_test.get_h2eff (las_test.mo_coeff)
+        casdm1frs = las_test.states_make_casdm1s_sub ()
+        veff_a = las_test.states_fast_veffa (casdm1frs, h2eff_sub, _full=True)
+        mo_cas = las_test.mo_coeff[:,las_test.ncore:][:,:las_test.ncas]
+        for state in range (las_test.nroots):
+            with self.subTest ('fast_veffa', state=state):
+                casdm1s = [linalg.block_diag (*[d[state][s] for d in casdm1frs]) for s in (0,1)]
+                dm1s = np.stack ([mo_cas @ d @ mo_cas.T for d in casdm1s], axis=0)
+                veff_a_ref = las_test.get_veff (dm1s=dm1s, spin_sep=True)
+                self.assertAlmostEqual (lib.fp (veff_a[state]), lib.fp (veff_a_ref), 9)
+        e_states = las_test.energy_nuc () + np.array (las_test.states_energy_elec (
+            h2eff=h2eff_sub))
+        self.assertAlmostEqual (lib.fp (e_states), lib.fp (las_test.e_states), 8)
+
+    def test_microit_pcg (self):
+        _check_()
+        from mrh.my_pyscf.mcscf import lasci_sync
+        for solver, prec, verbose in (('pcg', 'diag', 0), ('pcg', 'block', 0),
+                                      ('minres', 'diag', 0), ('minres', 'block', 0),
+                                      ('cg', 'block', 0), ('cg', 'diag', lib.logger.DEBUG)):
+            with self.subTest (solver=solver, prec=prec, verbose=verbose), lib.temporary_env (
+                    lasci_sync, MICROIT_SOLVER=solver, MICROIT_PREC=prec):
+                las_test = las.state_average (weights=weights, **states)
+                las_test.verbose = verbose
+                las_test.lasci (lroots=lroots)
+                self.assertAlmostEqual (lib.fp (las_test.e_states),
+                                        lib.fp (las_ref[0].e_states), 5)
+                self.assertTrue (las_test.converged)
+        # Breakdown at the first iteration must not be reported as convergence
+        from scipy.sparse.linalg import aslinearoperator
+        A = aslinearoperator (np.diag (np.arange (1, 5, dtype=float)))
+        x, info = lasci_sync.pcg (A, np.ones (4), M=lambda r: np.zeros_like (r))
+        self.assertNotEqual (info, 0)
+
     def test_convergence_slow (self):
         _check_()
         las_test = las.state_average (weights=weights, **states)
@@ -27,9 +27,22 @@ def tearDownModule():
     mf.stdout.close ()
     del mf, frag_atom_list, mo0
 
-def _run_mod (mod):
+def _polyene (nunits):
+    '''All-trans polyene with nunits C2H2 units; carbon atoms of unit i are 1+4*i and 2+4*i'''
+    xyz = ['H     -0.943967690125   0.545000000000   0.000000000000']
+    for i in range (nunits):
+        x, y = 2.459512146748*i, -0.070000000000*i
+        xyz.append ('C {:18.12f} {:18.12f}   0.000000000000'.format (x, y))
+        xyz.append ('C {:18.12f} {:18.12f}   0.000000000000'.format (x+1.169134295109, y+0.675))
+        xyz.append ('H {:18.12f} {:18.12f}   0.000000000000'.format (x, y-1.09))
+        xyz.append ('H {:18.12f} {:18.12f}   0.000000000000'.format (x+1.169134295109, y+1.765))
+    xyz.append ('H {:18.12f} {:18.12f}   0.000000000000'.format (x+2.113101985234, y+0.13))
+    return '\n'.join (xyz)
+
+def _run_mod (mod, **kwargs):
     las=mod.LASSCF(mf, (2,2), (2,2))
     las.conv_tol_grad = 1e-7
+    las.__dict__.update (kwargs)
     localize_fn = getattr (las, 'set_fragments_', las.localize_init_guess)
     mo_coeff=localize_fn (frag_atom_list, mo0)
     las.state_average_(weights=[.2,]*5,
@@ -53,6 +66,52 @@ class KnownValues (unittest.TestCase):
             with self.subTest ('energy', state=i):
                 self.assertAlmostEqual (las_syn.e_states[i], las_asyn.e_states[i], 6)
 
+    def test_impurity_nworkers (self):
+        las_ref = _run_mod (asyn)
+        las_test = _run_mod (asyn, impurity_nworkers=2)
+        with self.subTest ('converged'):
+            self.assertTrue (las_test.converged)
+        with self.subTest ('average energy'):
+            self.assertAlmostEqual (las_test.e_tot, las_ref.e_tot, 7)
+        for i in range (5):
+            with self.subTest ('energy', state=i):
+                self.assertAlmostEqual (las_test.e_states[i], las_ref.e_states[i], 6)
+
+    def test_impurity_nworkers_4frag (self):
+        # More fragments than workers: combine_pair steps run concurrently with impurity
+        # problems and with one another
+        mol = gto.M (atom=_polyene (4), basis='sto3g', verbose=0, output='/dev/null')
+        mf4 = scf.RHF (mol).run ()
+        mo = avas.kernel (mf4, ['C 2p'])[2]
+        frags = [list (range (1+4*i, 3+4*i)) for i in range (4)]
+        results = []
+        for nworkers in (1, 2, 4):
+            las = asyn.LASSCF (mf4, (2,2,2,2), (2,2,2,2))
+            las.conv_tol_grad = 1e-7
+            las.impurity_nworkers = nworkers
+            las.kernel (las.set_fragments_(frags, mo))
+            results.append (las)
+        for las in results[1:]:
+            with self.subTest ('converged', nworkers=las.impurity_nworkers):
+                self.assertTrue (las.converged)
+            with self.subTest ('energy', nworkers=las.impurity_nworkers):
+                self.assertAlmostEqual (las.e_tot, results[0].e_tot, 7)
+        mf4.stdout.close ()
+
+    def test_impurity_pull_nthreads (self):
+        from mrh.my_pyscf.mcscf.lasscf_async import lasscf_async
+        with lib.temporary_env (lasscf_async, IMPURITY_PULL_NTHREADS=1):
+            las_ref = _run_mod (asyn)
+        with lib.temporary_env (lasscf_async, IMPURITY_PULL_NTHREADS=2):
+            las_test = _run_mod (asyn)
+        with self.subTest ('converged'):
+            self.assertTrue (las_test.converged)
+        with self.subTest ('average energy'):
+            self.assertAlmostEqual (las_test.e_tot, las_ref.e_tot, 9)
+        for i in range (5):
+            with self.subTest ('energy', state=i):
+                self.assertAlmostEqual (las_test.e_states[i], las_ref.e_states[i], 9)
+
 if __name__ == "__main__":
     print("Full Tests for lasscf_async")
     unittest.main()
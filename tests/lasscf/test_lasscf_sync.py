@@ -76,6 +76,14 @@ class KnownValues(unittest.TestCase):
         hx = h_op._matvec (x)
         self.assertAlmostEqual (lib.fp (hx), 179.117392525215, 7)
 
+    def test_hessian_matmat (self):
+        X = np.random.default_rng (1).random ((ugg.nvar_tot, 3))
+        X[:,0] = x
+        hx_ref = np.stack ([h_op._matvec (xi) for xi in X.T], axis=1)
+        hx = h_op.matmat (X)
+        self.assertAlmostEqual (lib.fp (hx[:,0]), 179.117392525215, 7)
+        self.assertLess (np.amax (np.abs (hx - hx_ref)), 1e-8)
+
     def test_hc2 (self):
         xp = x.copy ()
         xp[:offs_ci2] = 0.0
@@ -142,6 +150,29 @@ class KnownValues(unittest.TestCase):
         Mx = M_op._matvec (x)
         self.assertAlmostEqual (lib.fp (Mx), 0.6376305050505824, 6)
 
+    def test_prec_block (self):
+        # No exact blocks: identical to get_prec
+        Mx = h_op.get_prec_block (maxsize=0)._matvec (x)
+        self.assertAlmostEqual (lib.fp (Mx), 0.6376305050505824, 6)
+        # Exact CI blocks: inverse of the Hessian in the stable subspace of each block
+        b = np.linalg.norm (h_op.get_grad ())
+        for positive in (False, True):
+            M_op = h_op.get_prec_block (positive=positive)
+            for p0, p1 in ((offs_ci1, offs_ci2), (offs_ci2, ugg.nvar_tot)):
+              with self.subTest (positive=positive, block=(p0,p1)):
+                eye = np.eye (ugg.nvar_tot)[:,p0:p1]
+                H = np.stack ([h_op._matvec (e)[p0:p1] for e in eye.T], axis=1)
+                M = np.stack ([M_op._matvec (e)[p0:p1] for e in eye.T], axis=1)
+                self.assertAlmostEqual (np.amax (np.abs (M-M.T)), 0, 9)
+                w, v = np.linalg.eigh ((H+H.T)/2)
+                if positive:
+                    self.assertGreaterEqual (np.linalg.eigvalsh (M).min (), -1e-9)
+                    w = np.abs (w)
+                v = v[:,b/np.abs (w) <= np.pi*.5]
+                w = w[b/np.abs (w) <= np.pi*.5]
+                self.assertGreater (len (w), 0)
+                self.assertAlmostEqual (np.amax (np.abs (M @ v - v / w[None,:])), 0, 6)
+
 
 if __name__ == "__main__":
     print("Full Tests for LASSCF Newton-CG module functions")
@@ -71,6 +71,71 @@ class KnownValues(unittest.TestCase):
         las = LASSCF (mf_hs_df, (4,), ((4,0),), spin_sub=(5,)).set (conv_tol_grad=1e-5).run ()
         self.assertAlmostEqual (las.e_tot, mf_hs_df.e_tot, 8)
 
+    def test_df_workspace (self):
+        from scipy import linalg
+        from mrh.my_pyscf.mcscf import las_ao2mo
+        las = LASSCF (mf_df, (4,), (4,), spin_sub=(1,))
+        ncore, nocc = las.ncore, las.ncore + las.ncas
+        ws = las_ao2mo.get_df_workspace (las)
+        self.assertIs (las_ao2mo.get_df_workspace (las), ws)
+        mo0 = las.mo_coeff
+        h2eff_ref = las.get_h2eff (mo0)
+        self.assertAlmostEqual (lib.fp (las.get_h2eff (mo0)), lib.fp (h2eff_ref), 9)
+        # Rotation among the active orbitals: intermediate is rotated, not recomputed
+        np.random.seed (2)
+        kappa = np.random.rand (4,4)
+        umat = linalg.expm (kappa - kappa.T)
+        mo1 = mo0.copy ()
+        mo1[:,ncore:nocc] = mo0[:,ncore:nocc] @ umat
+        h2eff_test = las.get_h2eff (mo1)
+        ws.reset ()
+        h2eff_ref = las.get_h2eff (mo1)
+        self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+        self.assertAlmostEqual (lib.fp (h2eff_test.bmPu), lib.fp (h2eff_ref.bmPu), 9)
+        # Rotation into the external space: intermediate is recomputed
+        mo2 = mo0.copy ()
+        mo2[:,[ncore,nocc]] = mo0[:,[nocc,ncore]]
+        self.assertIsNone (ws.get_bmPu (mo2[:,ncore:nocc]))
+        # The kernel releases the workspace's reference to bmPu before returning
+        las.kernel ()
+        self.assertIsNone (las._df_workspace.bmPu)
+
+    def test_df_outcore_bmPu (self):
+        from mrh.my_pyscf.mcscf import las_ao2mo
+        las = LASSCF (mf_df, (4,), (4,), spin_sub=(1,))
+        ncore, ncas, nocc = las.ncore, las.ncas, las.ncore + las.ncas
+        mo0 = las.mo_coeff
+        nao = mo0.shape[0]
+        h2eff_ref = las.get_h2eff (mo0)
+        bmPu = h2eff_ref.bmPu
+        naux = bmPu.shape[1]
+        # Small enough max_memory to force several blocks
+        max_memory = lib.current_memory ()[0] + 3*nao*ncas*8*16/1e6
+        bmPu_outcore = las_ao2mo.OutcoreBmPu (nao, naux, ncas, max_memory=max_memory)
+        bmPu_outcore.write (0, naux, bmPu)
+        self.assertGreater (len (list (las_ao2mo.loop_bmPu (bmPu_outcore))), 1)
+        h2eff_test = las_ao2mo._get_h2eff_from_bmPu (mo0, mo0[:,ncore:nocc], bmPu_outcore)
+        self.assertAlmostEqual (lib.fp (h2eff_test), lib.fp (h2eff_ref), 9)
+        np.random.seed (3)
+        dm = np.random.rand (ncas, ncas)
+        casdm1s_sub = [np.stack ([dm+dm.T, dm.T @ dm], axis=0)]
+        h2eff_test = lib.tag_array (h2eff_test, bmPu=bmPu_outcore)
+        for _full in (False, True):
+            with self.subTest (_full=_full):
+                vk_ref = las.fast_veffa (casdm1s_sub, h2eff_ref, _full=_full)
+                vk_test = las.fast_veffa (casdm1s_sub, h2eff_test, _full=_full)
+                self.assertAlmostEqual (lib.fp (vk_test), lib.fp (vk_ref), 9)
+        umat = np.linalg.qr (np.random.rand (ncas, ncas))[0]
+        bmPu_test = np.concatenate ([blk for p0, p1, blk in las_ao2mo.loop_bmPu (
+            las_ao2mo.rotate_bmPu (bmPu_outcore, umat))], axis=1)
+        self.assertAlmostEqual (lib.fp (bmPu_test), lib.fp (np.dot (bmPu, umat)), 9)
+        # Rotations are accumulated and applied on read, not written back to disk
+        bmPu_rot = las_ao2mo.rotate_bmPu (las_ao2mo.rotate_bmPu (bmPu_outcore, umat), umat.T)
+        self.assertIs (bmPu_rot.dset, bmPu_outcore.dset)
+        bmPu_test = np.concatenate ([blk for p0, p1, blk in las_ao2mo.loop_bmPu (bmPu_rot)],
+                                    axis=1)
+        self.assertAlmostEqual (lib.fp (bmPu_test), lib.fp (bmPu), 9)
+
     def test_derivatives (self):
         np.random.seed(1)
         las = LASSCF (mf, (4,), (4,), spin_sub=(1,)).set (max_cycle_macro=1, ah_level_shift=0).run ()
@@ -29,7 +29,7 @@ from mrh.my_pyscf.lassi.lassi import root_make_rdm12s, roots_make_rdm12s
 from mrh.my_pyscf.lassi.lassi import make_stdm12s, ham_2q, las_symm_tuple
 from mrh.my_pyscf.lassi import op_o0
 from mrh.my_pyscf.lassi import op_o1
-from mrh.my_pyscf.lassi import LASSIS
+from mrh.my_pyscf.lassi import LASSI, LASSIS
 from mrh.my_pyscf.lassi.op_o1 import get_fdm1_maker
 from mrh.my_pyscf.lassi.sitools import make_sdm1
 from mrh.tests.lassi.addons import case_contract_hlas_ci, case_lassis_fbf_2_model_state
@@ -121,6 +121,40 @@ class KnownValues(unittest.TestCase):
                     self.assertAlmostEqual (lib.fp (d12_o0[r][i,...,j]),
                         lib.fp (d12_o1[r][i,...,j]), 9)
 
+    def test_stdm12s_blocks (self):
+        d12_ref = [lib.fp (d) for d in op_o1.make_stdm12s (las, las.ci, nelec_frs)]
+        rdm12s_ref = op_o1.roots_make_rdm12s (las, las.ci, nelec_frs, si)
+        with lib.H5TmpFile () as f:
+            for h5 in (None, f):
+                d12_blks = op_o1.make_stdm12s (las, las.ci, nelec_frs, block_sparse=True, h5=h5)
+                self.assertLess (len (d12_blks), nroots**2)
+                rdm12s_test = d12_blks.roots_make_rdm12s (si)
+                d12_test = [lib.fp (d) for d in d12_blks.todense ()]
+                del d12_blks
+                for r in range (2):
+                    with self.subTest ('stdm', rank=r+1, h5=(h5 is not None)):
+                        self.assertAlmostEqual (d12_test[r], d12_ref[r], 9)
+                    with self.subTest ('rdm', rank=r+1, h5=(h5 is not None)):
+                        self.assertAlmostEqual (lib.fp (rdm12s_test[r]), lib.fp (rdm12s_ref[r]),
+                                                9)
+
+    def test_stdm12s_blocks_grouped (self):
+        from mrh.my_pyscf.lassi.op_o1 import frag, stdm
+        hopping_index, ints, lroots = frag.make_ints (las, las.ci, nelec_frs)
+        log = lib.logger.new_logger (las, las.verbose)
+        outerprod = stdm.LSTDMBlocks (ints, las.ncas_sub, hopping_index, lroots, log=log)
+        ref = dict (outerprod.kernel ()[0])
+        # One pair of blocks per group
+        self.assertGreater (len (outerprod.get_block_groups (0)), 1)
+        nblks = 0
+        for tdm_blocks, t0 in outerprod.iter_kernel (0):
+            for key, (d1, d2) in tdm_blocks.items ():
+                nblks += 1
+                with self.subTest (key):
+                    self.assertAlmostEqual (lib.fp (d1), lib.fp (ref[key][0]), 9)
+                    self.assertAlmostEqual (lib.fp (d2), lib.fp (ref[key][1]), 9)
+        self.assertEqual (nblks, len (ref))
+
     def test_ham_s2_ovlp (self):
         h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
         lbls = ('ham','s2','ovlp')
@@ -131,6 +165,29 @@ class KnownValues(unittest.TestCase):
             with self.subTest(opt=1, matrix=lbl):
                 self.assertAlmostEqual (lib.fp (mat), fp, 9)
 
+    def test_ham_s2_ovlp_operators (self):
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        lbls = ('ham','s2','ovlp')
+        mats_o1 = op_o1.ham (las, h1, h2, las.ci, nelec_frs)
+        ops = op_o1.gen_contract_op_si_hdiag (las, h1, h2, las.ci, nelec_frs)
+        x = np.eye (mats_o1[0].shape[0])
+        for lbl, mat, op in zip (lbls, mats_o1, ops[:3]):
+            with self.subTest (matrix=lbl):
+                self.assertAlmostEqual (lib.fp (op (x)), lib.fp (mat), 9)
+        with self.subTest ('ovlp diagonal'):
+            self.assertAlmostEqual (lib.fp (ops[4]), lib.fp (np.diag (mats_o1[2])), 9)
+
+    def test_davidson (self):
+        lsi_ref = LASSI (las).run ()
+        lsi = LASSI (las, davidson=True, nroots_si=3).run ()
+        self.assertEqual (lsi.si.shape, (96,3))
+        self.assertAlmostEqual (lib.fp (lsi.e_roots), lib.fp (lsi_ref.e_roots[:3]), 8)
+        for i in range (3):
+            with self.subTest (root=i):
+                ovlp = np.dot (lsi.si[:,i], lsi_ref.si[:,i])
+                self.assertAlmostEqual (abs (ovlp), 1.0, 6)
+                self.assertAlmostEqual (lsi.s2[i], lsi_ref.s2[i], 4)
+
     def test_rdm12s (self):
         d12_o0 = op_o0.roots_make_rdm12s (las, las.ci, nelec_frs, si)#, orbsym=orbsym, wfnsym=wfnsym)
         d12_o1 = op_o1.roots_make_rdm12s (las, las.ci, nelec_frs, si)#, orbsym=orbsym, wfnsym=wfnsym)
@@ -148,6 +205,142 @@ class KnownValues(unittest.TestCase):
                                                     break_symmetry=False, opt=1)[r]
                     self.assertAlmostEqual (lib.fp (d12_o1_test), lib.fp (d12_o0[r][i]), 9)
 
+    def test_crunch_nthreads (self):
+        from mrh.my_pyscf.lassi.op_o1 import stdm
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        results = []
+        for nthreads in (1, 4):
+            with lib.temporary_env (stdm, CRUNCH_NTHREADS=nthreads):
+                mats = op_o1.ham (las, h1, h2, las.ci, nelec_frs)[:3]
+                stdm12s = op_o1.make_stdm12s (las, las.ci, nelec_frs)
+                rdm12s = op_o1.roots_make_rdm12s (las, las.ci, nelec_frs, si)
+                hci = op_o1.contract_ham_ci (las, h1, h2, las.ci, nelec_frs, las.ci, nelec_frs)
+            results.append ([lib.fp (x) for x in (list (mats) + list (stdm12s) + list (rdm12s))]
+                            + [lib.fp (np.concatenate ([c.ravel () for c in hci_r]))
+                               for hci_r in hci])
+        for i, (ref, test) in enumerate (zip (*results)):
+            with self.subTest (i):
+                self.assertAlmostEqual (test, ref, 9)
+
+    def test_crunch_batch (self):
+        from mrh.my_pyscf.lassi.op_o1 import stdm
+        results = []
+        # 0 MB: one pair of model states per call to each cruncher function
+        for max_memory in (0, stdm.CRUNCH_BATCH_MAX_MEMORY):
+            with lib.temporary_env (stdm, CRUNCH_BATCH_MAX_MEMORY=max_memory):
+                stdm12s = op_o1.make_stdm12s (las, las.ci, nelec_frs)
+                blks = op_o1.make_stdm12s (las, las.ci, nelec_frs, block_sparse=True)
+            results.append ([lib.fp (x) for x in stdm12s] + [lib.fp (x) for x in blks.todense ()])
+        for i, (ref, test) in enumerate (zip (*results)):
+            with self.subTest (i):
+                self.assertAlmostEqual (test, ref, 9)
+
+    def test_make_ints_nthreads (self):
+        from mrh.my_pyscf.lassi.op_o1 import frag
+        ints_ref = frag.make_ints (las, las.ci, nelec_frs, nthreads=1)[1]
+        ints_test = frag.make_ints (las, las.ci, nelec_frs, nthreads=4)[1]
+        for ifrag, (ref, test) in enumerate (zip (ints_ref, ints_test)):
+            with self.subTest (ifrag=ifrag):
+                self.assertTrue (np.all (ref.unique_root == test.unique_root))
+                for i, j in product (range (ref.nroots), repeat=2):
+                    for lbl in ('ovlp', 'dm1', 'dm2'):
+                        x, y = getattr (ref, lbl)[i][j], getattr (test, lbl)[i][j]
+                        self.assertEqual (x is None, y is None)
+                        if x is not None:
+                            self.assertAlmostEqual (lib.fp (x), lib.fp (y), 12)
+
+    def test_ints_cache (self):
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        ref = (list (op_o1.ham (las, h1, h2, las.ci, nelec_frs)[:3])
+               + list (op_o1.make_stdm12s (las, las.ci, nelec_frs))
+               + list (op_o1.roots_make_rdm12s (las, las.ci, nelec_frs, si)))
+        ref = [lib.fp (x) for x in ref]
+        lsi = LASSI (las)
+        cache = lsi.ints_cache
+        test = list (op_o1.ham (lsi, h1, h2, las.ci, nelec_frs)[:3])
+        self.assertEqual ((len (cache), cache.nhits, cache.nmisses), (1, 0, 1))
+        test += list (op_o1.make_stdm12s (lsi, las.ci, nelec_frs))
+        self.assertEqual ((len (cache), cache.nhits, cache.nmisses), (1, 1, 1))
+        test += list (op_o1.roots_make_rdm12s (lsi, las.ci, nelec_frs, si))
+        self.assertEqual ((len (cache), cache.nhits, cache.nmisses), (2, 2, 1))
+        test = [lib.fp (x) for x in test]
+        for i, (t, r) in enumerate (zip (test, ref)):
+            with self.subTest (i):
+                self.assertAlmostEqual (t, r, 9)
+        ci = [[c.copy () for c in ci_r] for ci_r in las.ci]
+        op_o1.ham (lsi, h1, h2, ci, nelec_frs)
+        ci[0][0][:] = ci[0][0][::-1]
+        op_o1.ham (lsi, h1, h2, ci, nelec_frs)
+        self.assertEqual ((len (cache), cache.nhits, cache.nmisses), (3, 2, 3))
+        lsi.reset ()
+        self.assertEqual (len (cache), 0)
+        # Capped at a fraction of max_memory
+        with lib.temporary_env (op_o1.frag, INTS_CACHE_MAX_MEMORY_FRACTION=0):
+            op_o1.ham (lsi, h1, h2, las.ci, nelec_frs)
+        self.assertEqual (len (cache), 0)
+        # Kept after kernel for subsequent RDMs, released explicitly
+        lsi.kernel ()
+        nentries, nhits = len (cache), cache.nhits
+        self.assertGreater (nentries, 0)
+        roots_make_rdm12s (lsi, lsi.ci, lsi.si)
+        self.assertGreater (cache.nhits, nhits)
+        lsi.ints_cache.clear ()
+        self.assertEqual (len (cache), 0)
+
+    def test_trans_rdm12s_lroots (self):
+        from pyscf.fci.direct_spin1 import trans_rdm12s
+        from mrh.my_pyscf.lassi.op_o1.frag import trans_rdm12s_lroots, trans_rdm1s_lroots
+        rng = np.random.default_rng (0)
+        norb = 4
+        for nelec in ((2,1), (0,3), (4,2)):
+            na = cistring.num_strings (norb, nelec[0])
+            nb = cistring.num_strings (norb, nelec[1])
+            bra = rng.random ((2,na,nb))
+            ket = rng.random ((3,na,nb))
+            tdm1s, tdm2s = trans_rdm12s_lroots (bra, ket, norb, nelec)
+            self.assertAlmostEqual (lib.fp (trans_rdm1s_lroots (bra, ket, norb, nelec)),
+                                    lib.fp (tdm1s), 12)
+            for i, j in product (range (2), range (3)):
+                d1s, d2s = trans_rdm12s (bra[i], ket[j], norb, nelec)
+                with self.subTest (nelec=nelec, bra=i, ket=j):
+                    self.assertAlmostEqual (lib.fp (np.stack (d1s, axis=0).transpose (0,2,1)),
+                                            lib.fp (tdm1s[i,j]), 12)
+                    self.assertAlmostEqual (lib.fp (np.stack (d2s, axis=0)),
+                                            lib.fp (tdm2s[i,j]), 12)
+            # Chunks bounded by max_memory, down to the pairwise fallback
+            from mrh.my_pyscf.lassi.op_o1 import frag
+            for blksize in (0, 1, 2, 3, 4):
+                with lib.temporary_env (frag, _get_epq_blksize=lambda *args: blksize):
+                    tdm1s_test, tdm2s_test = trans_rdm12s_lroots (bra, ket, norb, nelec)
+                    tdm1s_test1 = trans_rdm1s_lroots (bra, ket, norb, nelec)
+                with self.subTest (nelec=nelec, blksize=blksize):
+                    self.assertAlmostEqual (lib.fp (tdm1s_test), lib.fp (tdm1s), 12)
+                    self.assertAlmostEqual (lib.fp (tdm2s_test), lib.fp (tdm2s), 12)
+                    self.assertAlmostEqual (lib.fp (tdm1s_test1), lib.fp (tdm1s), 12)
+
+    def test_unique_root_candidates (self):
+        from mrh.my_pyscf.lassi.op_o1.frag import get_unique_root_candidates
+        rng = np.random.default_rng (0)
+        ci, nelec_r = [], []
+        for i in range (4):
+            c = linalg.qr (rng.random ((36,3)), mode='economic')[0].T.reshape (3,6,6)
+            for j in range (3):
+                u = linalg.qr (rng.random ((3,3)))[0]
+                ci.append (np.dot (u, c.reshape (3,36)).reshape (3,6,6))
+                nelec_r.append ((2,2))
+        ci.append (ci[0].copy ())
+        nelec_r.append ((2,1))
+        pairs = set (get_unique_root_candidates (ci, nelec_r))
+        for i in range (4):
+            for j, k in ((0,1), (0,2), (1,2)):
+                self.assertIn ((3*i+j, 3*i+k), pairs)
+        self.assertNotIn ((0,12), pairs)
+        # Fingerprints scale as lroots/ndet; distinct rootspaces with many determinants must
+        # still be told apart
+        ci = [linalg.qr (rng.random ((40000,2)), mode='economic')[0].T.reshape (2,200,200)
+              for i in range (4)]
+        self.assertEqual (get_unique_root_candidates (ci, [(5,5),]*4), [])
+
     def test_lassis (self):
         las0 = las.get_single_state_las (state=0)
         for ifrag in range (len (las0.ci)):
@@ -14,6 +14,7 @@
 # limitations under the License.
 import os
 import copy
+import tempfile
 import unittest
 import numpy as np
 from scipy import linalg
@@ -86,6 +87,16 @@ class KnownValues(unittest.TestCase):
             else:
                 self.assertEqual (ne, (4,4))
 
+    def test_nproc (self):
+        lsi2 = LASSI (lsi._las, nproc=2).run ()
+        self.assertAlmostEqual (lib.fp (lsi2.e_roots), lib.fp (lsi.e_roots), 9)
+        ham = (lsi.si * lsi.e_roots[None,:]) @ lsi.si.conj ().T
+        ham2 = (lsi2.si * lsi2.e_roots[None,:]) @ lsi2.si.conj ().T
+        self.assertAlmostEqual (lib.fp (ham2), lib.fp (ham), 8)
+        self.assertAlmostEqual (lib.fp (lsi2.s2), lib.fp (lsi.s2), 8)
+        self.assertAlmostEqual (lib.fp (lsi2.s2_mat), lib.fp (lsi.s2_mat), 9)
+        self.assertEqual (lsi2.rootsym.tolist (), lsi.rootsym.tolist ())
+
     def test_s2 (self):
         s2_array = np.zeros (16)
         quintets = [1,2,5,8,11]
@@ -123,6 +134,25 @@ class KnownValues(unittest.TestCase):
         for e1, e0 in zip (e_roots_test, e_roots):
             self.assertAlmostEqual (e1, e0, 8)
 
+    def test_rdms_stream (self):
+        from mrh.my_pyscf.lassi.lassi import iter_roots_make_rdm12s, dump_roots_rdm12s
+        las = lsi._las
+        states = [5,0,3]
+        for s, d1, d2 in iter_roots_make_rdm12s (las, las.ci, lsi.si, state=states,
+                                                 batch_size=2):
+            with self.subTest ('generator', state=s):
+                self.assertAlmostEqual (lib.fp (d1), lib.fp (rdm1s[s]), 9)
+                self.assertAlmostEqual (lib.fp (d2), lib.fp (rdm2s[s]), 9)
+        with tempfile.NamedTemporaryFile (dir=lib.param.TMPDIR) as f:
+            with dump_roots_rdm12s (las, las.ci, lsi.si, f, state=states,
+                                    batch_size=1) as rdms:
+                self.assertEqual (list (rdms.states), states)
+                for s, d1, d2 in rdms:
+                    with self.subTest ('h5', state=s):
+                        self.assertAlmostEqual (lib.fp (d1), lib.fp (rdm1s[s]), 9)
+                        self.assertAlmostEqual (lib.fp (d2), lib.fp (rdm2s[s]), 9)
+            self.assertIsNone (rdms._f)
+
     def test_singles_constructor (self):
         from mrh.my_pyscf.lassi.spaces import all_single_excitations
         las2 = all_single_excitations (lsi._las)
@@ -41,6 +41,19 @@ class KnownValues(unittest.TestCase):
                 lsipdft.opt = opt
                 lsipdft.kernel()
                 self.assertAlmostEqual (lsipdft.e_tot[0], mc.e_tot, 7)
+                # One handle to the RDM tempfile, released by kernel, reopened on demand
+                rdmsh5 = lsipdft.rdmsh5
+                self.assertIsNone (rdmsh5._f)
+                self.assertEqual (len (lsipdft.ints_cache), 0)
+                casdm1s = lsipdft.make_one_casdm1s (state=0)
+                self.assertIs (lsipdft.rdmsh5, rdmsh5)
+                self.assertIsNotNone (rdmsh5._f)
+                self.assertAlmostEqual (casdm1s.sum (0).trace (), 4, 9)
+                # Rerunning overwrites the tempfile in place
+                e_tot = lsipdft.e_tot
+                lsipdft.kernel ()
+                self.assertIsNone (lsipdft.rdmsh5._f)
+                self.assertAlmostEqual (lsipdft.e_tot[0], e_tot[0], 9)
 
 if __name__ == "__main__":
     print("Full Tests for LASSI-PDFT")